@@ -1,4 +1,6 @@
+import shutil
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -8,13 +10,26 @@ from scipy.special import log_expit as logsigmoid  # type: ignore
 from sklearn.metrics import roc_auc_score
 from tqdm import tqdm
 from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
+    AutoConfig,
+    DynamicCache,
     PreTrainedModel,
     PreTrainedTokenizer,
     PreTrainedTokenizerFast,
 )
 
+from ..elk.activation_store import HiddenStateWriter
+from ..elk.extraction import (
+    ExtractionProgress,
+    ModelPrefetcher,
+    ThroughputMeter,
+    estimate_model_bytes,
+    expand_cache,
+    left_pad,
+    pad_token_id,
+    position_ids_from_mask,
+    resolve_device,
+)
+from ..elk.tokenization import pretokenize, tokenizer_fingerprint
 from ..utils import assert_type
 
 
@@ -28,6 +43,12 @@ class QuirkyDataset(ABC):
     quirky_choices: tuple[str, str]
     additional_quirky_columns: list[str] | None = None
 
+    # Version of the "log_odds" column, which is part of the results path so that
+    # results scored differently are never mixed. Version 1 summed the raw logits of
+    # the tokens of each choice; version 2 sums their log-softmax probabilities. Both
+    # agree for single-token choices.
+    log_odds_version: int = 2
+
     def __init__(
         self,
         working_dir: str | Path | None = None,
@@ -48,13 +69,44 @@ class QuirkyDataset(ABC):
         self,
         model_name: str,
         max_examples: int = 1000,
+        batch_size: int = 16,
     ) -> Dataset:
         """
         Evaluate the model on the dataset and save the results as huggingface dataset
         If the results already exist, skip the evaluation
 
+        `batch_size` prompts are scored together in each forward pass
+
         Returns:
-            The dataset with the results added as a column, with order preserved
+            The dataset with the results added as a column, with order preserved.
+            The "log_odds" column holds log p(choice 1) - log p(choice 0), where the
+            probability of a multi-token choice is the product of the probabilities
+            of its tokens (see `log_odds_version`).
+        """
+        return self.evaluate_models([model_name], max_examples, batch_size)[model_name]
+
+    def evaluate_models(
+        self,
+        model_names: list[str],
+        max_examples: int = 1000,
+        batch_size: int = 16,
+        max_concurrent_bytes: int | None = None,
+        device: str | None = None,
+    ) -> dict[str, Dataset]:
+        """
+        Evaluate several models on the dataset, like `evaluate` for each of them
+
+        Models are loaded in order, and the weights of the next model are read on a
+        background thread while the current ones are scoring. Consecutive models
+        whose estimated weights fit into `max_concurrent_bytes` together are kept on
+        the device at the same time and score concurrently, each on its own CUDA
+        stream. By default this budget is half of the GPU memory, and on the CPU
+        models run one at a time. Models with the same tokenizer share one
+        tokenization pass. Scoring is checkpointed in shards, so an interrupted run
+        resumes where it stopped.
+
+        Returns:
+            The evaluated dataset of each model, in the order of `model_names`
         """
         assert isinstance(self.dataset, Dataset), "self.dataset must have type Dataset"
         assert all(
@@ -65,62 +117,171 @@ class QuirkyDataset(ABC):
             or "prompts" in self.dataset.column_names
         ), "self.dataset must have column 'prompt' or 'prompts'"
 
+        results = {}
+        pending = []
+        for model_name in model_names:
+            save_path = self._results_path(model_name)
+            if save_path.exists():
+                if self.verbose:
+                    print(f"Loading results from {save_path}")
+                results[model_name] = assert_type(
+                    Dataset, load_from_disk(str(save_path))
+                )
+            else:
+                pending.append(model_name)
+
+        device = resolve_device(device)
+        if max_concurrent_bytes is None:
+            max_concurrent_bytes = (
+                torch.cuda.get_device_properties(device).total_memory // 2
+                if device.type == "cuda"
+                else 0
+            )
+        groups = self._plan_concurrent_groups(pending, max_concurrent_bytes)
+
+        # tokenized datasets, shared by all models with the same tokenizer
+        tokenized = {}
+        models = iter(ModelPrefetcher(pending, device))
+        for group in groups:
+            loaded = []
+            for _ in group:
+                model_name, model, tokenizer = next(models)
+                key = tokenizer_fingerprint(tokenizer)
+                if key not in tokenized:
+                    tokenized[key] = self._tokenize(tokenizer, max_examples)
+                loaded.append((model_name, model, tokenizer, tokenized[key]))
+            del model
+
+            if len(loaded) == 1:
+                results[group[0]] = self._score_model(*loaded[0], batch_size)
+            else:
+                with ThreadPoolExecutor(max_workers=len(loaded)) as pool:
+                    futures = {
+                        args[0]: pool.submit(self._score_model, *args, batch_size)
+                        for args in loaded
+                    }
+                    for model_name, future in futures.items():
+                        results[model_name] = future.result()
+            # release the models of this group before the next one is loaded
+            del loaded
+
+        return {model_name: results[model_name] for model_name in model_names}
+
+    def _results_path(self, model_name: str) -> Path:
         model_last = model_name.split("/")[-1]
-        save_path = self.working_dir / f"{model_last}_results"
-        if save_path.exists():
-            if self.verbose:
-                print(f"Loading results from {save_path}")
-            return assert_type(Dataset, load_from_disk(str(save_path)))
-
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map={"": torch.cuda.current_device()},
-            torch_dtype="auto",
-        )
-        tokenizer = AutoTokenizer.from_pretrained(model_name, truncation_side="left")
-
-        dataset = self.dataset.select(range(max_examples))
+        return self.working_dir / f"{model_last}_results_v{self.log_odds_version}"
 
-        log_odds = torch.full(
-            [
-                len(dataset),
-            ],
-            torch.nan,
-            device=model.device,
-            dtype=model.dtype,
+    @staticmethod
+    def _plan_concurrent_groups(
+        model_names: list[str], max_concurrent_bytes: int
+    ) -> list[list[str]]:
+        """Group consecutive models whose estimated weights fit on the device together"""
+        groups, group_bytes = [], 0
+        for model_name in model_names:
+            config = AutoConfig.from_pretrained(model_name)
+            num_bytes = estimate_model_bytes(config)
+            if groups and group_bytes + num_bytes <= max_concurrent_bytes:
+                groups[-1].append(model_name)
+                group_bytes += num_bytes
+            else:
+                groups.append([model_name])
+                group_bytes = num_bytes
+        return groups
+
+    def _tokenize(self, tokenizer, max_examples: int) -> Dataset:
+        # Token ids are cached on disk and shared by all models with this tokenizer
+        prompt_column = "prompt" if "prompt" in self.dataset.column_names else "prompts"
+        return pretokenize(
+            self.dataset,
+            tokenizer,
+            [prompt_column],
+            "choices",
+            single_token_choices=False,
+        ).select(range(max_examples))
+
+    def _score_model(
+        self,
+        model_name: str,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast,
+        dataset: Dataset,
+        batch_size: int,
+        shard_size: int = 512,
+    ) -> Dataset:
+        """Score a tokenized dataset with a loaded model and save the results"""
+        stream = (
+            torch.cuda.Stream(model.device) if model.device.type == "cuda" else None
         )
-        for i, example in tqdm(enumerate(dataset), total=len(dataset)):
-            example = assert_type(dict, example)
-
-            # either get log odds from prompt or all prompts
-            if "prompt" in example:
-                log_odds[i] = self._get_log_odds(
-                    model,
-                    tokenizer,
-                    example["prompt"],
-                    example["choices"],
-                )
-            elif "prompts" in example:
-                example_log_odds = [
-                    self._get_log_odds(model, tokenizer, p, example["choices"])
-                    for p in example["prompts"]
-                ]
-                log_odds[i] = torch.mean(torch.stack(example_log_odds))
+        with torch.cuda.stream(stream):
+            save_path = self._results_path(model_name)
+            # log odds are checkpointed per shard so that a restarted run can resume
+            partial_dir = save_path.with_name(f"{save_path.name}_partial")
+            progress = ExtractionProgress(partial_dir, shard_size)
+            progress.start(len(dataset))
+            writer = HiddenStateWriter(
+                partial_dir,
+                "log_odds",
+                1,
+                (len(dataset),),
+                torch.float32,
+                resume=progress.resumed,
+            )
 
-        np_lo = log_odds.cpu().float().numpy()
-        dataset = dataset.add_column("log_odds", np_lo)  # type: ignore
-        dataset.save_to_disk(save_path)
+            # either get log odds from prompt or the mean over all prompts
+            prompt_column = (
+                "prompt_ids" if "prompt_ids" in dataset.column_names else "prompts_ids"
+            )
+            meter = ThroughputMeter()
+            for shard in tqdm(progress.pending_shards(), desc=model_name):
+                records = dataset.select(shard)
+                prompts = records[prompt_column]
+                if prompt_column == "prompt_ids":
+                    prompts = [[p] for p in prompts]
+                # flatten to one (example, prompt) pair per row
+                owners = [i for i, ps in enumerate(prompts) for _ in ps]
+                flat_prompts = [p for ps in prompts for p in ps]
+                flat_choices = [records["choice_ids"][i] for i in owners]
+
+                flat_log_odds = torch.empty(
+                    len(flat_prompts), dtype=torch.float32, device=model.device
+                )
+                for start in range(0, len(flat_prompts), batch_size):
+                    batch = slice(start, start + batch_size)
+                    flat_log_odds[batch] = self._get_log_odds(
+                        model, tokenizer, flat_prompts[batch], flat_choices[batch]
+                    )
+                    meter.update(
+                        flat_prompts[batch],
+                        tokens_per_prompt=max(
+                            len(c) for cs in flat_choices[batch] for c in cs
+                        ),
+                    )
+                owners = torch.as_tensor(owners, device=model.device)
+                counts = torch.bincount(owners, minlength=len(records))
+                sums = torch.zeros(
+                    len(records), dtype=torch.float32, device=model.device
+                ).index_add_(0, owners, flat_log_odds)
+                writer.write(slice(shard.start, shard.stop), (sums / counts)[None])
+                progress.mark_done(shard, [writer])
+            progress.flush([writer])
+            meter.report(f"Scored {len(dataset)} examples with {model_name}: ")
+
+            np_lo = writer.load()[0].numpy().copy()
+            dataset = dataset.remove_columns([prompt_column, "choice_ids"])
+            dataset = dataset.add_column("log_odds", np_lo)  # type: ignore
+            dataset.save_to_disk(save_path)
+            shutil.rmtree(partial_dir)
 
         if self.verbose:
-            labels = torch.as_tensor(dataset["label"], device=model.device)
-            accuracy = (log_odds > 0).eq(labels).float().mean().item()
+            labels = np.asarray(dataset["label"])
+            accuracy = ((np_lo > 0) == labels).mean()
             try:
-                auc = roc_auc_score(labels.cpu().numpy(), np_lo)
+                auc = roc_auc_score(labels, np_lo)
             except ValueError:
                 auc = np.nan
-            balance = labels.float().mean().item()
+            balance = labels.mean()
             cal_thresh = np.quantile(np_lo, balance)
-            cal_acc = (log_odds > cal_thresh).eq(labels).float().mean().item()
+            cal_acc = ((np_lo > cal_thresh) == labels).mean()
 
             print(f"Accuracy: {accuracy:.3f}")
             print(f"AUC: {auc:.3f}")
@@ -130,53 +291,88 @@ class QuirkyDataset(ABC):
         return dataset
 
     @staticmethod
+    @torch.inference_mode()
     def _get_log_odds(
         model: PreTrainedModel,
         tokenizer: PreTrainedTokenizer | PreTrainedTokenizerFast,
-        prompt_str: str,
-        choice_strs: list[str],
+        prompts: list[list[int]],
+        choice_toks: list[list[list[int]]],
     ) -> torch.Tensor:
-        # warn if truncating
-        prompt = tokenizer.encode(prompt_str)
-        choice_toks = [tokenizer.encode(c) for c in choice_strs]
-        num_completion_toks = max(len(c) for c in choice_toks)
-        if len(prompt) + num_completion_toks > model.config.max_position_embeddings:
-            print(
-                f"Warning: prompt length {len(prompt)} exceeds "
-                f"model max length {tokenizer.model_max_length}"
+        """
+        Log odds of the second over the first choice for a batch of prompts
+
+        Each choice may span several tokens. The prompts are run once, their cache is
+        expanded to one copy per choice, and the continuations of both choices of all
+        prompts are scored teacher-forced in a single forward pass.
+
+        Returns:
+            Tensor of shape (len(prompts),) with log p(choice 1) - log p(choice 0)
+        """
+        num_completion_toks = max(len(c) for choices in choice_toks for c in choices)
+        max_prompt_len = model.config.max_position_embeddings - num_completion_toks
+        truncated = []
+        for prompt in prompts:
+            # warn if truncating
+            if len(prompt) > max_prompt_len:
+                print(
+                    f"Warning: prompt length {len(prompt)} exceeds "
+                    f"model max length {tokenizer.model_max_length}"
+                )
+                prompt = prompt[-max_prompt_len:]
+            truncated.append(list(prompt))
+
+        n = len(truncated)
+        input_ids, attention_mask = left_pad(
+            truncated, pad_token_id(tokenizer), model.device
+        )
+        cache = DynamicCache()
+        outputs = model(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids_from_mask(attention_mask),
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        # one row per (prompt, choice); the first choice token is predicted by the
+        # last prompt position, the remaining ones by teacher forcing on the cache
+        rows = [c for choices in choice_toks for c in choices[:2]]
+        first = torch.as_tensor([c[0] for c in rows], device=model.device)
+        logprobs = outputs.logits[:, -1].float().log_softmax(-1)
+        scores = logprobs.repeat_interleave(2, dim=0).gather(1, first[:, None])[:, 0]
+
+        num_rest = max(len(c) for c in rows) - 1
+        if num_rest > 0:
+            # right pad the continuations, which keeps them aligned with the prompts;
+            # outputs at padded positions are masked out of the score
+            inputs = torch.full(
+                [2 * n, num_rest], pad_token_id(tokenizer), device=model.device
             )
-            prompt = prompt[
-                -model.config.max_position_embeddings + num_completion_toks :
-            ]
-
-        with torch.inference_mode():
-            # get model outputs and cache in response to prompt
-            outputs = model(
-                torch.as_tensor([prompt], device=model.device), use_cache=True
+            targets = torch.zeros_like(inputs)
+            valid = torch.zeros_like(inputs, dtype=torch.bool)
+            for r, c in enumerate(rows):
+                if len(c) > 1:
+                    inputs[r, : len(c) - 1] = torch.as_tensor(c[:-1])
+                    targets[r, : len(c) - 1] = torch.as_tensor(c[1:])
+                    valid[r, : len(c) - 1] = True
+
+            prompt_mask = attention_mask.repeat_interleave(2, dim=0)
+            mask = torch.cat([prompt_mask, valid.long()], dim=1)
+            positions = position_ids_from_mask(prompt_mask)[:, -1:] + 1
+            positions = positions + torch.arange(num_rest, device=model.device)
+            choice_outputs = model(
+                inputs,
+                attention_mask=mask,
+                position_ids=positions,
+                past_key_values=expand_cache(cache, 2),
             )
-            logits = outputs.logits[0, -1, [choice_toks[0][0], choice_toks[1][0]]]
-
-            # we compute log_odds of the whole completion, possibly multiple tokens
-            # for each completion, while there are more tokens, get more outputs
-            for j, ctoks in enumerate(choice_toks):
-                cache = outputs.past_key_values
-                input_ids = prompt.copy()
-                for k in range(len(ctoks) - 1):
-                    input_ids.append(ctoks[k])
-                    choice_outputs = model(
-                        torch.as_tensor([input_ids], device=model.device),
-                        past_key_values=cache,
-                        use_cache=True,
-                    )
-                    cache = choice_outputs.past_key_values
-                    # add the logit for the next token
-                    logits[j] += choice_outputs.logits[0, -1, ctoks[k + 1]]
+            logprobs = choice_outputs.logits.float().log_softmax(-1)
+            token_scores = logprobs.gather(2, targets[..., None])[..., 0]
+            scores = scores + token_scores.masked_fill(~valid, 0).sum(-1)
 
-        # softmax adds constant to both, which cancels out, so is unnecessary here
         # log(p / (1 - p)) = log(p) - log(1 - p)
-        log_odds = logits[1] - logits[0]
-
-        return log_odds
+        scores = scores.view(n, 2)
+        return scores[:, 1] - scores[:, 0]
 
     @abstractmethod
     def _load(self) -> Dataset:
@@ -197,11 +393,10 @@ class QuirkyDataset(ABC):
         covers a wide range of scales (resources expended in training).
         """
         datasets = {
-            model: self.evaluate(
-                model,
-                max_examples=max_examples,
-            ).with_format("numpy")
-            for model in model_names
+            model: ds.with_format("numpy")
+            for model, ds in self.evaluate_models(
+                model_names, max_examples=max_examples
+            ).items()
         }
 
         losses = np.stack(
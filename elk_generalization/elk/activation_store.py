@@ -0,0 +1,585 @@
+"""On-disk storage for extracted hidden states."""
+
+import json
+import os
+import shutil
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import Tensor
+
+# numpy has no bfloat16, so those activations are stored as raw 16 bit integers
+NUMPY_DTYPES = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+}
+
+
+def to_numpy_dtype(dtype: torch.dtype):
+    if dtype not in NUMPY_DTYPES:
+        raise NotImplementedError(f"Unsupported activation dtype: {dtype}")
+    return NUMPY_DTYPES[dtype]
+
+
+def from_memmap(array: np.ndarray, dtype: torch.dtype) -> Tensor:
+    """Wrap a (memory-mapped) numpy array as a tensor of the given dtype without copying."""
+    return torch.from_numpy(array).view(dtype)
+
+
+# Storage formats of saved activations. "native" is a plain list of tensors in the
+# model dtype; the others are written by `quantize_activations`.
+STORAGE_FORMATS = ("native", "float16", "bfloat16", "int8")
+
+
+def quantize_layer(layer: Tensor, storage: str) -> dict:
+    """Compress the activations of a single layer for storage.
+
+    With "int8", each channel (the last dimension) is affinely mapped onto the int8
+    range using its own scale and zero point, which keeps the error small even for
+    the few channels with very large activations. The error of the round trip is
+    recorded along with the data.
+    """
+    x = layer.float()
+    if storage == "int8":
+        channels = x.reshape(-1, x.shape[-1])
+        lo = channels.amin(dim=0).clamp(max=0)
+        hi = channels.amax(dim=0).clamp(min=0)
+        scale = ((hi - lo) / 255).clamp(min=torch.finfo(torch.float32).tiny)
+        zero_point = (-128 - lo / scale).round()
+        data = (x / scale + zero_point).round().clamp(-128, 127).to(torch.int8)
+        out = {"data": data, "scale": scale, "zero_point": zero_point}
+    else:
+        out = {"data": x.to(getattr(torch, storage))}
+
+    error = dequantize_layer(out) - x
+    out["error"] = {
+        "rmse": error.square().mean().sqrt().item(),
+        "relative_rmse": (error.norm() / x.norm().clamp(min=1e-12)).item(),
+        "max_abs": error.abs().max().item(),
+    }
+    return out
+
+
+def dequantize_layer(layer: dict, device: str | torch.device | None = None) -> Tensor:
+    """Float32 activations of a layer compressed by `quantize_layer`."""
+    data = layer["data"].to(device)
+    if "scale" not in layer:
+        return data.float()
+    scale = layer["scale"].to(device)
+    return (data.float() - layer["zero_point"].to(device)) * scale
+
+
+def quantize_activations(layers: list[Tensor], storage: str) -> dict:
+    """Compressed, self-describing version of a list of per-layer activations."""
+    assert storage in STORAGE_FORMATS[1:], f"Unknown storage format: {storage}"
+    return {
+        "storage": storage,
+        "dtype": str(layers[0].dtype).removeprefix("torch."),
+        "layers": [quantize_layer(layer, storage) for layer in layers],
+    }
+
+
+class QuantizedActivations(Sequence):
+    """Per-layer activations that are dequantized to float32 when a layer is accessed.
+
+    Behaves like the list of tensors stored in the native format, so reporters can
+    index, iterate over and slice it, but only the compressed data is kept in memory.
+    Assigning a tensor to a layer replaces it.
+    """
+
+    def __init__(self, state: dict, device: str | torch.device | None = None):
+        self.storage = state["storage"]
+        self.dtype = state["dtype"]
+        self.layers = state["layers"]
+        self.device = device
+        self._replaced = {}
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(len(self))[k]]
+        k = range(len(self))[k]
+        if k in self._replaced:
+            return self._replaced[k]
+        return dequantize_layer(self.layers[k], self.device)
+
+    def __setitem__(self, k: int, value: Tensor):
+        self._replaced[range(len(self))[k]] = value
+
+    def errors(self) -> list[dict]:
+        """Quantization error of each layer, as recorded when it was saved."""
+        return [layer["error"] for layer in self.layers]
+
+
+# Artifact layouts. "file" saves all layers in a single `<name>.pt`; "layers" saves
+# a `<name>/` directory with one file per layer, see `ActivationStore`.
+LAYOUTS = ("file", "layers")
+
+
+def save_atomic(obj, path: Path):
+    """`torch.save` to a hidden file next to `path` and rename it into place, so that
+    an interrupted save never leaves a truncated file at `path`."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_activations(layers: list[Tensor], path: Path, storage: str = "native"):
+    """Save per-layer activations in the given storage format."""
+    if storage == "native":
+        save_atomic(layers, path)
+        return
+
+    state = quantize_activations(layers, storage)
+    save_atomic(state, path)
+    worst = max(layer["error"]["relative_rmse"] for layer in state["layers"])
+    print(f"Saved {path} as {storage} (max relative RMS error {worst:.2e})")
+
+
+def _publish_layer_major(tmp_dir: Path, path: Path, meta: dict):
+    """Write the metadata of a finished layer-major store and move it into place.
+
+    `meta.json` is written last, so a directory without it is incomplete.
+    """
+    (tmp_dir / "meta.json").write_text(json.dumps(meta, indent=1))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_dir, path)
+
+
+def save_layer_major(layers: Sequence[Tensor], path: Path, storage: str = "native"):
+    """Save per-layer activations as a layer-major directory, one file per layer.
+
+    Layer `k` is saved as `layer_{k:03d}.npy` in the storage dtype (bfloat16 as raw
+    16 bit integers), along with `quant_{k:03d}.npy` holding the per-channel scale
+    and zero point for "int8". Only one layer is held in memory at a time. Layers of
+    `QuantizedActivations` that are already in the storage format are copied as is.
+    """
+    assert storage in STORAGE_FORMATS, f"Unknown storage format: {storage}"
+    path = Path(path)
+    tmp_dir = path.with_name(f".{path.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    errors = []
+    for k in range(len(layers)):
+        if storage == "native":
+            data = layers[k].cpu()
+        else:
+            if (
+                isinstance(layers, QuantizedActivations)
+                and layers.storage == storage
+                and k not in layers._replaced
+            ):
+                quantized = layers.layers[k]
+            else:
+                quantized = quantize_layer(layers[k], storage)
+            data = quantized["data"]
+            errors.append(quantized["error"])
+            if "scale" in quantized:
+                quant = torch.stack([quantized["scale"], quantized["zero_point"]])
+                np.save(tmp_dir / f"quant_{k:03d}.npy", quant.numpy())
+        if data.dtype == torch.bfloat16:
+            data = data.view(torch.int16)
+        np.save(tmp_dir / f"layer_{k:03d}.npy", data.numpy())
+
+    meta = {
+        "num_layers": len(layers),
+        "shape": list(layers[0].shape),
+        "dtype": getattr(layers, "dtype", str(layers[0].dtype).removeprefix("torch.")),
+        "storage": storage,
+        "errors": errors,
+    }
+    _publish_layer_major(tmp_dir, path, meta)
+    if errors:
+        worst = max(error["relative_rmse"] for error in errors)
+        print(f"Saved {path} as {storage} (max relative RMS error {worst:.2e})")
+
+
+class ActivationStore(Sequence):
+    """Per-layer activations of an artifact that are read one layer at a time.
+
+    Layer-major stores (see `save_layer_major`) memory-map only the file of the
+    requested layer, so `store.layer(k)` reads a single layer from disk instead of
+    all of them. For artifacts saved as a single `<name>.pt` the store falls back to
+    memory-mapping that file, which also only reads the pages of the requested layer
+    for the native format; compressed files are loaded whole but stay compressed.
+    Native CPU layers are views of the (copy-on-write) memory maps rather than copies,
+    so processes reading the same files share the page cache, and a layer is only
+    moved to `device` when it is accessed.
+
+    Native layers are returned in their saved dtype, compressed layers are
+    dequantized to float32. Like `QuantizedActivations`, the store can be indexed,
+    iterated over and sliced like a list of tensors, and assigning a tensor to a
+    layer replaces it.
+
+    Args:
+        root: Directory containing the artifact, e.g. a split of a dataset.
+        name: Name of the artifact, e.g. "hiddens" or "ccs_hiddens".
+        device: Device the layers are moved to. They stay on the CPU by default.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        name: str = "hiddens",
+        device: str | torch.device | None = None,
+    ):
+        self.path = Path(root) / name
+        self.device = device
+        self._replaced = {}
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            self.meta = json.loads(meta_path.read_text())
+            self.storage = self.meta["storage"]
+            self._file = None
+        else:
+            file = self.path.with_suffix(".pt")
+            if not file.exists():
+                raise FileNotFoundError(f"No activations at {self.path} or {file}")
+            state = torch.load(file, map_location="cpu", mmap=True)
+            if isinstance(state, dict):
+                state = QuantizedActivations(state)
+            self.storage = getattr(state, "storage", "native")
+            self._file = state
+
+    def __len__(self) -> int:
+        if self._file is not None:
+            return len(self._file)
+        return self.meta["num_layers"]
+
+    def layer(self, k: int, device: str | torch.device | None = None) -> Tensor:
+        """Activations of layer `k`, read from disk when they are first used."""
+        k = range(len(self))[k]
+        if k in self._replaced:
+            return self._replaced[k]
+        device = device or self.device
+        if self._file is not None:
+            layer = self._file[k]
+        else:
+            # A copy-on-write map, so writes to the tensor never reach the file
+            data = np.load(self.path / f"layer_{k:03d}.npy", mmap_mode="c")
+            data = torch.from_numpy(np.asarray(data))
+            if self.storage == "native":
+                layer = data.view(getattr(torch, self.meta["dtype"]))
+            else:
+                quantized = {"data": data.view(getattr(torch, self.storage))}
+                if self.storage == "int8":
+                    quant = np.load(self.path / f"quant_{k:03d}.npy")
+                    quantized["scale"], quantized["zero_point"] = torch.from_numpy(
+                        quant
+                    )
+                layer = dequantize_layer(quantized)
+        return layer.to(device) if device is not None else layer
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.layer(i) for i in range(len(self))[k]]
+        return self.layer(k)
+
+    def __setitem__(self, k: int, value: Tensor):
+        self._replaced[range(len(self))[k]] = value
+
+    def errors(self) -> list[dict]:
+        """Quantization error of each layer, empty for the native format."""
+        if self._file is not None:
+            return self._file.errors() if self.storage != "native" else []
+        return self.meta["errors"]
+
+
+class LazyLayers(Sequence):
+    """Per-layer activations that are computed by `load(k)` when layer `k` is
+    accessed, e.g. by concatenating the layers of several `ActivationStore`s, so that
+    no layer is read before it is used.
+
+    The last accessed layer is kept, so repeated accesses to the same layer, as in a
+    loop over the layers, load it only once.
+    """
+
+    def __init__(self, num_layers: int, load: Callable[[int], Tensor]):
+        self.num_layers = num_layers
+        self.load = load
+        self._last: tuple[int, Tensor] | None = None
+
+    def __len__(self) -> int:
+        return self.num_layers
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(len(self))[k]]
+        k = range(len(self))[k]
+        if self._last is None or self._last[0] != k:
+            # Drop the previous layer before loading the next one
+            self._last = None
+            self._last = (k, self.load(k))
+        return self._last[1]
+
+
+def activations_exist(root: Path, name: str = "hiddens") -> bool:
+    """Whether an artifact was completely saved under `root` in either layout."""
+    root = Path(root)
+    return (root / f"{name}.pt").exists() or (root / name / "meta.json").exists()
+
+
+def extraction_complete(root: Path, name: str = "hiddens") -> bool:
+    """Whether the extraction of a split finished, i.e. its artifact `name` exists
+    and no `ExtractionProgress` manifest is left. The engine saves the hiddens after
+    every other artifact of the split."""
+    root = Path(root)
+    return activations_exist(root, name) and not (root / "progress.json").exists()
+
+
+def load_activations(
+    path: Path, device: str | torch.device | None = None
+) -> list[Tensor] | QuantizedActivations | ActivationStore:
+    """Load per-layer activations saved in any storage format.
+
+    Native files load as a list of tensors on `device`. Compressed files stay
+    compressed in memory and each layer is dequantized to float32 on `device` when
+    it is accessed. If `path` is a `<name>.pt` file that was saved in the layer-major
+    layout instead, its `ActivationStore` is returned.
+    """
+    path = Path(path)
+    if not path.exists() and (path.with_suffix("") / "meta.json").exists():
+        return ActivationStore(path.parent, path.stem, device)
+    state = torch.load(path, map_location=device)
+    if isinstance(state, dict):
+        return QuantizedActivations(state, device)
+    return state
+
+
+class HiddenStateWriter:
+    """Streams per-layer activations to memory-mapped files on disk.
+
+    Each call to `write` starts an asynchronous device-to-host copy into a pinned
+    staging buffer and then drains the previously staged batch into the per-layer
+    memory maps, so the disk writes overlap with the next forward pass. Memory use is
+    bounded by two batches regardless of the number of examples.
+
+    The layer files live in a hidden directory next to the final artifact and are
+    removed by `save`, which writes the usual list-of-tensors `.pt` file or, with the
+    "layers" layout, a layer-major `ActivationStore` directory. New layer files are
+    filled with NaN, so rows that were never written fail the finiteness check of
+    `load` and `save` instead of passing as zeros.
+
+    Args:
+        root: Directory in which the artifact is saved.
+        name: Name of the artifact, e.g. "hiddens" or "ccs_hiddens".
+        num_layers: Number of layers.
+        shape: Shape of the activations of a single layer, e.g. (N, d) or (N, 2, d).
+        dtype: Dtype of the activations.
+        resume: Reopen existing layer files instead of overwriting them, so that rows
+            written by an earlier, interrupted run are kept.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        name: str,
+        num_layers: int,
+        shape: tuple[int, ...],
+        dtype: torch.dtype,
+        resume: bool = False,
+    ):
+        self.root = Path(root)
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.layer_dir = self.root / f".{name}_layers"
+        self.layer_dir.mkdir(parents=True, exist_ok=True)
+
+        self.layers = [
+            self._open_layer(self.layer_dir / f"layer_{j:03d}.npy", resume)
+            for j in range(num_layers)
+        ]
+
+        # Two pinned staging buffers, so one can be filled while the other is drained
+        self._staging: list[Tensor | None] = [None, None]
+        self._pending = None
+        self._next = 0
+
+    def _open_layer(self, path: Path, resume: bool) -> np.memmap:
+        if resume and path.exists():
+            layer = np.lib.format.open_memmap(path, mode="r+")
+            assert layer.shape == self.shape, (
+                f"Cannot resume {path}: expected shape {self.shape}, "
+                f"found {layer.shape}"
+            )
+            return layer
+        layer = np.lib.format.open_memmap(
+            path, mode="w+", dtype=to_numpy_dtype(self.dtype), shape=self.shape
+        )
+        nan = torch.tensor(float("nan"), dtype=self.dtype)
+        layer[...] = nan.view(self._storage_dtype()).numpy()
+        return layer
+
+    def _staging_buffer(self, k: int, like: Tensor) -> Tensor:
+        buffer = self._staging[k]
+        if buffer is None or buffer.shape[1] < like.shape[1]:
+            buffer = torch.empty(
+                like.shape,
+                dtype=self.dtype,
+                pin_memory=torch.cuda.is_available(),
+            )
+            self._staging[k] = buffer
+        return buffer[:, : like.shape[1]]
+
+    def write(self, index: slice | Tensor, layers: Tensor):
+        """Queue the activations of a batch for writing.
+
+        Args:
+            index: Rows of the artifact the batch belongs to.
+            layers: Activations of shape (L, B, ...) on any device.
+        """
+        staging = self._staging_buffer(self._next, layers)
+        staging.copy_(layers, non_blocking=True)
+        event = None
+        if layers.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+
+        self.flush()
+        self._pending = (index, staging, event)
+        self._next = 1 - self._next
+
+    def flush(self):
+        """Copy the staged batch, if any, into the memory maps."""
+        if self._pending is None:
+            return
+        index, staging, event = self._pending
+        if event is not None:
+            event.synchronize()
+        # Checked on the host copy, since checking on the device would force a sync
+        assert staging.isfinite().all(), f"Non-finite activations for {self.name}"
+        if isinstance(index, Tensor):
+            index = index.cpu().numpy()
+        for layer, values in zip(self.layers, staging):
+            layer[index] = values.view(self._storage_dtype()).numpy()
+        self._pending = None
+
+    def _storage_dtype(self) -> torch.dtype:
+        return torch.int16 if self.dtype == torch.bfloat16 else self.dtype
+
+    def close(self):
+        """Write all queued activations through to disk."""
+        self.flush()
+        for layer in self.layers:
+            layer.flush()
+
+    def check_complete(self, chunk_size: int = 4096):
+        """Check that every row of every layer was written and is finite."""
+        self.close()
+        for k, layer in enumerate(self.layers):
+            for start in range(0, len(layer), chunk_size):
+                rows = from_memmap(layer[start : start + chunk_size], self.dtype)
+                assert rows.isfinite().all(), (
+                    f"Rows of layer {k} of {self.name} in {self.layer_dir} were never "
+                    f"written or are not finite"
+                )
+
+    def load(self) -> list[Tensor]:
+        """Return the layers as a list of tensors backed by the memory maps, after
+        checking that every row was written."""
+        self.check_complete()
+        return [from_memmap(layer, self.dtype) for layer in self.layers]
+
+    def save(self, storage: str = "native", layout: str = "file"):
+        """Write the artifact in the given storage format and layout and remove the
+        layer files."""
+        assert layout in LAYOUTS, f"Unknown layout: {layout}"
+        path = self.root / self.name
+        if layout == "file":
+            save_activations(self.load(), path.with_suffix(".pt"), storage)
+        elif storage == "native":
+            # The layer files already are a native layer-major store
+            self.check_complete()
+            meta = {
+                "num_layers": len(self.layers),
+                "shape": list(self.shape),
+                "dtype": str(self.dtype).removeprefix("torch."),
+                "storage": storage,
+                "errors": [],
+            }
+            self.layers = []
+            _publish_layer_major(self.layer_dir, path, meta)
+            return
+        else:
+            save_layer_major(self.load(), path, storage)
+        self.remove()
+
+    def remove(self):
+        """Delete the layer files."""
+        self.layers = []
+        shutil.rmtree(self.layer_dir)
+
+
+def convert_to_layer_major(
+    path: Path, storage: str | None = None, remove_original: bool = False
+) -> Path:
+    """Convert a `<name>.pt` artifact to a layer-major store next to it.
+
+    Args:
+        path: The `.pt` file, in any storage format.
+        storage: Storage format of the store. Defaults to that of the file.
+        remove_original: Delete the `.pt` file once the store is saved.
+    """
+    path = Path(path)
+    state = torch.load(path, map_location="cpu", mmap=True)
+    layers = QuantizedActivations(state) if isinstance(state, dict) else state
+    save_layer_major(
+        layers, path.with_suffix(""), storage or getattr(layers, "storage", "native")
+    )
+    if remove_original:
+        path.unlink()
+    return path.with_suffix("")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Convert saved activations to the layer-major layout, so that "
+        "single layers can be loaded without reading the others."
+    )
+    parser.add_argument(
+        "paths",
+        type=Path,
+        nargs="+",
+        help="Activation files, or directories that are searched for them",
+    )
+    parser.add_argument(
+        "--names",
+        type=str,
+        nargs="+",
+        default=["hiddens", "ccs_hiddens", "neg_hiddens"],
+        help="Names of the artifacts converted in directories",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=STORAGE_FORMATS,
+        help="Storage format of the converted activations. Defaults to that of each file.",
+    )
+    parser.add_argument(
+        "--remove-original",
+        action="store_true",
+        help="Delete each .pt file after it is converted",
+    )
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        if path.is_dir():
+            files += sorted(
+                file for name in args.names for file in path.rglob(f"{name}.pt")
+            )
+        else:
+            files.append(path)
+    for file in files:
+        out = convert_to_layer_major(file, args.storage, args.remove_original)
+        print(f"Converted {file} to {out}")
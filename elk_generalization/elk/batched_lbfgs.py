@@ -0,0 +1,156 @@
+"""L-BFGS for a batch of independent optimization problems."""
+
+from typing import Callable
+
+import torch
+from torch import Tensor
+
+
+def batched_lbfgs(
+    fn: Callable[[Tensor, Tensor], Tensor],
+    x0: Tensor,
+    *,
+    max_iter: int = 10_000,
+    history_size: int = 100,
+    tolerance_grad: float = 1e-7,
+    tolerance_change: float = 1e-9,
+    max_backtracks: int = 30,
+) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Minimize B independent objectives at once with L-BFGS.
+
+    Every row of `x0` is optimized as its own problem, with its own curvature
+    history, line search, and convergence checks, so the result matches B separate
+    runs of this function. Evaluations are vectorized over the rows that haven't
+    converged yet, so the cost of an iteration shrinks as rows converge.
+
+    The line search halves the step until the Armijo (sufficient decrease) condition
+    holds. It doesn't enforce the strong Wolfe conditions, so unlike
+    `torch.optim.LBFGS` with `line_search_fn="strong_wolfe"` the steps aren't
+    guaranteed to satisfy the curvature condition; pairs without positive curvature
+    are skipped instead. Both converge to the same minimum of a convex objective, but
+    along different iterates.
+
+    Args:
+        fn: Maps the parameters of some rows, shape (b, P), and the indices of these
+            rows, shape (b,), to their losses, shape (b,). The loss of a row may only
+            depend on the parameters of that row.
+        x0: Initial parameters of shape (B, P).
+        max_iter: Maximum number of iterations.
+        history_size: Number of curvature pairs kept per row.
+        tolerance_grad: A row has converged once its gradient is at most this large
+            in every coordinate.
+        tolerance_change: A row has converged once its loss or parameters change by
+            less than this in an iteration.
+        max_backtracks: Maximum number of times the step of a row is halved in a line
+            search. A row whose loss can't be decreased has converged.
+
+    Returns:
+        The optimized parameters of shape (B, P), their losses of shape (B,), the
+        numbers of iterations of the rows, shape (B,), and whether each row converged,
+        shape (B,). A row that converged in its last allowed iteration took `max_iter`
+        iterations and still counts as converged.
+    """
+
+    def evaluate(x: Tensor, index: Tensor) -> tuple[Tensor, Tensor]:
+        with torch.enable_grad():
+            x = x.detach().requires_grad_()
+            loss = fn(x, index)
+            (grad,) = torch.autograd.grad(loss.sum(), x)
+        return loss.detach(), grad
+
+    out = x0.detach().clone()
+    # Original indices of the rows that are still optimized; the state below only
+    # holds these rows, and is compacted whenever some of them converge
+    rows = torch.arange(len(out), device=out.device)
+    x = out.clone()
+    loss, grad = evaluate(x, rows)
+    out_loss = loss.clone()
+    out_iterations = torch.zeros_like(rows)
+    out_converged = torch.zeros_like(rows, dtype=torch.bool)
+    # Curvature pairs, with rho = 0 for pairs that a row rejected
+    s_hist: list[Tensor] = []
+    y_hist: list[Tensor] = []
+    rho_hist: list[Tensor] = []
+    # Scale of the initial inverse Hessian; the first step is normalized by |g|_1
+    gamma = (1 / grad.abs().sum(-1)).clamp(max=1)
+    converged = grad.abs().amax(-1) <= tolerance_grad
+
+    for iteration in range(max_iter):
+        if converged.any():
+            out[rows[converged]] = x[converged]
+            out_loss[rows[converged]] = loss[converged]
+            out_iterations[rows[converged]] = iteration
+            out_converged[rows[converged]] = True
+            keep = ~converged
+            rows, x, loss, grad, gamma, converged = (
+                t[keep] for t in (rows, x, loss, grad, gamma, converged)
+            )
+            s_hist = [s[keep] for s in s_hist]
+            y_hist = [y[keep] for y in y_hist]
+            rho_hist = [rho[keep] for rho in rho_hist]
+            if not len(rows):
+                break
+
+        # Two-loop recursion for the search directions of all rows
+        q = -grad
+        alphas = []
+        for s, y, rho in zip(reversed(s_hist), reversed(y_hist), reversed(rho_hist)):
+            alpha = rho * torch.linalg.vecdot(s, q)
+            q = q.addcmul(alpha[:, None], y, value=-1)
+            alphas.append(alpha)
+        direction = gamma[:, None] * q
+        for s, y, rho, alpha in zip(s_hist, y_hist, rho_hist, reversed(alphas)):
+            beta = rho * torch.linalg.vecdot(y, direction)
+            direction = direction.addcmul((alpha - beta)[:, None], s)
+
+        # Fall back to steepest descent if a direction doesn't descend
+        slope = torch.linalg.vecdot(grad, direction)
+        ascent = slope >= 0
+        if ascent.any():
+            direction[ascent] = -grad[ascent] * gamma[ascent, None]
+            slope = torch.linalg.vecdot(grad, direction)
+
+        # Backtrack until the loss of every row decreases sufficiently
+        step = torch.ones_like(loss)
+        new_x, new_loss, new_grad = x.clone(), loss.clone(), grad.clone()
+        pending = torch.ones_like(loss, dtype=torch.bool)
+        for _ in range(max_backtracks):
+            index = pending.nonzero().squeeze(-1)
+            trial = x[index] + step[index, None] * direction[index]
+            trial_loss, trial_grad = evaluate(trial, rows[index])
+            accept = trial_loss <= loss[index] + 1e-4 * step[index] * slope[index]
+            accepted = index[accept]
+            new_x[accepted] = trial[accept]
+            new_loss[accepted] = trial_loss[accept]
+            new_grad[accepted] = trial_grad[accept]
+            pending[accepted] = False
+            if not pending.any():
+                break
+            step = torch.where(pending, step / 2, step)
+
+        s = new_x - x
+        y = new_grad - grad
+        sy = torch.linalg.vecdot(s, y)
+        valid = sy > 1e-10
+        s_hist.append(s)
+        y_hist.append(y)
+        rho_hist.append(torch.where(valid, 1 / sy.where(valid, 1.0), 0.0))
+        if len(s_hist) > history_size:
+            del s_hist[0], y_hist[0], rho_hist[0]
+        gamma = torch.where(valid, sy / (y * y).sum(-1).where(valid, 1.0), gamma)
+
+        converged = (
+            # Rows without any decrease along their direction are at their minimum
+            pending
+            | (new_grad.abs().amax(-1) <= tolerance_grad)
+            | ((new_loss - loss).abs() < tolerance_change)
+            | (s.abs().amax(-1) <= tolerance_change)
+        )
+        x, loss, grad = new_x, new_loss, new_grad
+
+    # Rows that converged in the last iteration or reached `max_iter`
+    out[rows] = x
+    out_loss[rows] = loss
+    out_iterations[rows] = max_iter
+    out_converged[rows] = converged
+    return out, out_loss, out_iterations, out_converged
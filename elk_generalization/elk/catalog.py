@@ -0,0 +1,474 @@
+"""SQLite catalog of the artifacts under a data root.
+
+Scripts that discover their inputs by globbing `<data_root>/<dataset>/<model>/<split>`
+and checking for individual files cost a metadata round-trip per file, which is slow on
+parallel filesystems, and can't tell a complete artifact from a half-written one. The
+catalog records every artifact once it has been completely written, along with its
+shape, dtype, size on disk and checksum, so discovery and skip checks become queries of
+a single file.
+
+The module only depends on torch and the standard library, so that it can also be
+imported as `elk_generalization.elk.catalog`.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from torch import Tensor
+
+CATALOG_FILE = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    dataset TEXT NOT NULL,
+    model TEXT NOT NULL,
+    split TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    layout TEXT NOT NULL,
+    storage TEXT,
+    dtype TEXT,
+    num_layers INTEGER,
+    num_examples INTEGER,
+    hidden_size INTEGER,
+    shape TEXT,
+    bytes INTEGER NOT NULL,
+    checksum TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (dataset, model, split, name)
+)
+"""
+
+
+@dataclass
+class Artifact:
+    """A catalogued artifact, e.g. the hiddens of a model on a split of a dataset."""
+
+    dataset: str
+    model: str
+    split: str
+    name: str
+    """Path of the artifact relative to the split directory, without the `.pt` suffix,
+    e.g. "hiddens" or "<training_identifier>/lr_log_odds"."""
+    path: Path
+    """Absolute path of the `.pt` file or the layer-major directory."""
+    layout: str
+    """"file" for a `.pt` file, "layers" for a layer-major directory."""
+    storage: str | None
+    """Storage format of per-layer activations, see `activation_store.STORAGE_FORMATS`."""
+    dtype: str | None
+    num_layers: int | None
+    """Number of layers, or None if the artifact isn't a list of per-layer tensors."""
+    num_examples: int | None
+    hidden_size: int | None
+    shape: tuple[int, ...] | None
+    """Shape of a single layer, or of the tensor for single-tensor artifacts."""
+    bytes: int
+    checksum: str | None
+    updated: float
+
+    def files(self) -> list[Path]:
+        return artifact_files(self.path)
+
+    def verify(self, checksum: bool = True) -> bool:
+        """Whether the artifact on disk still matches the catalog.
+
+        The byte size is always compared; the checksum, which reads the whole
+        artifact, only if `checksum` is set and one was recorded.
+        """
+        files = self.files()
+        if not files or sum(f.stat().st_size for f in files) != self.bytes:
+            return False
+        return (
+            not (checksum and self.checksum) or compute_checksum(files) == self.checksum
+        )
+
+
+def find_data_root(path: Path) -> Path | None:
+    """The closest directory above `path` with a catalog, i.e. the data root that
+    `path` belongs to, if any."""
+    for parent in Path(path).resolve().parents:
+        if (parent / CATALOG_FILE).exists():
+            return parent
+    return None
+
+
+def artifact_files(path: Path) -> list[Path]:
+    """Files making up an artifact: the `.pt` file, or the files of a layer-major
+    directory in a fixed order."""
+    path = Path(path)
+    if path.is_dir():
+        return sorted(f for f in path.iterdir() if f.is_file())
+    return [path] if path.exists() else []
+
+
+def compute_checksum(files: list[Path]) -> str:
+    """BLAKE2b digest of the contents of the files, in order."""
+    digest = hashlib.blake2b(digest_size=16)
+    for file in files:
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 24):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe(path: Path) -> dict:
+    """Layout, storage, dtype and shapes of the artifact at `path`.
+
+    Handles layer-major directories, `.pt` files with a list of per-layer tensors in
+    any storage format, single tensors (e.g. labels or log odds), and other objects,
+    for which only the layout is known.
+    """
+    path = Path(path)
+    out = dict(layout="file", storage=None, dtype=None, num_layers=None, shape=None)
+    if path.is_dir():
+        meta = json.loads((path / "meta.json").read_text())
+        out.update(
+            layout="layers",
+            storage=meta["storage"],
+            dtype=meta["dtype"],
+            num_layers=meta["num_layers"],
+            shape=tuple(meta["shape"]),
+        )
+        return out
+
+    state = torch.load(path, map_location="cpu", mmap=True)
+    if isinstance(state, Tensor):
+        out.update(
+            dtype=str(state.dtype).removeprefix("torch."), shape=tuple(state.shape)
+        )
+    elif isinstance(state, dict) and "storage" in state:
+        # Compressed by activation_store.quantize_activations
+        out.update(
+            storage=state["storage"],
+            dtype=state["dtype"],
+            num_layers=len(state["layers"]),
+            shape=tuple(state["layers"][0]["data"].shape),
+        )
+    elif (
+        isinstance(state, list) and state and all(isinstance(x, Tensor) for x in state)
+    ):
+        out.update(
+            storage="native",
+            dtype=str(state[0].dtype).removeprefix("torch."),
+            num_layers=len(state),
+            shape=tuple(state[0].shape),
+        )
+    return out
+
+
+class Catalog:
+    """Catalog of the artifacts under a data root, stored in `<root>/catalog.sqlite`.
+
+    Artifacts are keyed by dataset, model, split and name, and live at
+    `<root>/<dataset>/<model>/<split>/<name>(.pt)` unless recorded with another path.
+    Every update is a single transaction, so concurrent jobs never see a partially
+    updated catalog, and artifacts are only recorded once they have been completely
+    written, so a catalogued artifact is never half-written.
+
+    The extraction scripts record each split they save with `record_split`. Scripts
+    that only consume artifacts open the catalog with `readonly`, and only query it.
+    Artifacts saved before the catalog existed are added once with `index`, through
+    the command line of this module.
+
+    Args:
+        root: The data root.
+        timeout: Seconds to wait for other jobs that are updating the catalog.
+        readonly: Open an existing catalog for queries only. Nothing is created or
+            written under `root`.
+    """
+
+    def __init__(self, root: Path, timeout: float = 600, readonly: bool = False):
+        self.root = Path(root)
+        path = self.root / CATALOG_FILE
+        if readonly:
+            if not path.exists():
+                raise FileNotFoundError(
+                    f"No catalog at {path}. Extraction creates it when it saves a "
+                    f"split; record splits saved earlier with `python "
+                    f"elk_generalization/elk/catalog.py {self.root} --datasets ... "
+                    f"--models ...`"
+                )
+            uri = f"{path.resolve().as_uri()}?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, timeout=timeout)
+        else:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=timeout)
+            with self.db:
+                self.db.execute(SCHEMA)
+        self.db.row_factory = sqlite3.Row
+
+    def split_dir(self, dataset: str, model: str, split: str) -> Path:
+        return self.root / dataset / model / split
+
+    def split_keys(
+        self, split_dir: Path, model: str | None = None
+    ) -> tuple[str, str, str]:
+        """Dataset, model and split of a directory `<root>/<dataset>/<model>/<split>`.
+
+        Dataset and model names may contain slashes, e.g. hub ids, so the model is
+        `model` if the directory is saved under it, and the last directory above the
+        split otherwise.
+        """
+        split_dir = Path(split_dir).resolve()
+        assert split_dir.is_relative_to(self.root.resolve()), (
+            f"{split_dir} is not under the data root {self.root}"
+        )
+        *parts, split = split_dir.relative_to(self.root.resolve()).parts
+        model_parts = Path(model).parts if model else ()
+        num_model_parts = len(model_parts)
+        if not 0 < num_model_parts < len(parts) or (
+            tuple(parts[-num_model_parts:]) != model_parts
+        ):
+            num_model_parts = 1
+        assert len(parts) > num_model_parts, (
+            f"{split_dir} is not a <dataset>/<model>/<split> directory of {self.root}"
+        )
+        return (
+            "/".join(parts[:-num_model_parts]),
+            "/".join(parts[-num_model_parts:]),
+            split,
+        )
+
+    def _entry(
+        self,
+        dataset: str,
+        model: str,
+        split: str,
+        name: str,
+        path: Path,
+        checksum: bool,
+    ) -> dict:
+        files = artifact_files(path)
+        assert files, f"No artifact at {path}"
+        info = describe(path)
+        shape = info.pop("shape")
+        path = path.resolve()
+        if path.is_relative_to(self.root.resolve()):
+            path = path.relative_to(self.root.resolve())
+        return dict(
+            dataset=dataset,
+            model=model,
+            split=split,
+            name=name,
+            # Relative to the root, so that the data root can be moved
+            path=path.as_posix(),
+            num_examples=shape[0] if shape else None,
+            hidden_size=shape[-1] if shape and info["num_layers"] else None,
+            shape=json.dumps(shape) if shape is not None else None,
+            bytes=sum(f.stat().st_size for f in files),
+            checksum=compute_checksum(files) if checksum else None,
+            updated=time.time(),
+            **info,
+        )
+
+    def _insert(self, entries: list[dict]):
+        if not entries:
+            return
+        columns = list(entries[0])
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO artifacts ({', '.join(columns)}) "
+                f"VALUES ({', '.join(':' + c for c in columns)})",
+                entries,
+            )
+
+    def record(
+        self,
+        dataset: str,
+        model: str,
+        split: str,
+        name: str,
+        path: Path | None = None,
+        checksum: bool = True,
+    ) -> Artifact:
+        """Record a completely written artifact, replacing any earlier entry.
+
+        Args:
+            path: The `.pt` file or layer-major directory. Defaults to `<name>.pt` or
+                `<name>/` in the split directory, whichever exists.
+            checksum: Compute the checksum of the artifact, which reads it in full.
+        """
+        if path is None:
+            base = self.split_dir(dataset, model, split) / name
+            path = base if base.is_dir() else base.with_name(f"{base.name}.pt")
+        self._insert([self._entry(dataset, model, split, name, Path(path), checksum)])
+        artifact = self.get(dataset, model, split, name)
+        assert artifact is not None
+        return artifact
+
+    def record_split(
+        self,
+        dataset: str,
+        model: str,
+        split: str,
+        path: Path | None = None,
+        checksum: bool = True,
+    ) -> list[Artifact]:
+        """Record all artifacts in a split directory in a single transaction.
+
+        These are the `.pt` files and layer-major directories in the directory and its
+        subdirectories, e.g. the log odds of reporters. Hidden files and directories,
+        like the layer files of an unfinished extraction, are skipped.
+        """
+        root = Path(path) if path is not None else self.split_dir(dataset, model, split)
+        entries = []
+        for path in _find_artifacts(root):
+            name = _artifact_name(root, path)
+            entries.append(self._entry(dataset, model, split, name, path, checksum))
+        self._insert(entries)
+        return self.find(dataset, model, split)
+
+    def index(
+        self,
+        datasets: list[str],
+        models: list[str],
+        splits: list[str],
+        checksum: bool = False,
+        rescan: bool = False,
+    ) -> int:
+        """Record the artifacts of the existing split directories that have no entries
+        yet, e.g. ones saved before the catalog existed, and return their number.
+
+        This is a one-off backfill that walks the split directories, run from the
+        command line of this module. The scripts never call it, since extraction
+        records the splits it saves. Only new artifacts are described, and by default
+        only their size is recorded, so the artifacts aren't read in full. Splits with
+        an unfinished extraction are skipped.
+
+        Args:
+            checksum: Also compute the checksums of the new artifacts, which reads
+                them in full.
+            rescan: Also record the artifacts that are already catalogued again.
+        """
+        rows = self.db.execute("SELECT dataset, model, split, name FROM artifacts")
+        known = {tuple(row) for row in rows}
+        entries = []
+        for dataset in datasets:
+            for model in models:
+                for split in splits:
+                    split_dir = self.split_dir(dataset, model, split)
+                    # An extraction removes its manifest once all artifacts are saved
+                    if not split_dir.is_dir() or (split_dir / "progress.json").exists():
+                        continue
+                    for path in _find_artifacts(split_dir):
+                        name = _artifact_name(split_dir, path)
+                        if rescan or (dataset, model, split, name) not in known:
+                            entries.append(
+                                self._entry(dataset, model, split, name, path, checksum)
+                            )
+        self._insert(entries)
+        return len(entries)
+
+    def find(
+        self,
+        dataset: str | None = None,
+        model: str | None = None,
+        split: str | None = None,
+        name: str | None = None,
+    ) -> list[Artifact]:
+        """All artifacts matching the given fields, ordered by key."""
+        filters = dict(dataset=dataset, model=model, split=split, name=name)
+        filters = {k: v for k, v in filters.items() if v is not None}
+        where = " AND ".join(f"{k} = :{k}" for k in filters) or "1"
+        rows = self.db.execute(
+            f"SELECT * FROM artifacts WHERE {where} ORDER BY dataset, model, split, name",
+            filters,
+        )
+        return [self._artifact(row) for row in rows]
+
+    def get(self, dataset: str, model: str, split: str, name: str) -> Artifact | None:
+        found = self.find(dataset, model, split, name)
+        return found[0] if found else None
+
+    def exists(
+        self, dataset: str, model: str, split: str, name: str = "hiddens"
+    ) -> bool:
+        """Whether the artifact was completely written, without touching the filesystem."""
+        return self.get(dataset, model, split, name) is not None
+
+    def remove(self, dataset: str, model: str, split: str, name: str):
+        """Forget an artifact, e.g. one that failed `Artifact.verify`. The files are kept."""
+        with self.db:
+            self.db.execute(
+                "DELETE FROM artifacts WHERE dataset = ? AND model = ? AND split = ? AND name = ?",
+                (dataset, model, split, name),
+            )
+
+    def _artifact(self, row: sqlite3.Row) -> Artifact:
+        fields = dict(row)
+        fields["path"] = self.root / fields["path"]
+        if fields["shape"] is not None:
+            fields["shape"] = tuple(json.loads(fields["shape"]))
+        return Artifact(**fields)
+
+
+def _artifact_name(split_dir: Path, path: Path) -> str:
+    return path.relative_to(split_dir).with_suffix("").as_posix()
+
+
+def _find_artifacts(root: Path) -> list[Path]:
+    found = []
+    for path in sorted(root.iterdir()):
+        if path.name.startswith("."):
+            continue
+        if path.is_dir():
+            if (path / "meta.json").exists():
+                found.append(path)
+            else:
+                found += _find_artifacts(path)
+        elif path.suffix == ".pt":
+            found.append(path)
+    return found
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Catalog the existing artifacts under a data root, laid out as "
+        "<data-root>/<dataset>/<model>/<split>, or verify the catalogued ones."
+    )
+    parser.add_argument("data_root", type=Path)
+    parser.add_argument("--datasets", nargs="+", type=str, help="Datasets to catalog")
+    parser.add_argument("--models", nargs="+", type=str, help="Models to catalog")
+    parser.add_argument("--splits", nargs="+", type=str, default=["train", "test"])
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="Checksum the newly catalogued artifacts, and compare the checksums of "
+        "the catalogued ones with --verify. This reads the artifacts in full.",
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Also catalog the artifacts of catalogued splits again",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the size (and with --checksum the checksum) of all catalogued "
+        "artifacts and forget the ones that changed",
+    )
+    args = parser.parse_args()
+
+    catalog = Catalog(args.data_root)
+    if args.datasets and args.models:
+        count = catalog.index(
+            args.datasets, args.models, args.splits, args.checksum, args.rescan
+        )
+        print(f"Catalogued {count} artifacts in {args.data_root / CATALOG_FILE}")
+    if args.verify:
+        for artifact in catalog.find():
+            if not artifact.verify(args.checksum):
+                print(
+                    f"{artifact.path} changed since it was catalogued; removing its entry"
+                )
+                catalog.remove(
+                    artifact.dataset, artifact.model, artifact.split, artifact.name
+                )
@@ -3,19 +3,31 @@
 import math
 from copy import deepcopy
 from dataclasses import dataclass, field
-from typing import Literal, cast
+from typing import Literal, Sequence, cast
 
 import torch
 import torch.nn as nn
-from burns_norm import BurnsNorm
-from ccs_losses import LOSSES, parse_loss
 from concept_erasure import LeaceFitter
 from einops import repeat
 from torch import Tensor, optim
+from torch.func import vmap
 from typing_extensions import override
 
 from concept_erasure import LeaceFitter
 
+try:
+    from .batched_lbfgs import batched_lbfgs
+    from .burns_norm import BurnsNorm
+    from .ccs_losses import LOSSES, parse_loss
+except ImportError:  # run as a script from this directory
+    from batched_lbfgs import batched_lbfgs
+    from burns_norm import BurnsNorm
+    from ccs_losses import LOSSES, parse_loss
+
+# Default number of layers that `fit_reporters` fits at once. Their contrast pairs and
+# the L-BFGS histories of all of their tries are on the device together
+LAYERS_PER_BATCH = 8
+
 
 @dataclass
 class CcsConfig:
@@ -41,6 +53,9 @@ class CcsConfig:
     """The number of times to try training the reporter."""
     optimizer: Literal["adam", "lbfgs"] = "lbfgs"
     """The optimizer to use."""
+    parallel_tries: bool = False
+    """Whether to optimize all tries at once as a bank of probes, rather than one
+    after another. The PCA initialization then uses a single decomposition."""
     weight_decay: float = 0.01
     """The weight decay or L2 penalty to use."""
 
@@ -160,11 +175,11 @@ class CcsReporter(nn.Module):
         )
         return loss  # type: ignore
 
-    def fit(self, hiddens: Tensor) -> float:
-        """Fit the probe to the contrast pair `hiddens`.
+    def fit_norm(self, hiddens: Tensor) -> tuple[Tensor, Tensor]:
+        """Fit the normalization to the contrast pair `hiddens`.
 
         Returns:
-            best_loss: The best loss obtained.
+            x_neg, x_pos: The normalized negative and positive hiddens.
         """
         x_neg, x_pos = hiddens.unbind(2)
 
@@ -190,7 +205,21 @@ class CcsReporter(nn.Module):
             )
             self.norm = fitter.eraser
 
-        x_neg, x_pos = self.norm(x_neg), self.norm(x_pos)
+        return self.norm(x_neg), self.norm(x_pos)
+
+    def fit(self, hiddens: Tensor) -> float:
+        """Fit the probe to the contrast pair `hiddens`.
+
+        Returns:
+            best_loss: The best loss obtained.
+        """
+        x_neg, x_pos = self.fit_norm(hiddens)
+
+        if self.config.parallel_tries:
+            (best_loss,) = fit_tries([self], x_neg[None], x_pos[None]).tolist()
+            if not math.isfinite(best_loss):
+                raise RuntimeError("Got NaN/infinite loss during training")
+            return best_loss
 
         # Record the best acc, loss, and params found so far
         best_loss = torch.inf
@@ -306,6 +335,167 @@ class CcsReporter(nn.Module):
         opt.step(closure)
 
 
+def fit_tries(reporters: list[CcsReporter], x_neg: Tensor, x_pos: Tensor) -> Tensor:
+    """Fit all tries of the probes of several reporters at once, and keep the best.
+
+    The `num_tries` probes of every reporter are stacked into a bank and optimized
+    jointly, with a separate loss for every try, so that the tries of all reporters
+    take about as many steps as the slowest one. Each reporter keeps the try with the
+    lowest loss, like `CcsReporter.fit`.
+
+    Args:
+        reporters: Reporters with the same config, whose norms have been fit.
+        x_neg: Normalized negative hiddens of every reporter, shape (L, n, v, d).
+        x_pos: Normalized positive hiddens of every reporter, shape (L, n, v, d).
+
+    Returns:
+        The best loss of every reporter, shape (L,).
+    """
+    cfg = reporters[0].config
+    num_tries = cfg.num_tries
+    d = x_neg.shape[-1]
+
+    # Initialize the tries exactly like the tries of `CcsReporter.fit`, drawing from
+    # the random number generator in the same order
+    bank = []
+    for layer, reporter in enumerate(reporters):
+        if cfg.init == "pca":
+            diffs = torch.flatten(x_pos[layer] - x_neg[layer], 0, 1)
+        for i in range(num_tries):
+            reporter.reset_parameters()
+            if cfg.init == "pca":
+                _, __, V = torch.pca_lowrank(diffs, q=i + 1)
+                reporter.probe.weight.data = V[:, -1, None].T
+            bank.append(
+                torch.cat([param.data.flatten() for param in reporter.parameters()])
+            )
+    params = torch.stack(bank).to(x_neg.dtype)
+
+    loss_fn = vmap(reporters[0].loss)
+    # Hiddens of the reporters with tries left to optimize. Consecutive reporters are
+    # views, others are gathered once for every set of reporters
+    gathered = (None, x_neg, x_pos)
+
+    def losses(params: Tensor, index: Tensor, regularize: bool = True) -> Tensor:
+        nonlocal gathered
+        layers, tries = index // num_tries, index % num_tries
+        used = layers.unique()
+        start, stop = int(used[0]), int(used[-1]) + 1
+        if stop - start == len(used):
+            used_neg, used_pos = x_neg[start:stop], x_pos[start:stop]
+        else:
+            if gathered[0] is None or not torch.equal(gathered[0], used):
+                gathered = (used, x_neg[used], x_pos[used])
+            _, used_neg, used_pos = gathered
+
+        # Probes of all tries of the used reporters, zero for tries that are done
+        position = torch.searchsorted(used, layers)
+        probes = params.new_zeros(len(used), num_tries, params.shape[-1])
+        probes = probes.index_put((position, tries), params)
+        # Without a bias term the sum over the empty bias columns is zero
+        weight, bias = probes[..., :d], probes[..., d:].sum(-1, keepdim=True)
+
+        def logits(x: Tensor) -> Tensor:
+            # (U, tries, d) @ (U, d, n * v) -> (U, tries, n, v)
+            scores = torch.baddbmm(bias, weight, x.flatten(1, 2).mT)
+            return scores.unflatten(-1, x.shape[1:3])[position, tries]
+
+        loss = loss_fn(logits(used_neg), logits(used_pos))
+        if regularize:
+            # Like the L2 regularization of `train_loop_lbfgs`
+            loss = loss + cfg.weight_decay * params.square().sum(-1) / 2
+        return loss
+
+    everything = torch.arange(len(params), device=params.device)
+    if cfg.optimizer == "lbfgs":
+        eps = torch.finfo(x_neg.dtype).eps
+        params, _, _, _ = batched_lbfgs(
+            losses,
+            params,
+            max_iter=cfg.num_epochs,
+            tolerance_change=eps,
+            tolerance_grad=eps,
+        )
+        with torch.no_grad():
+            final = losses(params, everything, regularize=False)
+    elif cfg.optimizer == "adam":
+        # Adam updates every coordinate independently, so optimizing the sum of the
+        # losses of the tries is the same as optimizing them one after another
+        params = nn.Parameter(params)
+        optimizer = torch.optim.AdamW(
+            [params], lr=cfg.lr, weight_decay=cfg.weight_decay
+        )
+        final = torch.full([len(params)], torch.inf)
+        for _ in range(cfg.num_epochs):
+            optimizer.zero_grad()
+            final = losses(params, everything, regularize=False)
+            final.sum().backward()
+            optimizer.step()
+        params, final = params.detach(), final.detach()
+    else:
+        raise ValueError(f"Optimizer {cfg.optimizer} is not supported")
+
+    # Keep the try with the lowest finite loss of every reporter
+    final = final.nan_to_num(torch.inf).view(len(reporters), num_tries)
+    best_loss, best_try = final.min(-1)
+    params = params.view(len(reporters), num_tries, -1)
+    for layer, reporter in enumerate(reporters):
+        best = params[layer, best_try[layer]]
+        reporter.probe.weight.data = best[None, :d].to(reporter.probe.weight.dtype)
+        if reporter.probe.bias is not None:
+            reporter.probe.bias.data = best[d:].to(reporter.probe.bias.dtype)
+    return best_loss
+
+
+def fit_reporters(
+    cfg: CcsConfig,
+    hiddens: Sequence[Tensor],
+    *,
+    device: str | torch.device | None = None,
+    dtype: torch.dtype | None = None,
+    layers_per_batch: int | None = None,
+) -> list[CcsReporter]:
+    """Fit a reporter to the contrast pairs of every layer, e.g. of an `ActivationStore`.
+
+    The tries of the reporters of `layers_per_batch` layers, `LAYERS_PER_BATCH` by
+    default, are optimized at once with `fit_tries`. Raise it to fit more layers at
+    once when they fit in memory.
+
+    Args:
+        cfg: The reporter configuration, shared by all layers.
+        hiddens: Contrast pairs of every layer, each of shape (n, v, 2, d).
+        device: Device of the reporters, to which the layers are moved.
+        dtype: Dtype of the reporters and the hiddens.
+        layers_per_batch: Number of layers whose reporters are fit at once.
+
+    Returns:
+        The fitted reporter of every layer.
+    """
+    layers_per_batch = layers_per_batch or LAYERS_PER_BATCH
+    reporters = []
+    for start in range(0, len(hiddens), layers_per_batch):
+        batch, x_neg, x_pos = [], [], []
+        for layer in range(start, min(start + layers_per_batch, len(hiddens))):
+            hidden = hiddens[layer].to(device, dtype)
+            reporter = CcsReporter(
+                cfg,
+                hidden.shape[-1],
+                device=device,
+                dtype=dtype,
+                num_variants=hidden.shape[1],
+            )
+            neg, pos = reporter.fit_norm(hidden)
+            batch.append(reporter)
+            x_neg.append(neg)
+            x_pos.append(pos)
+
+        best_loss = fit_tries(batch, torch.stack(x_neg), torch.stack(x_pos))
+        if not best_loss.isfinite().all():
+            raise RuntimeError("Got NaN/infinite loss during training")
+        reporters.extend(batch)
+    return reporters
+
+
 def to_one_hot(labels: Tensor, n_classes: int) -> Tensor:
     """
     Convert a tensor of class labels to a one-hot representation.
@@ -1,6 +1,15 @@
 import torch
 from distutils.util import strtobool
 
+try:
+    from .activation_store import ActivationStore, LazyLayers, activations_exist
+    from .burns_norm import BurnsNorm
+    from .moment_store import MomentStore
+except ImportError:  # run as a script from this directory
+    from activation_store import ActivationStore, LazyLayers, activations_exist
+    from burns_norm import BurnsNorm
+    from moment_store import MomentStore
+
 # Helpers for align transfer experiments
 
 key_to_column = {
@@ -186,14 +195,17 @@ class SegmentConfig():
 def aggregate_segments(paths, label_cols, reporter, device, data_split, log_odds_split_descriptor=None):
     """Aggregates segments for transfer_align experiments"""
     out = {}
+    stores = []
     for i, path in enumerate(paths):
         path = path / data_split
-        hiddens_file = (
-            "ccs_hiddens.pt"
+        hiddens_name = (
+            "ccs_hiddens"
             if reporter in {"ccs", "crc", "lr-on-pair"}
-            else "hiddens.pt"
+            else "hiddens"
         )
-        train_hiddens = torch.load(path / hiddens_file)
+        # Memory-mapped; the layers are only read when they are used
+        train_hiddens = ActivationStore(path, hiddens_name)
+        stores.append(train_hiddens)
         train_n = train_hiddens[0].shape[0]
         d = train_hiddens[0].shape[-1]
         assert all(
@@ -206,20 +218,20 @@ def aggregate_segments(paths, label_cols, reporter, device, data_split, log_odds
             log_odds = torch.load(log_odds_path, map_location="cpu")
 
         if i==0:
-            out["hiddens"] = train_hiddens
             if log_odds_split_descriptor:
                 out["reporter_log_odds"] = log_odds
             for label_col in label_cols:
                 out[label_col] = torch.load(path / f"{label_col}.pt").to(device).int()
         else:
-            out["hiddens"] = [torch.cat([out["hiddens"][i], train_hiddens[i]]) for i in range(len(train_hiddens))]
             if log_odds_split_descriptor:
                 out["reporter_log_odds"] = torch.cat([out["reporter_log_odds"], log_odds], axis=1)
             for label_col in label_cols:
                 labels = torch.load(path / f"{label_col}.pt").to(device).int()
                 assert len(labels) == train_n, "Mismatched number of labels"
                 out[label_col] = torch.cat([out[label_col], labels])
-        
+
+    # Each layer is concatenated over all segments on the device when it is accessed
+    out["hiddens"] = LazyLayers(len(stores[0]), lambda k: torch.cat([store.layer(k, device) for store in stores]))
     return out
 
 # Helpers for diversify experiments
@@ -285,18 +297,13 @@ class DiversifyTrainingConfig():
 def aggregate_datasets(paths, label_cols, device, samples_per_dataset=None, contrast_norm=None, reporters_for_log_odds=[]):
     """Aggregates datasets for diversity experiments"""
     out = {}
+    # Memory-mapped hiddens and the indices of the selected rows of each dataset
+    parts, ccs_parts = [], []
     for i, path in enumerate(paths):
-        train_hiddens = torch.load(path / "hiddens.pt", map_location=torch.device(device))
-        ccs_hiddens_exist = (path / "ccs_hiddens.pt").exists()
+        train_hiddens = ActivationStore(path, "hiddens")
+        ccs_hiddens_exist = activations_exist(path, "ccs_hiddens")
         if ccs_hiddens_exist:
-            train_ccs_hiddens = torch.load(path / "ccs_hiddens.pt", map_location=torch.device(device))
-
-        # If a contrast_norm is specified, we normalize each dataset individually
-        if contrast_norm and ccs_hiddens_exist:
-            for layer in range(len(train_ccs_hiddens)):
-                # Unsqueeze+Squeeze because normalize_ccs_hiddens expects variants dimension
-                normalized_ccs_hiddens, _ = normalize_ccs_hiddens(train_ccs_hiddens[layer].unsqueeze(1), norm=contrast_norm)
-                train_ccs_hiddens[layer] = normalized_ccs_hiddens.squeeze(1)
+            train_ccs_hiddens = ActivationStore(path, "ccs_hiddens")
         train_n = train_hiddens[0].shape[0]
         d = train_hiddens[0].shape[-1]
         assert all(
@@ -310,9 +317,9 @@ def aggregate_datasets(paths, label_cols, device, samples_per_dataset=None, cont
             indices = torch.randperm(train_n)[:samples_per_dataset]
         else:
             indices = torch.arange(train_n)
-        train_hiddens = [h[indices] for h in train_hiddens]
+        parts.append((train_hiddens, indices))
         if ccs_hiddens_exist:
-            train_ccs_hiddens = [h[indices] for h in train_ccs_hiddens]
+            ccs_parts.append((train_ccs_hiddens, indices))
 
         # Extract log_odds for each reporter (only relevant for evaluation)
         log_odds = {}
@@ -323,29 +330,60 @@ def aggregate_datasets(paths, label_cols, device, samples_per_dataset=None, cont
         # Extract labels
         for label_col in label_cols:
             labels = torch.load(path / f"{label_col}.pt", map_location=torch.device(device))[indices].int()
-            assert len(labels) == train_hiddens[0].shape[0], "Mismatched number of labels"
+            assert len(labels) == len(indices), "Mismatched number of labels"
 
         # Concatenate data with data from previous datasets eval_paths
         if i==0:
-            out["hiddens"] = train_hiddens
-            if ccs_hiddens_exist:
-                out["ccs_hiddens"] = train_ccs_hiddens
             for reporter in reporters_for_log_odds:
                 out[f"{reporter}_log_odds"] = log_odds[reporter]
             for label_col in label_cols:
                 out[label_col] = labels
         else:
-            out["hiddens"] = [torch.cat([out["hiddens"][i], train_hiddens[i]]) for i in range(len(train_hiddens))]
-            if ccs_hiddens_exist:
-                out["ccs_hiddens"] = [torch.cat([out["ccs_hiddens"][i], train_ccs_hiddens[i]]) for i in range(len(train_ccs_hiddens))]
             for reporter in reporters_for_log_odds:
                 out[f"{reporter}_log_odds"] = torch.cat([out[f"{reporter}_log_odds"], log_odds[reporter]], axis=1)
             for label_col in label_cols:
                 out[label_col] = torch.cat([out[label_col], labels])
-        
+
+    # Each layer is gathered from all datasets and moved to the device when it is accessed
+    out["hiddens"] = LazyLayers(len(parts[0][0]), lambda k: aggregate_layer(parts, k, device))
+    if ccs_parts:
+        out["ccs_hiddens"] = LazyLayers(
+            len(ccs_parts[0][0]), lambda k: aggregate_layer(ccs_parts, k, device, contrast_norm)
+        )
     return out
 
 
+def aggregate_layer(parts, layer, device, contrast_norm=None):
+    """Concatenates the selected rows of a layer of several datasets on the device.
+
+    Args:
+        parts: List of (hiddens, indices) of each dataset.
+        layer: Index of the layer.
+        device: Device of the concatenated hiddens.
+        contrast_norm: If given, the ccs_hiddens of each dataset are normalized individually
+            before their rows are selected. The "leace" eraser of a dataset is fit to the
+            cached `ClassMoments` of the two sides of its contrast pairs (see moment_store.py),
+            one of the closed-form fits that the moment store serves, instead of to all of
+            its rows.
+    """
+    selected = []
+    for hiddens, indices in parts:
+        if contrast_norm == "leace":
+            # The eraser of each dataset is fit to the moments of the two sides of its contrast
+            # pairs, which are saved next to its ccs_hiddens, so only the selected rows are read
+            store = MomentStore(hiddens.path.parent, hiddens.path.name, "contrast", device)
+            rows = hiddens.layer(layer)[indices].to(device)
+            selected.append(store[layer].leace_eraser(dtype=rows.dtype)(rows))
+        elif contrast_norm:
+            # Unsqueeze+Squeeze because normalize_ccs_hiddens expects variants dimension
+            normalized_ccs_hiddens, _ = normalize_ccs_hiddens(hiddens.layer(layer, device).unsqueeze(1), norm=contrast_norm)
+            selected.append(normalized_ccs_hiddens.squeeze(1)[indices])
+        else:
+            # Only the selected rows are read from disk and moved to the device
+            selected.append(hiddens.layer(layer)[indices].to(device))
+    return torch.cat(selected)
+
+
 def normalize_ccs_hiddens(ccs_hiddens, norm):
     """Normalizes hidden states for both templates individually.
 
@@ -359,7 +397,6 @@ def normalize_ccs_hiddens(ccs_hiddens, norm):
     Returns:
         tensor, Module: The normalized ccs_hiddens with the original shape and the normalization module.
     """
-    from burns_norm import BurnsNorm
     from concept_erasure import LeaceFitter
     assert ccs_hiddens.dim() == 4, "Expecting ccs_hiddens to be a 4-dimensional tensor of shape (samples, v, 2, neurons)."
     assert ccs_hiddens.shape[2] == 2, "Expecting 2 templates on axis=1."
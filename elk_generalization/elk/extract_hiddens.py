@@ -2,21 +2,111 @@ from argparse import ArgumentParser, Namespace
 from pathlib import Path
 import json
 
-import torch
 from datasets import Dataset, load_dataset, load_from_disk
-from tqdm.auto import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from activation_store import extraction_complete
+from catalog import Catalog, find_data_root
+from extraction import (
+    ExtractionProgress,
+    ModelPrefetcher,
+    SharedPrefix,
+    expand_runs,
+    filter_difficulty,
+)
+from extraction_engine import (
+    ChoiceContrastHiddens,
+    ExtractionEngine,
+    LastTokenHiddens,
+    LMLogOdds,
+)
+from tokenization import pretokenize
 
-def encode_choice(text, tokenizer):
-    c_ids = tokenizer.encode(text, add_special_tokens=False)
 
-    # some tokenizers split off the leading whitespace character
-    if tokenizer.decode(c_ids[0]).strip() == "":
-        c_ids = c_ids[1:]
-        assert c_ids == tokenizer.encode(text.lstrip(), add_special_tokens=False)
-    assert len(c_ids) == 1, f"Choice should be one token: {text}"
-    return c_ids[0]
+def extract(args, model, tokenizer):
+    """Extract the hiddens of every split of a single dataset."""
+    views = [LastTokenHiddens(), ChoiceContrastHiddens()]
+    if not args.skip_lm_log_odds:
+        views.append(LMLogOdds())
+    engine = ExtractionEngine(
+        model,
+        tokenizer,
+        views,
+        args.layers,
+        args.batch_size,
+        args.max_tokens_per_batch,
+        storage=args.storage,
+        layout=args.layout,
+    )
+
+    assert len(args.max_examples) == len(args.splits)
+    for split, max_examples in zip(args.splits, args.max_examples):
+        root = args.save_path / split
+        root.mkdir(parents=True, exist_ok=True)
+        # skip if the results for this split already exist
+        if extraction_complete(root):
+            print(f"Skipping because the hiddens in '{root}' already exist")
+            continue
+
+        print(f"Processing '{split}' split...")
+
+        # A restarted job continues at the first unfinished shard of this split
+        progress = ExtractionProgress(root, args.shard_size, args.flush_every)
+        seed = progress.seed(args.seed)
+
+        if Path(args.dataset).exists():
+            print(f"Trying to load {args.dataset} from disk...")
+            dataset = load_from_disk(args.dataset)[split]
+        else:
+            print(f"Trying to load {args.dataset} from hub...")
+            dataset = load_dataset(args.dataset, split=split)
+        assert isinstance(dataset, Dataset)
+
+        shared_prefix = None
+        if args.prefix:
+            assert Path(args.prefix_path).exists(), f"Could not find file at {args.prefix_path}. Please specify valid json file with -prefix-path."
+
+            with open(Path(args.prefix_path), "r") as f:
+                prefixes = json.loads(f.read())
+
+            assert args.prefix in prefixes, f"No prefix with key {args.prefix} found in {args.prefix_path}."
+            prefix = prefixes[args.prefix]
+
+            def add_prefix(ex):
+                ex["statement"] = prefix + ex["statement"]
+                return ex
+            
+            dataset = dataset.map(add_prefix)
+
+        # Tokenize the whole split once per tokenizer; the token ids are cached on disk
+        dataset = pretokenize(
+            dataset, tokenizer, ["statement"], "choices", cache_dir=args.tokenization_cache
+        )
+        dataset = dataset.shuffle(seed=seed)
+
+        if args.character:
+            print(f"Filtering for character {args.character}")
+            dataset = dataset.filter(lambda example: example["character"] == args.character)
+
+        dataset = filter_difficulty(dataset, args.difficulty)
+
+        print(f"Size of dataset before selecting: {len(dataset)}")
+        dataset = dataset.select(range(max_examples))
+
+        if args.prefix:
+            print("First example including the prefix:")
+            print(dataset[0]["statement"])
+
+            # Run the prefix through the model once and reuse its KV cache
+            shared_prefix = SharedPrefix(model, tokenizer.encode(prefix))
+
+        # Default behavior is to save the labels of both characters
+        label_cols = args.label_cols or ["label", "alice_label", "bob_label"]
+        engine.run(dataset, root, progress, label_cols, shared_prefix, f"'{split}' split")
+        # Record the split in the catalog of the data root it was saved under, if any
+        catalog_root = args.catalog or find_data_root(root)
+        if catalog_root is not None:
+            catalog = Catalog(catalog_root)
+            catalog.record_split(*catalog.split_keys(root, args.model), root)
 
 
 if __name__ == "__main__":
@@ -32,11 +122,33 @@ if __name__ == "__main__":
             character = "Alice",
             difficulty = "easy",
             prefix_path = Path(".\elk_generalization\elk\prefixes.json"),
-            prefix = "few_shot_persona_first_v1"
+            prefix = "few_shot_persona_first_v1",
+            batch_size = 8,
+            max_tokens_per_batch = None,
+            shard_size = 1024,
+            flush_every = 1,
+            seed = None,
+            layers = None,
+            device = None,
+            dtype = "auto",
+            quantize = False,
+            storage = "native",
+            layout = "file",
+            num_threads = None,
+            tokenization_cache = None,
+            skip_lm_log_odds = False,
+            runs = None,
+            catalog = None,
             )
     else:
         parser = ArgumentParser(description="Process and save model hidden states.")
         parser.add_argument("--model", type=str, help="Name of the Hugging Face model")
+        parser.add_argument(
+            "--runs",
+            type=Path,
+            help="JSON lines file with one object of arguments per run (e.g. model, dataset, save_path, splits), "
+            "overriding the command line arguments. Runs with the same model share a single copy of it.",
+        )
         parser.add_argument("--dataset", type=str, help="Name of the Hugging Face dataset")
         parser.add_argument("--save-path", type=Path, help="Path to save the hidden states")
         parser.add_argument('--prefix-path', type=str, help="Path to json file containing prefixes.")
@@ -72,150 +184,113 @@ if __name__ == "__main__":
             help="Columns of the dataset that contain labels we wish to save",
             default=[],
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="Number of statements per left-padded forward pass. Defaults to 1 on GPUs "
+            "and to a size that fits the CPU cache on the CPU.",
+        )
+        parser.add_argument(
+            "--max-tokens-per-batch",
+            type=int,
+            help="Build batches of statements of similar length with at most this many (padded) "
+            "tokens instead of fixed-size batches. --batch-size then caps the number of statements.",
+        )
+        parser.add_argument(
+            "--shard-size",
+            type=int,
+            default=1024,
+            help="Number of examples per checkpointed shard",
+        )
+        parser.add_argument(
+            "--flush-every",
+            type=int,
+            default=1,
+            help="Number of finished shards after which progress is flushed to disk",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Seed for shuffling the dataset. Random by default, but always reused when resuming.",
+        )
+        parser.add_argument(
+            "--layers",
+            type=int,
+            nargs="+",
+            help="Only extract these layers. All layers are extracted by default.",
+        )
+        parser.add_argument(
+            "--tokenization-cache",
+            type=Path,
+            help="Directory in which tokenized datasets are cached. Defaults to a subdirectory of the datasets cache.",
+        )
+        parser.add_argument(
+            "--device",
+            type=str,
+            help="Device to run the model on, e.g. 'cuda:1' or 'cpu'. Defaults to the current CUDA device if available.",
+        )
+        parser.add_argument(
+            "--dtype",
+            type=str,
+            default="auto",
+            choices=["auto", "float32", "bfloat16", "float16"],
+            help="Model dtype. 'auto' uses the checkpoint dtype on GPUs and bf16 or float32 on the CPU.",
+        )
+        parser.add_argument(
+            "--storage",
+            type=str,
+            default="native",
+            choices=["native", "float16", "bfloat16", "int8"],
+            help="Storage format of the hidden states. 'native' saves them in the model dtype; 'int8' uses a "
+            "per-channel scale and zero point. Load them with activation_store.load_activations.",
+        )
+        parser.add_argument(
+            "--layout",
+            type=str,
+            default="file",
+            choices=["file", "layers"],
+            help="'file' saves all layers of an artifact in a single .pt file; 'layers' saves a directory with "
+            "one file per layer, so single layers can be loaded with activation_store.ActivationStore.",
+        )
+        parser.add_argument(
+            "--quantize",
+            action="store_true",
+            help="Dynamically quantize the linear layers to int8 (CPU only)",
+        )
+        parser.add_argument(
+            "--num-threads",
+            type=int,
+            help="Number of CPU threads. Defaults to the number of cores.",
+        )
+        parser.add_argument(
+            "--catalog",
+            type=Path,
+            help="Data root in whose catalog the saved splits are recorded, under the dataset and model of the path of "
+            "--save-path relative to it. Defaults to the closest directory above --save-path with a catalog.",
+        )
+        parser.add_argument(
+            "--skip-lm-log-odds",
+            action="store_true",
+            help="Don't save lm_log_odds.pt, so the forward pass can stop after the highest of --layers",
+        )
         args = parser.parse_args()
 
-    # check if all the results already exist
-    if all((args.save_path / split / "hiddens.pt").exists() for split in args.splits):
-        print(f"Hiddens already exist at {args.save_path}")
-        exit()
-
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model,
-        device_map={"": torch.cuda.current_device()},
-        torch_dtype="auto",
-    )
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
-
-    assert len(args.max_examples) == len(args.splits)
-    for split, max_examples in zip(args.splits, args.max_examples):
-        root = args.save_path / split
-        root.mkdir(parents=True, exist_ok=True)
-        # skip if the results for this split already exist
-        if (root / "hiddens.pt").exists():
-            print(f"Skipping because '{root / 'hiddens.pt'}' already exists")
-            continue
-
-        print(f"Processing '{split}' split...")
-
-        if Path(args.dataset).exists():
-            print(f"Trying to load {args.dataset} from disk...")
-            dataset = load_from_disk(args.dataset)[split].shuffle()
+    # Extract all runs with the same model using a single copy of the model
+    runs = []
+    for run in expand_runs(args, args.runs):
+        # check if all the results already exist
+        if all(extraction_complete(run.save_path / split) for split in run.splits):
+            print(f"Hiddens already exist at {run.save_path}")
         else:
-            print(f"Trying to load {args.dataset} from hub...")
-            dataset = load_dataset(args.dataset, split=split).shuffle()
-        assert isinstance(dataset, Dataset)
-
-        if args.character:
-            print(f"Filtering for character {args.character}")
-            dataset = dataset.filter(lambda example: example["character"] == args.character)
-
-        # Filter for difficulty (corresponds to number of digits in the shorter of the two summands)
-        # An easy example is defined as one in which the shorter of the two summands is two digits or shorter. 
-        if args.difficulty == "easy":
-            print(f"Filtering for difficulty {args.difficulty}")
-            dataset = dataset.filter(lambda example: example["difficulty"] <= 2)
-            
-        # Similarly, a hard example has a shorter summand of at least four digits.
-        if args.difficulty == "hard":
-            print(f"Filtering for difficulty {args.difficulty}")
-            dataset = dataset.filter(lambda example: example["difficulty"] > 4)
-
-        print(f"Size of dataset before selecting: {len(dataset)}")
-        dataset = dataset.select(range(max_examples))
-
-        if args.prefix:
-            assert Path(args.prefix_path).exists(), f"Could not find file at {args.prefix_path}. Please specify valid json file with -prefix-path."
+            runs.append(run)
 
-            with open(Path(args.prefix_path), "r") as f:
-                prefixes = json.loads(f.read())
+    models = list(dict.fromkeys(run.model for run in runs))
+    prefetcher = ModelPrefetcher(models, args.device, args.dtype, args.quantize, args.num_threads)
+    for model_name, model, tokenizer in prefetcher:
+        for run in runs:
+            if run.model == model_name:
+                print(f"Extracting {run.dataset} with {model_name} to {run.save_path}")
+                extract(run, model, tokenizer)
+        # Release the model before the next one is moved to the device
+        del model
 
-            assert args.prefix in prefixes, f"No prefix with key {args.prefix} found in {args.prefix_path}."
-            prefix = prefixes[args.prefix]
-
-            def add_prefix(ex):
-                ex["statement"] = prefix + ex["statement"]
-                return ex
-            
-            dataset = dataset.map(add_prefix)
-            print("First example including the prefix:")
-            print(dataset[0]["statement"])
-
-        buffers = [
-            torch.full(
-                [len(dataset), model.config.hidden_size],
-                torch.nan,
-                device=model.device,
-                dtype=model.dtype,
-            )
-            for _ in range(model.config.num_hidden_layers)
-        ]
-        ccs_buffers = [
-            torch.full(
-                [len(dataset), 2, model.config.hidden_size],
-                torch.nan,
-                device=model.device,
-                dtype=model.dtype,
-            )
-            for _ in range(model.config.num_hidden_layers)
-        ]
-        log_odds = torch.full(
-            [len(dataset)], torch.nan, device=model.device, dtype=model.dtype
-        )
-
-        for i, record in tqdm(enumerate(dataset), total=len(dataset)):
-            assert isinstance(record, dict)
-
-            prompt = tokenizer.encode(record["statement"])
-            choice_toks = [
-                encode_choice(record["choices"][0], tokenizer),
-                encode_choice(record["choices"][1], tokenizer),
-            ]
-
-            with torch.inference_mode():
-                outputs = model(
-                    torch.as_tensor([prompt], device=model.device),
-                    output_hidden_states=True,
-                    use_cache=True,
-                )
-
-                # FOR CCS: Gather hidden states for each of the two choices
-                ccs_outputs = [
-                    model(
-                        torch.as_tensor([[choice]], device=model.device),
-                        output_hidden_states=True,
-                        past_key_values=outputs.past_key_values,
-                    ).hidden_states[1:]
-                    for choice in choice_toks
-                ]
-                for j, (state1, state2) in enumerate(zip(*ccs_outputs)):
-                    ccs_buffers[j][i, 0] = state1.squeeze()
-                    ccs_buffers[j][i, 1] = state2.squeeze()
-
-                logit1, logit2 = outputs.logits[0, -1, choice_toks]
-                log_odds[i] = logit2 - logit1
-
-                # Extract hidden states of the last token in each layer
-                for j, state in enumerate(outputs.hidden_states[1:]):
-                    buffers[j][i] = state[0, -1, :]
-
-        # Sanity check
-        assert all(buffer.isfinite().all() for buffer in buffers)
-        assert all(buffer.isfinite().all() for buffer in ccs_buffers)
-        assert log_odds.isfinite().all()
-
-        # Save results to disk for later
-        if args.label_cols:
-            for label_col in args.label_cols:
-                labels = torch.as_tensor(dataset[label_col], dtype=torch.int32)
-                torch.save(labels, root / f"{label_col}s.pt")
-        else:
-            # Default behavior
-            labels = torch.as_tensor(dataset["label"], dtype=torch.int32)
-            alice_labels = torch.as_tensor(dataset["alice_label"], dtype=torch.int32)
-            bob_labels = torch.as_tensor(dataset["bob_label"], dtype=torch.int32)
-            torch.save(labels, root / "labels.pt")
-            torch.save(alice_labels, root / "alice_labels.pt")
-            torch.save(bob_labels, root / "bob_labels.pt")
-        torch.save(buffers, root / "hiddens.pt")
-        torch.save(ccs_buffers, root / "ccs_hiddens.pt")
-        torch.save(log_odds, root / "lm_log_odds.pt")
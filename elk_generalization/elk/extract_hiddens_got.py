@@ -2,21 +2,13 @@ from argparse import ArgumentParser, Namespace
 from pathlib import Path
 import json
 
-import torch
 from datasets import Dataset, load_dataset, load_from_disk
-from tqdm.auto import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoTokenizer
 
-
-def encode_choice(text, tokenizer):
-    c_ids = tokenizer.encode(text, add_special_tokens=False)
-
-    # some tokenizers split off the leading whitespace character
-    if tokenizer.decode(c_ids[0]).strip() == "":
-        c_ids = c_ids[1:]
-        assert c_ids == tokenizer.encode(text.lstrip(), add_special_tokens=False)
-    assert len(c_ids) == 1, f"Choice should be one token: {text}"
-    return c_ids[0]
+from catalog import Catalog
+from extraction import ExtractionProgress, load_model
+from extraction_engine import ExtractionEngine, LastTokenHiddens, NegatedContrastHiddens
+from tokenization import pretokenize
 
 
 if __name__ == "__main__":
@@ -33,6 +25,20 @@ if __name__ == "__main__":
             extract_ccs = True,
             filter_cols = [],
             filter_values = [],
+            batch_size = 8,
+            max_tokens_per_batch = None,
+            shard_size = 1024,
+            flush_every = 1,
+            seed = None,
+            layers = None,
+            share_prefix = False,
+            device = None,
+            dtype = "auto",
+            quantize = False,
+            storage = "native",
+            layout = "file",
+            num_threads = None,
+            tokenization_cache = None,
             )
     else:
         parser = ArgumentParser(description="Process and save model hidden states.")
@@ -75,28 +81,128 @@ if __name__ == "__main__":
         parser.add_argument("--extract-ccs", action="store_true")
         parser.add_argument("--shuffle", action="store_true")
         parser.add_argument("--prevent-skip", action="store_true")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="Number of statements per left-padded forward pass. Defaults to 1 on GPUs "
+            "and to a size that fits the CPU cache on the CPU.",
+        )
+        parser.add_argument(
+            "--max-tokens-per-batch",
+            type=int,
+            help="Build batches of statements of similar length with at most this many (padded) "
+            "tokens instead of fixed-size batches. --batch-size then caps the number of statements.",
+        )
+        parser.add_argument(
+            "--shard-size",
+            type=int,
+            default=1024,
+            help="Number of examples per checkpointed shard",
+        )
+        parser.add_argument(
+            "--flush-every",
+            type=int,
+            default=1,
+            help="Number of finished shards after which progress is flushed to disk",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Seed for --shuffle. Random by default, but always reused when resuming.",
+        )
+        parser.add_argument(
+            "--layers",
+            type=int,
+            nargs="+",
+            help="Only extract these layers. All layers are extracted by default.",
+        )
+        parser.add_argument(
+            "--share-prefix",
+            action="store_true",
+            help="With --extract-ccs, run the common token prefix of each statement and its negation only once",
+        )
+        parser.add_argument(
+            "--tokenization-cache",
+            type=Path,
+            help="Directory in which tokenized datasets are cached. Defaults to a subdirectory of the datasets cache.",
+        )
+        parser.add_argument(
+            "--device",
+            type=str,
+            help="Device to run the model on, e.g. 'cuda:1' or 'cpu'. Defaults to the current CUDA device if available.",
+        )
+        parser.add_argument(
+            "--dtype",
+            type=str,
+            default="auto",
+            choices=["auto", "float32", "bfloat16", "float16"],
+            help="Model dtype. 'auto' uses the checkpoint dtype on GPUs and bf16 or float32 on the CPU.",
+        )
+        parser.add_argument(
+            "--storage",
+            type=str,
+            default="native",
+            choices=["native", "float16", "bfloat16", "int8"],
+            help="Storage format of the hidden states. 'native' saves them in the model dtype; 'int8' uses a "
+            "per-channel scale and zero point. Load them with activation_store.load_activations.",
+        )
+        parser.add_argument(
+            "--layout",
+            type=str,
+            default="file",
+            choices=["file", "layers"],
+            help="'file' saves all layers of an artifact in a single .pt file; 'layers' saves a directory with "
+            "one file per layer, so single layers can be loaded with activation_store.ActivationStore.",
+        )
+        parser.add_argument(
+            "--quantize",
+            action="store_true",
+            help="Dynamically quantize the linear layers to int8 (CPU only)",
+        )
+        parser.add_argument(
+            "--num-threads",
+            type=int,
+            help="Number of CPU threads. Defaults to the number of cores.",
+        )
         args = parser.parse_args()
 
     print(args)
     for model_name in args.models:
         print(f"Starting extraction for {model_name}")
         model = None
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map={"": torch.cuda.current_device()},
-            torch_dtype="auto",
-        )
+        model = load_model(model_name, args.device, args.dtype, args.quantize, args.num_threads)
         tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Extract hidden states of the last token in each layer for the non-negated statement for which the label is accurate
+        views = [LastTokenHiddens()]
+        if args.extract_ccs:
+            # and for negated statement for which the label is wrong
+            views.append(NegatedContrastHiddens())
+        engine = ExtractionEngine(
+            model,
+            tokenizer,
+            views,
+            args.layers,
+            args.batch_size,
+            args.max_tokens_per_batch,
+            share_prefix=args.share_prefix,
+            storage=args.storage,
+            layout=args.layout,
+        )
 
+        # Catalog of the hiddens under data_dir, which is updated once a split is saved
+        catalog = Catalog(args.data_dir)
         for dataset_name in args.datasets:
             print(f"Starting {model_name=} on {dataset_name=}...")
             dataset_path = Path(args.data_dir) / dataset_name
-
+            if not dataset_path.exists():
+                raise FileNotFoundError(
+                    f"No dataset saved with `save_to_disk` at {dataset_path}"
+                )
 
             for split, max_examples in zip(args.splits, args.max_examples):
                 root = Path(args.data_dir) / dataset_name / model_name / split
                 # check if all the results already exist
-                if not args.prevent_skip and (root / "hiddens.pt").exists():
+                if not args.prevent_skip and catalog.exists(dataset_name, model_name, split, "hiddens"):
                     print(f"Hiddens already exist at {root}. Skipping.")
                     continue
                 
@@ -105,92 +211,20 @@ if __name__ == "__main__":
                 root.mkdir(parents=True, exist_ok=True)
 
                 print(f"Processing '{split}' split...")
-                if Path(dataset_path).exists():
-                    print(f"Trying to load {dataset_path} from disk...")
-                    dataset = load_from_disk(dataset_path)[split]
-                    if args.shuffle:
-                        dataset = dataset.shuffle()
+                # A restarted job continues at the first unfinished shard of this split
+                progress = ExtractionProgress(root, args.shard_size, args.flush_every)
+                print(f"Trying to load {dataset_path} from disk...")
+                dataset = load_from_disk(dataset_path)[split]
+                # Tokenize the whole split once per tokenizer; the token ids are cached on disk
+                text_columns = ["statement", "neg_statement"] if args.extract_ccs else ["statement"]
+                dataset = pretokenize(dataset, tokenizer, text_columns, cache_dir=args.tokenization_cache)
+                if args.shuffle:
+                    dataset = dataset.shuffle(seed=progress.seed(args.seed))
 
                 assert isinstance(dataset, Dataset)
 
                 dataset = dataset.select(range(min(max_examples, len(dataset))))
-
-                buffers = [
-                    torch.full(
-                        [len(dataset), model.config.hidden_size],
-                        torch.nan,
-                        device=model.device,
-                        dtype=model.dtype,
-                    )
-                    for _ in range(model.config.num_hidden_layers)
-                ]
-                if args.extract_ccs:
-                    neg_buffers = [
-                        torch.full(
-                            [len(dataset), model.config.hidden_size],
-                            torch.nan,
-                            device=model.device,
-                            dtype=model.dtype,
-                        )
-                        for _ in range(model.config.num_hidden_layers)
-                    ]
-                    ccs_buffers = [
-                        torch.full(
-                            [len(dataset), 2, model.config.hidden_size],
-                            torch.nan,
-                            device=model.device,
-                            dtype=model.dtype,
-                        )
-                        for _ in range(model.config.num_hidden_layers)
-                    ]
-
-                for i, record in tqdm(enumerate(dataset), total=len(dataset), mininterval=10):
-                    assert isinstance(record, dict)
-
-                    prompt = tokenizer.encode(record["statement"])
-                    if i == 0:
-                        print(f"First statement of {dataset_name}: {record['statement']=}, {record['label']=}")
-
-                    with torch.inference_mode():
-                        outputs = model(
-                            torch.as_tensor([prompt], device=model.device),
-                            output_hidden_states=True,
-                            use_cache=True,
-                        )
-
-                        # Extract hidden states of the last token in each layer for the non-negated statement for which the label is accurate
-                        for j, state in enumerate(outputs.hidden_states[1:]):
-                            buffers[j][i] = state[0, -1, :]
-
-                        if args.extract_ccs:
-                            neg_prompt = tokenizer.encode(record["neg_statement"])
-                            neg_outputs = model(
-                                torch.as_tensor([neg_prompt], device=model.device),
-                                output_hidden_states=True,
-                                use_cache=True,
-                            )
-                            ccs_outputs = [outputs.hidden_states[1:], neg_outputs.hidden_states[1:]]
-
-                            for j, (state1, state2) in enumerate(zip(*ccs_outputs)):
-                                # Store hiddens for only prompt and last token
-                                ccs_buffers[j][i, 0] = state1[0][-1] 
-                                ccs_buffers[j][i, 1] = state2[0][-1]
-
-                            # and for negated statement for which the label is wrong
-                            for j, state in enumerate(neg_outputs.hidden_states[1:]):
-                                neg_buffers[j][i] = state[0, -1, :]
-
-                # Sanity check
-                assert all(buffer.isfinite().all() for buffer in buffers)
-
-
-                # Save results to disk for later
-                for label_col in args.label_cols:
-                    labels = torch.as_tensor(dataset[label_col], dtype=torch.int32)
-                    torch.save(labels, root / f"{label_col}s.pt")
-                torch.save(buffers, root / "hiddens.pt")
-                if args.extract_ccs:
-                    torch.save(neg_buffers, root / "neg_hiddens.pt")
-                    torch.save(ccs_buffers, root / "ccs_hiddens.pt")
-                    assert all(buffer.isfinite().all() for buffer in ccs_buffers)
+                print(f"First statement of {dataset_name}: {dataset[0]['statement']=}, {dataset[0]['label']=}")
+                engine.run(dataset, root, progress, args.label_cols, desc=f"'{split}' split")
+                catalog.record_split(dataset_name, model_name, split)
                 print(f"Finished storing hiddens for {model_name=} on {dataset_name=}.")
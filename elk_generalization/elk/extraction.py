@@ -0,0 +1,818 @@
+"""Helpers for running batched forward passes during hidden state extraction."""
+
+import copy
+import gc
+import json
+import os
+import random
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import torch
+from huggingface_hub import snapshot_download
+from torch import Tensor, nn
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    PretrainedConfig,
+    PreTrainedModel,
+)
+
+
+def batch_ranges(n: int, batch_size: int, start: int = 0) -> list[range]:
+    """Split `range(start, n)` into consecutive chunks of at most `batch_size` indices."""
+    assert batch_size > 0, "batch_size must be positive"
+    return [range(i, min(i + batch_size, n)) for i in range(start, n, batch_size)]
+
+
+def plan_batches(
+    lengths: list[int],
+    batch_size: int | None = None,
+    max_tokens: int | None = None,
+) -> list[list[int]]:
+    """Group examples into batches, optionally bucketed by length under a token budget.
+
+    Without a token budget, consecutive examples are grouped into batches of
+    `batch_size`. With `max_tokens`, the examples are sorted by length and greedily
+    packed so that each padded batch (number of examples times the longest prompt)
+    holds at most `max_tokens` tokens, which keeps the padding to a minimum.
+    `batch_size` then only caps the number of examples per batch. The longest
+    examples come first, so running out of memory shows up right away. Examples
+    longer than the budget get a batch of their own.
+
+    Args:
+        lengths: Number of tokens of each example.
+        batch_size: Number of examples per batch.
+        max_tokens: Maximum number of (padded) tokens per batch.
+
+    Returns:
+        For each batch, the indices into `lengths` of its examples.
+    """
+    if max_tokens is None:
+        assert batch_size, "Either batch_size or max_tokens must be given"
+        return [list(batch) for batch in batch_ranges(len(lengths), batch_size)]
+
+    batches, batch = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        # The first example of a batch is its longest
+        full = batch_size is not None and len(batch) >= batch_size
+        if batch and (full or (len(batch) + 1) * lengths[batch[0]] > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class ExtractionProgress:
+    """Progress manifest for resumable, sharded extraction of a single split.
+
+    The examples of a split are divided into shards of `shard_size` consecutive
+    examples. Finished shards are recorded in `<root>/progress.json` together with the
+    seed used to shuffle the dataset, so that a restarted job sees the examples in the
+    same order and can continue at the first unfinished shard. The manifest is only
+    written after the activation writers have been flushed, so every shard it lists
+    is guaranteed to be on disk. Once all shards are done, the artifacts merged from
+    the shards are recorded as well, and the manifest is removed after the last one,
+    so a split is complete only if its artifacts exist and the manifest doesn't.
+
+    Args:
+        root: Directory of the split in which the outputs are saved.
+        shard_size: Number of examples per shard.
+        flush_every: Number of finished shards after which the writers and the
+            manifest are flushed to disk.
+    """
+
+    def __init__(self, root: Path, shard_size: int, flush_every: int = 1):
+        assert shard_size > 0, "shard_size must be positive"
+        self.path = Path(root) / "progress.json"
+        self.flush_every = flush_every
+        self.resumed = self.path.exists()
+        if self.resumed:
+            self.state = json.loads(self.path.read_text())
+        else:
+            self.state = {"shard_size": shard_size, "done": [], "merged": []}
+        self._unflushed = 0
+
+    def seed(self, seed: int | None = None) -> int:
+        """Seed for shuffling the dataset. On resume, the seed of the first run wins."""
+        if "seed" not in self.state:
+            self.state["seed"] = seed if seed is not None else random.randrange(2**32)
+        elif seed is not None and seed != self.state["seed"]:
+            print(
+                f"Ignoring seed {seed}; resuming with seed {self.state['seed']} "
+                f"from {self.path}"
+            )
+        return self.state["seed"]
+
+    def start(self, num_examples: int):
+        """Register the number of examples. Must match the interrupted run, if any."""
+        if self.resumed:
+            assert self.state["num_examples"] == num_examples, (
+                f"Cannot resume from {self.path}: it covers "
+                f"{self.state['num_examples']} examples, but there are {num_examples}"
+            )
+            print(
+                f"Resuming from {self.path}: "
+                f"{len(self.state['done'])}/{len(self.shards())} shards done"
+            )
+        self.state["num_examples"] = num_examples
+
+    def shards(self) -> list[range]:
+        return batch_ranges(self.state["num_examples"], self.state["shard_size"])
+
+    def pending_shards(self) -> list[range]:
+        done = {tuple(shard) for shard in self.state["done"]}
+        return [
+            shard for shard in self.shards() if (shard.start, shard.stop) not in done
+        ]
+
+    def mark_done(self, shard: range, writers: list):
+        """Record a finished shard, flushing every `flush_every` shards."""
+        self.state["done"].append([shard.start, shard.stop])
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush(writers)
+
+    def flush(self, writers: list):
+        """Write the activations through to disk, then atomically update the manifest."""
+        for writer in writers:
+            writer.close()
+        self._write()
+        self._unflushed = 0
+
+    def merged(self, name: str) -> bool:
+        """Whether the artifact `name` was merged from the shards and saved."""
+        return name in self.state.get("merged", [])
+
+    def mark_merged(self, name: str):
+        """Record that the artifact `name` was saved, so a restarted job keeps it."""
+        self.state.setdefault("merged", []).append(name)
+        self._write()
+
+    def _write(self):
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.state))
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Delete the manifest once the outputs have been merged."""
+        self.path.unlink(missing_ok=True)
+
+
+def filter_difficulty(dataset, difficulty: str = "any"):
+    """Keep the "easy" or "hard" examples of an arithmetic dataset, or all of them.
+
+    The difficulty of an example is the number of digits of the shorter of its two
+    operands. Easy examples have at most two digits, hard ones more than four.
+    """
+    if difficulty == "easy":
+        print(f"Filtering for difficulty {difficulty}")
+        dataset = dataset.filter(lambda example: example["difficulty"] <= 2)
+    elif difficulty == "hard":
+        print(f"Filtering for difficulty {difficulty}")
+        dataset = dataset.filter(lambda example: example["difficulty"] > 4)
+    return dataset
+
+
+def resolve_device(device: str | None = None) -> torch.device:
+    """The requested device, or the current CUDA device if available, else the CPU."""
+    if device is not None:
+        return torch.device(device)
+    if torch.cuda.is_available():
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def configure_cpu_threads(num_threads: int | None = None):
+    """Use one intra-op thread per core and a single inter-op thread.
+
+    A causal LM forward is a chain of dependent ops, so inter-op parallelism only
+    oversubscribes the cores that the matmuls already use.
+    """
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+
+
+def cpu_supports_bf16() -> bool:
+    """Whether oneDNN has fast bf16 kernels on this CPU (AVX512-BF16 or AMX)."""
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _model_dtype(
+    device: torch.device, dtype: str, quantize: bool, num_threads: int | None
+) -> str | torch.dtype:
+    """The dtype to load a model in on `device`, configuring the CPU threads if needed."""
+    if device.type == "cpu":
+        configure_cpu_threads(num_threads)
+        if quantize:
+            dtype = "float32"
+        elif dtype == "auto":
+            dtype = "bfloat16" if cpu_supports_bf16() else "float32"
+    else:
+        assert not quantize, "int8 dynamic quantization is only supported on the CPU"
+    return dtype if dtype == "auto" else getattr(torch, dtype)
+
+
+def _prepare_model(
+    model: PreTrainedModel, name: str, quantize: bool
+) -> PreTrainedModel:
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+    print(
+        f"Loaded {name} on {model.device} in {model.dtype}"
+        f"{' (int8)' if quantize else ''}"
+    )
+    return model
+
+
+def load_model(
+    name: str,
+    device: str | None = None,
+    dtype: str = "auto",
+    quantize: bool = False,
+    num_threads: int | None = None,
+) -> PreTrainedModel:
+    """Load a causal LM for extraction on a GPU or the CPU.
+
+    On the CPU, "auto" picks bf16 if the CPU has native bf16 support and float32
+    otherwise, since the fp16 weights of most checkpoints are very slow on CPUs.
+    With `quantize`, the linear layers are dynamically quantized to int8, which is
+    usually the fastest option on CPUs without bf16 support. The residual stream is
+    still float32, so the extracted hiddens are float32 as well.
+
+    Args:
+        name: Name or path of the Hugging Face model.
+        device: Device to run on. Defaults to the current CUDA device if available.
+        dtype: "auto" or the name of a torch dtype, e.g. "float32" or "bfloat16".
+        quantize: Dynamically quantize the linear layers to int8 (CPU only).
+        num_threads: Number of CPU threads. Defaults to the number of cores.
+    """
+    device = resolve_device(device)
+    model = AutoModelForCausalLM.from_pretrained(
+        name,
+        device_map={"": device},
+        torch_dtype=_model_dtype(device, dtype, quantize, num_threads),
+    )
+    return _prepare_model(model, name, quantize)
+
+
+class ModelPrefetcher:
+    """Iterates over models and their tokenizers, prefetching the next model.
+
+    While a model is in use, the checkpoint files of the next one are downloaded if
+    needed and read once on a background thread, so that they are in the page cache
+    by the time it is loaded. The models themselves are only built on the calling
+    thread: `from_pretrained` swaps the process-wide default dtype while it builds a
+    model, which would change the dtype of tensors created concurrently on other
+    threads. Callers should drop their reference to a model before asking for the
+    next one, so that two models never have to fit on the device at once.
+
+    Args:
+        names: Names or paths of the Hugging Face models.
+        device, dtype, quantize, num_threads: See `load_model`.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        device: str | None = None,
+        dtype: str = "auto",
+        quantize: bool = False,
+        num_threads: int | None = None,
+    ):
+        self.names = list(names)
+        self.device = resolve_device(device)
+        self.dtype = dtype
+        self.quantize = quantize
+        self.num_threads = num_threads
+
+    @staticmethod
+    def _prefetch(name: str, chunk_size: int = 1 << 26):
+        """Download the checkpoint of `name` if needed and read its weights."""
+        path = Path(name)
+        if not path.is_dir():
+            path = Path(
+                snapshot_download(name, allow_patterns=["*.json", "*.safetensors"])
+            )
+        for file in path.glob("*.safetensors"):
+            with open(file, "rb") as f:
+                while f.read(chunk_size):
+                    pass
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = None
+            for i, name in enumerate(self.names):
+                if pending is not None:
+                    pending.result()
+                    # Free the previous model before loading this one to the device
+                    gc.collect()
+                    if self.device.type == "cuda":
+                        torch.cuda.empty_cache()
+                model = load_model(
+                    name, self.device, self.dtype, self.quantize, self.num_threads
+                )
+
+                pending = None
+                if i + 1 < len(self.names):
+                    pending = pool.submit(self._prefetch, self.names[i + 1])
+
+                yield name, model, AutoTokenizer.from_pretrained(name)
+                model = None
+
+
+def expand_runs(args: Namespace, path: Path | None) -> list[Namespace]:
+    """Arguments of each extraction run in a JSON lines file.
+
+    Each line is an object with some of the command line arguments (with
+    underscores, e.g. `{"model": ..., "dataset": ..., "save_path": ...}`), which
+    override those given on the command line. Without a file, there is a single run
+    with the command line arguments.
+    """
+    if path is None:
+        return [args]
+
+    runs = []
+    for line in Path(path).read_text().splitlines():
+        if not line.strip():
+            continue
+        spec = json.loads(line)
+        unknown = set(spec) - set(vars(args))
+        assert not unknown, f"Unknown arguments in {path}: {unknown}"
+        run = Namespace(**{**vars(args), **spec})
+        run.save_path = Path(run.save_path)
+        runs.append(run)
+    return runs
+
+
+def default_batch_size(
+    model: PreTrainedModel, tokens_per_example: int = 64, cache_bytes: int = 2**21
+) -> int:
+    """Batch size used when none is given.
+
+    On GPUs this is 1, as before. On the CPU we pick the largest batch whose
+    activations of a single layer fit in a typical 2MB per-core L2 cache, so that
+    the weights are reused across examples without spilling the activations.
+    """
+    if model.device.type != "cpu":
+        return 1
+    row_bytes = model.config.hidden_size * tokens_per_example * model.dtype.itemsize
+    return max(1, min(64, cache_bytes // row_bytes))
+
+
+def estimate_model_bytes(config: PretrainedConfig) -> int:
+    """Rough size of the weights of a decoder-only transformer with this config.
+
+    Each block has about 12 d^2 parameters (4 d^2 in the attention and 8 d^2 in the
+    MLP), plus the embedding matrix, which counts twice if the unembedding is not
+    tied to it. This is only used to decide which models fit on a device together.
+    """
+    d = config.hidden_size
+    num_params = 12 * config.num_hidden_layers * d**2
+    num_params += config.vocab_size * d * (1 if config.tie_word_embeddings else 2)
+    dtype = getattr(config, "dtype", None) or config.torch_dtype or torch.float32
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    return num_params * dtype.itemsize
+
+
+class ThroughputMeter:
+    """Counts the tokens run through the model and reports tokens per second."""
+
+    def __init__(self):
+        self.num_tokens = 0
+        self.start = time.perf_counter()
+
+    def update(self, prompts: list[list[int]], tokens_per_prompt: int = 0):
+        """Count a batch of prompts, plus `tokens_per_prompt` extra tokens each (e.g.
+        the two choice tokens scored on top of the prompt cache)."""
+        self.num_tokens += sum(len(prompt) + tokens_per_prompt for prompt in prompts)
+
+    def tokens_per_second(self) -> float:
+        return self.num_tokens / max(time.perf_counter() - self.start, 1e-9)
+
+    def report(self, desc: str = ""):
+        print(
+            f"{desc}{self.num_tokens} tokens at "
+            f"{self.tokens_per_second():.1f} tokens/s"
+        )
+
+
+def left_pad(
+    sequences: list[list[int]], pad_token_id: int, device: str | torch.device
+) -> tuple[Tensor, Tensor]:
+    """Left-pad token id sequences to a common length.
+
+    Left padding keeps the last real token of every sequence at position -1, so the
+    hidden states we want can be read off with a simple slice.
+
+    Returns:
+        input_ids: Tensor of shape (B, T).
+        attention_mask: Tensor of shape (B, T), zero at padded positions.
+    """
+    max_len = max(len(seq) for seq in sequences)
+    input_ids = torch.full(
+        [len(sequences), max_len], pad_token_id, dtype=torch.long, device=device
+    )
+    attention_mask = torch.zeros(
+        [len(sequences), max_len], dtype=torch.long, device=device
+    )
+    for i, seq in enumerate(sequences):
+        if len(seq):
+            input_ids[i, -len(seq) :] = torch.as_tensor(seq, device=device)
+            attention_mask[i, -len(seq) :] = 1
+    return input_ids, attention_mask
+
+
+def position_ids_from_mask(attention_mask: Tensor) -> Tensor:
+    """Position ids that ignore padding, matching what an unpadded forward would use."""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.clamp(min=0)
+
+
+def pad_token_id(tokenizer) -> int:
+    """Token id used for padding. Its value is irrelevant since it is masked out."""
+    for token_id in (tokenizer.pad_token_id, tokenizer.eos_token_id):
+        if token_id is not None:
+            return token_id
+    return 0
+
+
+def expand_cache(past_key_values, repeats: int):
+    """Repeat every sequence in a KV cache `repeats` times along the batch dimension.
+
+    Sequence i of the input ends up at rows `i * repeats` to `(i + 1) * repeats - 1`.
+    `Cache` objects are expanded in-place and should not be reused for the original
+    batch afterwards. Legacy tuple caches are copied.
+    """
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(
+        tuple(t.repeat_interleave(repeats, dim=0) for t in layer)
+        for layer in past_key_values
+    )
+
+
+class SharedPrefix:
+    """KV cache of a prompt prefix shared by every example, e.g. a few-shot prefix.
+
+    The prefix is run through the model once. Each batch then only runs the suffixes
+    of its prompts on top of a copy of the cache, so the cost per example scales
+    with the suffix length. The prompts are still tokenized as a whole and split at
+    the prefix boundary, so the suffix tokens are exactly the ones the full prompt
+    would have. Prompts whose tokenization does not start with the prefix tokens
+    (e.g. because a token straddles the boundary) can't use the cache.
+
+    Args:
+        model: The causal language model.
+        prefix_ids: Token ids of the prefix, as produced by encoding the prefix on
+            its own.
+    """
+
+    @torch.inference_mode()
+    def __init__(self, model: PreTrainedModel, prefix_ids: list[int]):
+        assert len(prefix_ids), "The prefix must not be empty"
+        self.ids = list(prefix_ids)
+        self.cache = DynamicCache()
+        model(
+            torch.as_tensor([self.ids], device=model.device),
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def split(self, prompt: list[int]) -> list[int] | None:
+        """The suffix of a prompt, or None if the prompt can't use the prefix cache."""
+        n = len(self.ids)
+        if len(prompt) <= n or prompt[:n] != self.ids:
+            return None
+        return prompt[n:]
+
+    def expand(self, batch_size: int) -> DynamicCache:
+        """A copy of the prefix cache for a batch of `batch_size` suffixes."""
+        return expand_cache(copy.deepcopy(self.cache), batch_size)
+
+
+class StopForward(Exception):
+    """Raised by a capture hook to skip the layers above the highest requested one."""
+
+
+def decoder_blocks(model: PreTrainedModel) -> tuple[nn.ModuleList, nn.Module | None]:
+    """Find the decoder blocks of a causal LM and the norm applied after the last one."""
+    base = model.base_model
+    for container in (base, getattr(base, "decoder", None)):
+        for name in ("layers", "h"):
+            blocks = getattr(container, name, None)
+            if isinstance(blocks, nn.ModuleList):
+                norms = ("norm", "final_layer_norm", "ln_f")
+                norm = next(
+                    (getattr(container, n) for n in norms if hasattr(container, n)),
+                    None,
+                )
+                return blocks, norm
+    raise NotImplementedError(f"Cannot find decoder blocks of {type(model).__name__}")
+
+
+class LayerCapture:
+    """Captures the residual stream at the last position of selected layers.
+
+    Forward hooks on the requested decoder blocks copy only the last position, so the
+    model does not have to keep the hidden states of every position of every layer
+    alive as with `output_hidden_states=True`. Layer j is the output of block j, which
+    matches `hidden_states[j + 1]`. For the top layer transformers returns the output
+    of the final norm, so that is what we hook there.
+
+    If `stop_early` is set, the forward pass is aborted right after the highest
+    requested layer, which saves the compute of all layers above it. The model
+    outputs (logits, KV cache object) are then unavailable, but the KV cache passed
+    into the model is still filled for the layers that ran.
+
+    Args:
+        model: The causal language model.
+        layers: Indices of the layers to capture. All layers by default.
+        stop_early: Whether to skip the layers above the highest requested one.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        layers: list[int] | None = None,
+        stop_early: bool = False,
+    ):
+        self.model = model
+        blocks, norm = decoder_blocks(model)
+        self.layers = sorted(layers) if layers is not None else list(range(len(blocks)))
+        assert all(
+            0 <= j < len(blocks) for j in self.layers
+        ), f"Invalid layers: {layers}"
+
+        self.captured: dict[int, Tensor] = {}
+        self.handles = []
+        for j in self.layers:
+            is_top = j == len(blocks) - 1 and norm is not None
+            stop = stop_early and j == self.layers[-1]
+            module = norm if is_top else blocks[j]
+            hook = partial(self._hook, j, stop)
+            self.handles.append(module.register_forward_hook(hook))
+
+    def _hook(self, j: int, stop: bool, module, inputs, output):
+        hidden = output[0] if isinstance(output, tuple) else output
+        self.captured[j] = hidden[:, -1].clone()
+        if stop:
+            raise StopForward
+
+    def __call__(self, *args, **kwargs):
+        """Run the model and return its outputs (None if stopped early) and the
+        captured hidden states of shape (len(layers), B, d)."""
+        self.captured = {}
+        try:
+            outputs = self.model(*args, **kwargs)
+        except StopForward:
+            outputs = None
+        return outputs, torch.stack([self.captured[j] for j in self.layers])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+
+
+@torch.inference_mode()
+def contrast_pair_hiddens(
+    capture: LayerCapture,
+    past_key_values,
+    attention_mask: Tensor,
+    choices: Tensor,
+) -> Tensor:
+    """Score both choice tokens of every prompt in a single forward call.
+
+    The prompt cache is expanded to batch size 2B so that each choice token gets its
+    own copy of the prompt to attend to.
+
+    Args:
+        capture: Hooks capturing the requested layers of the model.
+        past_key_values: KV cache of the left-padded prompts.
+        attention_mask: Attention mask of the prompts, of shape (B, T).
+        choices: Token ids of the two choices for each prompt, of shape (B, 2).
+
+    Returns:
+        Hidden states of the choice tokens of shape (L, B, 2, d).
+    """
+    n = len(choices)
+    mask = attention_mask.repeat_interleave(2, dim=0)
+    positions = position_ids_from_mask(mask)[:, -1:] + 1
+    mask = torch.cat([mask, mask.new_ones(2 * n, 1)], dim=1)
+
+    _, hiddens = capture(
+        choices.reshape(2 * n, 1),
+        attention_mask=mask,
+        position_ids=positions,
+        past_key_values=expand_cache(past_key_values, 2),
+    )
+    return hiddens.unflatten(1, (n, 2))
+
+
+@torch.inference_mode()
+def forward_batch(
+    model: PreTrainedModel,
+    prompts: list[list[int]],
+    choice_toks: list[list[int]] | None,
+    pad_id: int,
+    layers: list[int] | None = None,
+    lm_log_odds: bool = True,
+    prefix: SharedPrefix | None = None,
+    ccs_hiddens: bool = True,
+) -> dict[str, Tensor]:
+    """Run a left-padded batch of prompts through the model.
+
+    Args:
+        model: The causal language model.
+        prompts: Token ids of each prompt.
+        choice_toks: For each prompt, the token ids of the two answer choices. If None,
+            no contrast hiddens or log odds are computed.
+        pad_id: Token id used for padding.
+        layers: Indices of the layers to extract, all layers by default. Unless LM
+            log odds are needed, the forward pass stops after the highest one.
+        lm_log_odds: Whether to compute the LM log odds of the two choices.
+        prefix: Cached prefix shared by all prompts. If given, `prompts` only contain
+            the suffixes that follow it (see `SharedPrefix.split`).
+        ccs_hiddens: Whether to compute the contrast hiddens of the two choices. If
+            not, `choice_toks` are only used for the log odds.
+
+    Returns:
+        Dictionary with "hiddens" of shape (L, B, d) containing the hidden states of
+        the last prompt token for each requested layer, and if `choice_toks` is given
+        also "ccs_hiddens" of shape (L, B, 2, d) if `ccs_hiddens` is set and
+        "log_odds" of shape (B,) if `lm_log_odds` is set.
+    """
+    input_ids, attention_mask = left_pad(prompts, pad_id, model.device)
+    if prefix is None:
+        position_ids = position_ids_from_mask(attention_mask)
+        # Only create a KV cache if we need it for the contrast pairs
+        cache = DynamicCache() if choice_toks is not None and ccs_hiddens else None
+    else:
+        # The padding ends up between the prefix and the suffixes, where it is masked
+        # out and skipped by the position ids just like left padding
+        prefix_mask = attention_mask.new_ones(len(prompts), len(prefix))
+        attention_mask = torch.cat([prefix_mask, attention_mask], dim=1)
+        position_ids = position_ids_from_mask(attention_mask)[:, len(prefix) :]
+        cache = prefix.expand(len(prompts))
+
+    need_logits = choice_toks is not None and lm_log_odds
+    with LayerCapture(model, layers, stop_early=not need_logits) as capture:
+        outputs, hiddens = capture(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=cache is not None,
+        )
+
+        # Hidden states of the last token in each layer
+        out = {"hiddens": hiddens}
+        if choice_toks is None:
+            return out
+
+        choices = torch.as_tensor(choice_toks, device=model.device)
+        if need_logits:
+            rows = torch.arange(len(prompts), device=model.device)
+            last_logits = outputs.logits[:, -1]
+            out["log_odds"] = (
+                last_logits[rows, choices[:, 1]] - last_logits[rows, choices[:, 0]]
+            )
+
+        # FOR CCS: Gather hidden states for each of the two choices
+        if ccs_hiddens:
+            out["ccs_hiddens"] = contrast_pair_hiddens(
+                capture, cache, attention_mask, choices
+            )
+    return out
+
+
+@torch.inference_mode()
+def lm_log_odds_batch(
+    model: PreTrainedModel,
+    prompts: list[list[int]],
+    choice_toks: list[list[int]],
+    pad_id: int,
+) -> Tensor:
+    """LM log odds of the second over the first choice token after each prompt.
+
+    Cheaper than `forward_batch` when only the log odds are needed, since neither
+    hidden states nor a KV cache for the contrast pairs are kept.
+
+    Returns:
+        Tensor of shape (B,) with logit(choice 1) - logit(choice 0).
+    """
+    input_ids, attention_mask = left_pad(prompts, pad_id, model.device)
+    outputs = model(
+        input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids_from_mask(attention_mask),
+        use_cache=False,
+    )
+    last_logits = outputs.logits[:, -1]
+    choices = torch.as_tensor(choice_toks, device=model.device)
+    rows = torch.arange(len(prompts), device=model.device)
+    return last_logits[rows, choices[:, 1]] - last_logits[rows, choices[:, 0]]
+
+
+def common_prefix_length(a: list[int], b: list[int]) -> int:
+    """Length of the longest common prefix of two token sequences, leaving at least
+    one token in each suffix so that both have a last position of their own."""
+    n = 0
+    for x, y in zip(a[: len(a) - 1], b[: len(b) - 1]):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+@torch.inference_mode()
+def forward_pair_batch(
+    model: PreTrainedModel,
+    prompts: list[list[int]],
+    pair_prompts: list[list[int]],
+    pad_id: int,
+    layers: list[int] | None = None,
+) -> tuple[Tensor, Tensor]:
+    """Last-token hidden states of pairs of prompts that share a token prefix.
+
+    Statements and their negations usually only differ in a few tokens near the end
+    ("The city of X is (not) in Y"). The longest common token prefix of each pair is
+    run once, its KV cache is branched in two, and the suffixes of both halves of all
+    pairs are run in a single batched call.
+
+    Args:
+        model: The causal language model.
+        prompts: Token ids of the first prompt of each pair.
+        pair_prompts: Token ids of the second prompt of each pair.
+        pad_id: Token id used for padding.
+        layers: Indices of the layers to extract, all layers by default. The forward
+            passes stop after the highest one.
+
+    Returns:
+        Hidden states of the last token of the first and of the second prompts, each
+        of shape (L, B, d).
+    """
+    lengths = [common_prefix_length(a, b) for a, b in zip(prompts, pair_prompts)]
+    if min(lengths) == 0:
+        # Rows without any shared token would have a fully masked prefix
+        return (
+            forward_batch(model, prompts, None, pad_id, layers)["hiddens"],
+            forward_batch(model, pair_prompts, None, pad_id, layers)["hiddens"],
+        )
+
+    n = len(prompts)
+    prefixes = [a[:k] for a, k in zip(prompts, lengths)]
+    suffixes = [
+        seq[k:] for a, b, k in zip(prompts, pair_prompts, lengths) for seq in (a, b)
+    ]
+    prefix_ids, prefix_mask = left_pad(prefixes, pad_id, model.device)
+    suffix_ids, suffix_mask = left_pad(suffixes, pad_id, model.device)
+
+    with LayerCapture(model, layers, stop_early=True) as capture:
+        cache = DynamicCache()
+        capture(
+            prefix_ids,
+            attention_mask=prefix_mask,
+            position_ids=position_ids_from_mask(prefix_mask),
+            past_key_values=cache,
+            use_cache=True,
+        )
+
+        # Rows 2i and 2i + 1 continue the prefix of pair i
+        attention_mask = torch.cat(
+            [prefix_mask.repeat_interleave(2, dim=0), suffix_mask], dim=1
+        )
+        position_ids = position_ids_from_mask(attention_mask)[:, prefix_ids.shape[1] :]
+        _, hiddens = capture(
+            suffix_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=expand_cache(cache, 2),
+            use_cache=True,
+        )
+    hiddens = hiddens.unflatten(1, (n, 2))
+    return hiddens[:, :, 0], hiddens[:, :, 1]
@@ -0,0 +1,371 @@
+"""Single-pass extraction of any combination of hidden-state views of a dataset."""
+
+from pathlib import Path
+
+import torch
+from activation_store import LAYOUTS, STORAGE_FORMATS, HiddenStateWriter, save_atomic
+from datasets import Dataset
+from extraction import (
+    ExtractionProgress,
+    SharedPrefix,
+    ThroughputMeter,
+    common_prefix_length,
+    default_batch_size,
+    forward_batch,
+    forward_pair_batch,
+    pad_token_id,
+    plan_batches,
+)
+from torch import Tensor
+from tqdm.auto import tqdm
+from transformers import PreTrainedModel
+
+
+class View:
+    """Something extracted from every batch and saved next to the hiddens.
+
+    A view declares which outputs of the forward pass it needs, opens the writers of
+    its artifacts for a split, and writes its slice of every batch to them. The engine
+    runs the forward passes for the union of the needs of all its views, so any
+    combination of views is computed in a single pass over the batches.
+
+    Outputs of a batch, as passed to `write`:
+        "hiddens": Last-token hidden states of the prompts, (L, B, d).
+        "ccs_hiddens": Hidden states of the two choice tokens, (L, B, 2, d). Only if a
+            view sets `needs_choice_hiddens`.
+        "log_odds": LM log odds of the second over the first choice, (B,). Only if a
+            view sets `needs_log_odds`.
+        "pair_hiddens": Last-token hidden states of the paired prompts, e.g. the
+            negated statements, (L, B, d). Only if a view sets `needs_pairs`.
+    """
+
+    # Names of the artifacts the view saves
+    artifacts: tuple[str, ...] = ()
+    needs_choice_hiddens = False
+    needs_log_odds = False
+    needs_pairs = False
+
+    def open(
+        self,
+        root: Path,
+        num_examples: int,
+        num_layers: int,
+        model: PreTrainedModel,
+        resume: bool,
+    ) -> list[HiddenStateWriter]:
+        """Open the writers of this view for a split and return them."""
+        raise NotImplementedError
+
+    def write(self, index: Tensor, outputs: dict[str, Tensor]):
+        raise NotImplementedError
+
+    def save(
+        self,
+        progress: ExtractionProgress,
+        storage: str = "native",
+        layout: str = "file",
+    ):
+        """Merge the written batches into the final artifacts, recording each one in
+        `progress`. Artifacts already merged by an interrupted run are kept."""
+        for writer in self.writers:
+            if progress.merged(writer.name):
+                writer.remove()
+                continue
+            self.save_artifact(writer, storage, layout)
+            progress.mark_merged(writer.name)
+
+    def save_artifact(self, writer: HiddenStateWriter, storage: str, layout: str):
+        writer.save(storage, layout)
+
+
+class LastTokenHiddens(View):
+    """Hidden states of the last prompt token, saved as hiddens.pt."""
+
+    artifacts = ("hiddens",)
+
+    def open(self, root, num_examples, num_layers, model, resume):
+        shape = (num_examples, model.config.hidden_size)
+        self.writer = HiddenStateWriter(
+            root, "hiddens", num_layers, shape, model.dtype, resume=resume
+        )
+        self.writers = [self.writer]
+        return self.writers
+
+    def write(self, index, outputs):
+        self.writer.write(index, outputs["hiddens"])
+
+
+class ChoiceContrastHiddens(View):
+    """Hidden states of the two answer choice tokens appended to the prompt, saved
+    as ccs_hiddens.pt."""
+
+    artifacts = ("ccs_hiddens",)
+    needs_choice_hiddens = True
+
+    def open(self, root, num_examples, num_layers, model, resume):
+        shape = (num_examples, 2, model.config.hidden_size)
+        self.writer = HiddenStateWriter(
+            root, "ccs_hiddens", num_layers, shape, model.dtype, resume=resume
+        )
+        self.writers = [self.writer]
+        return self.writers
+
+    def write(self, index, outputs):
+        self.writer.write(index, outputs["ccs_hiddens"])
+
+
+class NegatedContrastHiddens(View):
+    """Last-token hidden states of the paired (negated) statements, saved as
+    neg_hiddens.pt, and stacked with those of the statements as ccs_hiddens.pt."""
+
+    artifacts = ("neg_hiddens", "ccs_hiddens")
+    needs_pairs = True
+
+    def open(self, root, num_examples, num_layers, model, resume):
+        hidden_size = model.config.hidden_size
+        self.neg_writer = HiddenStateWriter(
+            root,
+            "neg_hiddens",
+            num_layers,
+            (num_examples, hidden_size),
+            model.dtype,
+            resume=resume,
+        )
+        self.ccs_writer = HiddenStateWriter(
+            root,
+            "ccs_hiddens",
+            num_layers,
+            (num_examples, 2, hidden_size),
+            model.dtype,
+            resume=resume,
+        )
+        self.writers = [self.neg_writer, self.ccs_writer]
+        return self.writers
+
+    def write(self, index, outputs):
+        self.neg_writer.write(index, outputs["pair_hiddens"])
+        self.ccs_writer.write(
+            index, torch.stack([outputs["hiddens"], outputs["pair_hiddens"]], dim=2)
+        )
+
+
+class LMLogOdds(View):
+    """LM log odds of the second over the first choice, saved as lm_log_odds.pt."""
+
+    artifacts = ("lm_log_odds",)
+    needs_log_odds = True
+
+    def open(self, root, num_examples, num_layers, model, resume):
+        self.root = root
+        self.writer = HiddenStateWriter(
+            root, "lm_log_odds", 1, (num_examples,), model.dtype, resume=resume
+        )
+        self.writers = [self.writer]
+        return self.writers
+
+    def write(self, index, outputs):
+        self.writer.write(index, outputs["log_odds"][None])
+
+    def save_artifact(self, writer, storage, layout):
+        # A single tensor rather than a list of layers, always stored natively
+        save_atomic(writer.load()[0], self.root / "lm_log_odds.pt")
+        writer.remove()
+
+
+class ExtractionEngine:
+    """Extracts a set of views from tokenized datasets with a loaded model.
+
+    Every batch goes through the model once (plus one forward for the paired
+    prompts, unless their common prefix is shared), and all views are written from
+    the outputs of that pass. Splits are processed in checkpointed shards, so an
+    interrupted extraction resumes at the first unfinished shard.
+
+    Args:
+        model: The causal language model.
+        tokenizer: Its tokenizer, used for the pad token.
+        views: The views to extract. Their artifact names must be distinct.
+        layers: Indices of the layers to extract, all layers by default.
+        batch_size: Number of prompts per batch. Defaults to `default_batch_size`,
+            or to no limit if `max_tokens_per_batch` is given.
+        max_tokens_per_batch: Build batches of prompts of similar length with at most
+            this many (padded) tokens instead of fixed-size batches.
+        prompt_column: Column with the token ids of the prompts.
+        choices_column: Column with the token ids of the two answer choices.
+        pair_column: Column with the token ids of the paired prompts.
+        share_prefix: Run the common token prefix of each prompt and its pair only
+            once. Only used if no view needs the answer choices.
+        storage: Storage format of the saved hidden states, one of
+            `STORAGE_FORMATS` (see `load_activations`).
+        layout: Layout of the saved hidden states, one of `LAYOUTS`. "layers" saves
+            a directory per artifact from which single layers can be loaded with
+            `ActivationStore`.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer,
+        views: list[View],
+        layers: list[int] | None = None,
+        batch_size: int | None = None,
+        max_tokens_per_batch: int | None = None,
+        prompt_column: str = "statement_ids",
+        choices_column: str = "choice_ids",
+        pair_column: str = "neg_statement_ids",
+        share_prefix: bool = False,
+        storage: str = "native",
+        layout: str = "file",
+    ):
+        names = [name for view in views for name in view.artifacts]
+        assert len(set(names)) == len(names), f"Views save the same artifact: {names}"
+        self.model = model
+        self.views = views
+        self.layers = (
+            sorted(set(layers))
+            if layers
+            else list(range(model.config.num_hidden_layers))
+        )
+        self.save_layers = bool(layers)
+        self.batch_size = batch_size or (
+            None if max_tokens_per_batch else default_batch_size(model)
+        )
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.prompt_column = prompt_column
+        self.choices_column = choices_column
+        self.pair_column = pair_column
+        self.pad_id = pad_token_id(tokenizer)
+
+        self.needs_choice_hiddens = any(view.needs_choice_hiddens for view in views)
+        self.needs_log_odds = any(view.needs_log_odds for view in views)
+        self.needs_choices = self.needs_choice_hiddens or self.needs_log_odds
+        self.needs_pairs = any(view.needs_pairs for view in views)
+        self.share_prefix = share_prefix and not self.needs_choices
+        assert storage in STORAGE_FORMATS, f"Unknown storage format: {storage}"
+        self.storage = storage
+        assert layout in LAYOUTS, f"Unknown layout: {layout}"
+        self.layout = layout
+
+    def run(
+        self,
+        dataset: Dataset,
+        root: Path,
+        progress: ExtractionProgress,
+        label_cols: list[str] | None = None,
+        prefix: SharedPrefix | None = None,
+        desc: str = "split",
+    ):
+        """Extract all views of a tokenized split and save them under `root`.
+
+        Args:
+            dataset: The split, with the token id columns of the engine.
+            root: Directory in which the artifacts are saved.
+            progress: Progress manifest of the split, before `start` is called.
+            label_cols: Columns saved as `<col>s.pt` int32 tensors.
+            prefix: Cached prefix shared by the prompts. Prompts that don't tokenize
+                to the prefix followed by a suffix are run in full.
+            desc: Description of the split in the progress messages.
+        """
+        assert prefix is None or not self.needs_pairs, "Pairs can't share a prefix"
+        progress.start(len(dataset))
+        # Views whose artifacts were all saved by an interrupted run are done
+        views = [
+            view
+            for view in self.views
+            if not all(progress.merged(name) for name in view.artifacts)
+        ]
+        writers = []
+        for view in views:
+            writers += view.open(
+                root, len(dataset), len(self.layers), self.model, progress.resumed
+            )
+
+        meter = ThroughputMeter()
+        for shard in tqdm(progress.pending_shards(), desc="Shards", mininterval=10):
+            records = dataset.select(shard)
+            prompts = records[self.prompt_column]
+            choice_toks = records[self.choices_column] if self.needs_choices else None
+            pairs = records[self.pair_column] if self.needs_pairs else None
+
+            # Only run the suffixes after the shared prefix, unless a prompt doesn't
+            # tokenize to the prefix tokens followed by a suffix
+            suffixes = [prefix.split(p) if prefix else None for p in prompts]
+            groups = {None: [], prefix: []}
+            for i, suffix in enumerate(suffixes):
+                groups[None if suffix is None else prefix].append(i)
+
+            for group_prefix, group in groups.items():
+                inputs = [
+                    prompts[i] if group_prefix is None else suffixes[i] for i in group
+                ]
+                lengths = [len(ids) for ids in inputs]
+                if pairs is not None:
+                    lengths = [max(n, len(pairs[i])) for n, i in zip(lengths, group)]
+
+                for batch in plan_batches(
+                    lengths, self.batch_size, self.max_tokens_per_batch
+                ):
+                    # Scatter the results back to the positions of the examples
+                    rows = [group[i] for i in batch]
+                    index = torch.tensor([shard.start + i for i in rows])
+                    outputs = self._forward(
+                        [inputs[i] for i in batch],
+                        [choice_toks[i] for i in rows] if choice_toks else None,
+                        [pairs[i] for i in rows] if pairs else None,
+                        group_prefix,
+                        meter,
+                    )
+                    for view in views:
+                        view.write(index, outputs)
+            progress.mark_done(shard, writers)
+        progress.flush(writers)
+        meter.report(f"Extracted {desc}: ")
+
+        # Save the labels first and the hiddens last, so that a split with hiddens
+        # and without a progress manifest is complete
+        for label_col in label_cols or []:
+            labels = torch.as_tensor(dataset[label_col], dtype=torch.int32)
+            save_atomic(labels, root / f"{label_col}s.pt")
+        if self.save_layers:
+            save_atomic(self.layers, root / "layers.pt")
+        # The writers check that every row was written and is finite
+        for view in sorted(views, key=lambda view: "hiddens" in view.artifacts):
+            view.save(progress, self.storage, self.layout)
+        progress.remove()
+
+    def _forward(
+        self,
+        prompts: list[list[int]],
+        choice_toks: list[list[int]] | None,
+        pairs: list[list[int]] | None,
+        prefix: SharedPrefix | None,
+        meter: ThroughputMeter,
+    ) -> dict[str, Tensor]:
+        """The outputs needed by the views for a single batch."""
+        if pairs is not None and self.share_prefix:
+            # Run the common prefix of each pair once and branch it for both prompts
+            hiddens, pair_hiddens = forward_pair_batch(
+                self.model, prompts, pairs, self.pad_id, self.layers
+            )
+            meter.update(
+                [p[common_prefix_length(p, q) :] + q for p, q in zip(prompts, pairs)]
+            )
+            return {"hiddens": hiddens, "pair_hiddens": pair_hiddens}
+
+        outputs = forward_batch(
+            self.model,
+            prompts,
+            choice_toks,
+            self.pad_id,
+            self.layers,
+            self.needs_log_odds,
+            prefix=prefix,
+            ccs_hiddens=self.needs_choice_hiddens,
+        )
+        # The two choice tokens are run on top of the prompt cache
+        meter.update(prompts, tokens_per_prompt=2 * self.needs_choice_hiddens)
+        if pairs is not None:
+            outputs["pair_hiddens"] = forward_batch(
+                self.model, pairs, None, self.pad_id, self.layers
+            )["hiddens"]
+            meter.update(pairs)
+        return outputs
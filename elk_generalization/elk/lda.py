@@ -1,8 +1,20 @@
+from typing import Sequence
+
 from concept_erasure.shrinkage import optimal_linear_shrinkage
 from torch import Tensor, nn
 import torch
 from sklearn.metrics import roc_auc_score
 
+try:
+    from .moment_store import ClassMoments
+except ImportError:  # run as a script from this directory
+    from moment_store import ClassMoments
+
+# Default number of layers that `fit_lda_reporters` fits at once. Their hiddens and
+# their (d, d) covariances, or (n, n) Gram matrices, are on the device together
+LAYERS_PER_BATCH = 8
+
+
 class LdaReporter(nn.Module):
     def __init__(self, in_features: int, device: torch.device, dtype: torch.dtype):
         super().__init__()
@@ -35,19 +47,16 @@ class LdaReporter(nn.Module):
         w = w / w.norm()
 
         self.linear.weight.data = w.mT.to(self.linear.weight.dtype)
-    
-    def fit(self, x: Tensor, y: Tensor):
-        x0, x1 = x[y == 0], x[y == 1]
-        mu0, mu1 = x0.mean(dim=0), x1.mean(dim=0)
 
-        # Within-class covariance
-        cov0 = x0.mT.cov()
-        cov1 = x1.mT.cov()
-
-        S = (len(x0) * cov0 + len(x1) * cov1) / len(x)
-        precision = torch.linalg.pinv(S)
-        w = precision @ (mu1 - mu0)
+    def fit(self, x: Tensor, y: Tensor):
+        w = shrunk_lda_weights(x[None], y)[0]
+        self.linear.weight.data = w[None].to(self.linear.weight.dtype)
 
+    def fit_from_moments(self, moments: ClassMoments):
+        """Fit like `fit` to the samples that `moments` summarize, without a pass over
+        them. The direction already has a positive AUROC on them in expectation, since
+        it has a positive inner product with mu1 - mu0."""
+        w = shrunk_lda_weight_from_moments(moments)
         self.linear.weight.data = w[None].to(self.linear.weight.dtype)
 
     @torch.no_grad()
@@ -56,3 +65,117 @@ class LdaReporter(nn.Module):
         auroc = roc_auc_score(labels.cpu().numpy(), self.forward(hiddens).cpu().numpy())
         if auroc < 0.5:
             self.scale.data = -self.scale.data
+
+
+def shrunk_lda_weights(x: Tensor, y: Tensor) -> Tensor:
+    """LDA directions S^-1 (mu1 - mu0) of a batch of layers, with the pooled
+    within-class covariance S shrunk towards a multiple of the identity.
+
+    The shrinkage is the optimal linear shrinkage of `optimal_linear_shrinkage`,
+    S = alpha * S_n + (1 - alpha) * tr(S_n) / d * I, whose coefficient only depends on
+    the trace and Frobenius norm of the sample covariance S_n. With n >= d samples, S
+    is solved with a Cholesky factorization. With n < d, S is never formed: the Woodbury
+    identity turns the solve into one with the (n, n) Gram matrix of the centered
+    samples, so the cost is O(n^2 d) instead of O(d^3). Solves run in float64.
+
+    Args:
+        x: Hiddens of shape (L, n, d).
+        y: Binary labels of shape (n,), shared by all layers.
+
+    Returns:
+        Directions of shape (L, d).
+    """
+    _, n, d = x.shape
+    y = y.to(x.device).bool()
+    mu0, mu1 = x[:, ~y].mean(dim=1), x[:, y].mean(dim=1)
+    centered = x - torch.where(y[None, :, None], mu1[:, None], mu0[:, None])
+    diff = (mu1 - mu0).double()
+
+    # Trace and squared Frobenius norm of S_n = X^T X / n, which equals those of the
+    # Gram matrix X X^T / n
+    if n < d:
+        gram = torch.bmm(centered, centered.mT).double() / n
+        cov = gram
+    else:
+        cov = torch.bmm(centered.mT, centered).double() / n
+    alpha, ridge = _shrinkage(cov, n, d)
+
+    if n < d:
+        # S^-1 v = (v - alpha X^T (ridge * I + alpha X X^T / n)^-1 X v / n) / ridge
+        eye = torch.eye(n, dtype=torch.float64, device=x.device)
+        inner = alpha[:, None, None] * gram + ridge[:, None, None] * eye
+        projected = torch.bmm(centered, diff.to(x.dtype)[..., None]).double() / n
+        solved = torch.cholesky_solve(projected, torch.linalg.cholesky(inner))
+        back = torch.bmm(centered.mT, solved.to(x.dtype)).squeeze(-1).double()
+        w = (diff - alpha[:, None] * back) / ridge[:, None]
+    else:
+        w = _solve_shrunk(cov, alpha, ridge, diff)
+    return w.to(x.dtype)
+
+
+def shrunk_lda_weight_from_moments(moments: ClassMoments) -> Tensor:
+    """The direction of `shrunk_lda_weights` of the samples summarized by binary
+    class moments, of shape (d,) in float64. Costs O(d^3) regardless of the number of
+    samples."""
+    cov = moments.within_covariance()[None]
+    d = cov.shape[-1]
+    alpha, ridge = _shrinkage(cov, moments.num_samples, d)
+    return _solve_shrunk(cov, alpha, ridge, moments.means[1:] - moments.means[:1])[0]
+
+
+def _shrinkage(cov: Tensor, n: float, d: int) -> tuple[Tensor, Tensor]:
+    """Coefficients alpha and ridge of the optimal linear shrinkage
+    alpha * S_n + ridge * I of sample covariances, from their trace and Frobenius norm.
+    These are the same for the (L, d, d) covariances S_n and the (L, n, n) Gram
+    matrices X X^T / n."""
+    trace = cov.diagonal(dim1=-2, dim2=-1).sum(-1)
+    alpha = 1 - (trace.square() / n) / (cov.square().sum((-2, -1)) - trace.square() / d)
+    alpha = alpha.nan_to_num(0.0).clamp(0, 1)
+    eps = torch.finfo(torch.float64).eps
+    ridge = ((1 - alpha) * trace / d).clamp_min(eps * trace / d + eps)
+    return alpha, ridge
+
+
+def _solve_shrunk(cov: Tensor, alpha: Tensor, ridge: Tensor, v: Tensor) -> Tensor:
+    """Solve (alpha * cov + ridge * I) w = v for covariances of shape (L, d, d)."""
+    eye = torch.eye(cov.shape[-1], dtype=torch.float64, device=cov.device)
+    shrunk = alpha[:, None, None] * cov + ridge[:, None, None] * eye
+    w = torch.cholesky_solve(v[..., None], torch.linalg.cholesky(shrunk))
+    return w.squeeze(-1)
+
+
+def fit_lda_reporters(
+    hiddens: Sequence[Tensor],
+    y: Tensor,
+    *,
+    device: str | torch.device | None = None,
+    dtype: torch.dtype | None = None,
+    layers_per_batch: int | None = None,
+) -> list[LdaReporter]:
+    """Fit an `LdaReporter` to the hiddens of every layer, e.g. of an `ActivationStore`.
+
+    The directions of `layers_per_batch` layers, `LAYERS_PER_BATCH` by default, are
+    computed at once with `shrunk_lda_weights`. Raise it to fit more layers at once
+    when they fit in memory.
+
+    Args:
+        hiddens: Hiddens of every layer, each of shape (n, d).
+        y: Binary labels of shape (n,).
+        device: Device of the reporters, to which the layers are moved.
+        dtype: Dtype of the reporters and the hiddens.
+        layers_per_batch: Number of layers whose reporters are fit at once.
+
+    Returns:
+        The fitted reporter of every layer.
+    """
+    layers_per_batch = layers_per_batch or LAYERS_PER_BATCH
+    reporters = []
+    for start in range(0, len(hiddens), layers_per_batch):
+        layers = range(start, min(start + layers_per_batch, len(hiddens)))
+        x = torch.stack([hiddens[layer].to(device, dtype) for layer in layers])
+        for w in shrunk_lda_weights(x, y):
+            reporter = LdaReporter(x.shape[-1], device=device, dtype=dtype)
+            reporter.linear.weight.data = w[None].to(reporter.linear.weight.dtype)
+            reporters.append(reporter)
+        del x
+    return reporters
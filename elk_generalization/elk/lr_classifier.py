@@ -1,8 +1,52 @@
+from dataclasses import dataclass
+from typing import Literal, Sequence
+
 import torch
 from torch import Tensor, nn
 from torch.nn.functional import binary_cross_entropy_with_logits as bce_with_logits
 from torch.nn.functional import cross_entropy
 
+try:
+    from .batched_lbfgs import batched_lbfgs
+except ImportError:  # run as a script from this directory
+    from batched_lbfgs import batched_lbfgs
+
+Solver = Literal["auto", "lbfgs", "newton", "dual"]
+# Largest input dimension for which "auto" factorizes the d x d Hessian
+MAX_NEWTON_DIM = 2048
+# Default number of layers that `BatchedClassifier.fit_layers` fits at once. Their
+# inputs, and with Newton's method their (D, D) Hessians, are on the device together
+LAYERS_PER_BATCH = 8
+
+
+@dataclass
+class FitDiagnostics:
+    """Convergence diagnostics of a fit, with shape () for a `Classifier` and (L,)
+    for a `BatchedClassifier`."""
+
+    solver: str
+    """The solver that was used."""
+    iterations: Tensor
+    """Number of iterations of the solver."""
+    converged: Tensor
+    """Whether the solver converged within its maximum number of iterations."""
+    loss: Tensor
+    """Final value of the loss function, without the L2 penalty."""
+    grad_norm: Tensor
+    """Largest absolute value of the gradient of the regularized loss at the end."""
+
+
+def choose_solver(num_samples: int, input_dim: int) -> str:
+    """The fastest solver for binary classification of this many samples and inputs.
+
+    The dual solver only factorizes the (N, N) Gram matrix, so it is used whenever
+    there are at most as many samples as inputs. Otherwise Newton's method is used
+    as long as the (D, D) Hessian is small, and L-BFGS beyond that.
+    """
+    if num_samples <= input_dim:
+        return "dual"
+    return "newton" if input_dim <= MAX_NEWTON_DIM else "lbfgs"
+
 
 class Classifier(nn.Module):
     """Linear classifier trained with supervised learning."""
@@ -33,8 +77,11 @@ class Classifier(nn.Module):
         *,
         l2_penalty: float = 0.001,
         max_iter: int = 10_000,
+        solver: Solver = "lbfgs",
     ) -> float:
-        """Fits the model to the input data using L-BFGS with L2 regularization.
+        """Fits the model to the input data with L2 regularization.
+
+        Convergence diagnostics of the fit are saved in `self.diagnostics`.
 
         Args:
             x: Input tensor of shape (N, D), where N is the number of samples and D is
@@ -43,17 +90,29 @@ class Classifier(nn.Module):
                 multiclass classification, where C is the number of classes.
             l2_penalty: L2 regularization strength.
             max_iter: Maximum number of iterations for the L-BFGS optimizer.
+            solver: "lbfgs", the default, uses L-BFGS with a strong Wolfe line
+                search. For binary classification, "newton" uses Newton's method with
+                a Cholesky factorization of the (D, D) Hessian, and "dual" uses
+                Newton's method in the space of the (N, N) Gram matrix, which is much
+                faster for N < D. "auto" chooses one with `choose_solver`.
 
         Returns:
             Final value of the loss function after optimization.
         """
+        num_classes = self.linear.out_features
+        if solver == "auto":
+            solver = "lbfgs" if num_classes > 1 else choose_solver(*x.shape)
+        if solver in ("newton", "dual"):
+            assert num_classes == 1, f"The {solver} solver only supports binary labels"
+            return self._fit_newton(x, y, l2_penalty, solver)
+        assert solver == "lbfgs", f"Unknown solver: {solver}"
+
         optimizer = torch.optim.LBFGS(
             self.parameters(),
             line_search_fn="strong_wolfe",
             max_iter=max_iter,
         )
 
-        num_classes = self.linear.out_features
         loss_fn = bce_with_logits if num_classes == 1 else cross_entropy
         loss = torch.inf
         y = y.to(
@@ -76,4 +135,377 @@ class Classifier(nn.Module):
             return float(reg_loss)
 
         optimizer.step(closure)
+
+        state = optimizer.state[self.linear.weight]
+        self.diagnostics = FitDiagnostics(
+            solver=solver,
+            iterations=torch.tensor(state["n_iter"]),
+            converged=torch.tensor(state["n_iter"] < max_iter),
+            loss=torch.tensor(float(loss)),
+            grad_norm=torch.stack(
+                [param.grad.abs().max() for param in self.parameters()]
+            ).max(),
+        )
         return float(loss)
+
+    @torch.no_grad()
+    def _fit_newton(self, x: Tensor, y: Tensor, l2_penalty: float, solver: str):
+        x, y = x[None], y[None].to(x.dtype)
+        weight, bias, iterations, converged = newton_logistic(
+            x, y, l2_penalty, dual=solver == "dual"
+        )
+        self.linear.weight.data = weight.to(self.linear.weight.dtype)
+        self.linear.bias.data = bias.to(self.linear.bias.dtype)
+
+        loss, grad_norm = logistic_loss_and_grad_norm(x, y, weight, bias, l2_penalty)
+        self.diagnostics = FitDiagnostics(
+            solver, iterations[0], converged[0], loss[0], grad_norm[0]
+        )
+        return float(loss[0])
+
+
+def batched_logits(weight: Tensor, bias: Tensor, x: Tensor) -> Tensor:
+    """Logits of shape (L, N) of inputs (L, N, D) under weights (L, D) and biases
+    (L,)."""
+    # As row vectors times x^T, which unlike x times column vectors runs (and
+    # backpropagates) at the speed of one matrix-vector product per layer
+    return torch.baddbmm(bias[:, None, None], weight[:, None, :], x.mT).squeeze(1)
+
+
+def logistic_loss_and_grad_norm(
+    x: Tensor, y: Tensor, weight: Tensor, bias: Tensor, l2_penalty: float
+) -> tuple[Tensor, Tensor]:
+    """Binary cross entropy of shape (L,) of `batched_logits`, and the largest
+    absolute value of the gradient of the regularized loss, shape (L,)."""
+    logits = batched_logits(weight, bias, x)
+    residuals = logits.sigmoid() - y
+    grad_weight = torch.bmm(residuals[:, None], x).squeeze(1) / x.shape[1]
+    grad_weight += 2 * l2_penalty * weight
+    grad_norm = torch.maximum(grad_weight.abs().amax(-1), residuals.mean(-1).abs())
+    return bce_with_logits(logits, y, reduction="none").mean(-1), grad_norm
+
+
+def newton_logistic(
+    x: Tensor,
+    y: Tensor,
+    l2_penalty: float,
+    *,
+    dual: bool = False,
+    max_iter: int = 100,
+) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+    """Fits L binary logistic regressions with damped Newton's method.
+
+    Minimizes the mean binary cross entropy plus `l2_penalty` times the squared norm
+    of the weights, without penalizing the bias, like `Classifier.fit`. The bias is
+    eliminated from the Newton system with its Schur complement, and the system is
+    solved in float64:
+
+    - The primal solver factorizes the (D, D) Hessian X^T S X / N + 2 * l2_penalty * I
+      of the weights with Cholesky.
+    - The dual solver writes the weights as X^T a, which holds from the zero
+      initialization on, and takes Newton steps of the coefficients a in the (N, N)
+      space of the Gram matrix X X^T. Apart from computing the Gram matrix, its cost
+      doesn't depend on D, so it is much faster for N < D.
+
+    A backtracking line search makes every step decrease the loss, and a problem has
+    converged once half its Newton decrement is below the machine epsilon.
+
+    Args:
+        x: Inputs of shape (L, N, D).
+        y: Binary targets of shape (L, N).
+        l2_penalty: L2 regularization strength.
+        dual: Whether to use the dual solver.
+        max_iter: Maximum number of Newton steps.
+
+    Returns:
+        Weights of shape (L, D), biases (L,), numbers of iterations (L,) and whether
+        each problem converged (L,).
+    """
+    num_layers, n, d = x.shape
+    ridge = 2 * l2_penalty
+    eps = torch.finfo(x.dtype).eps
+    if dual:
+        # The logits are K a + b for the Gram matrix K, and the penalty is a^T K a
+        features = torch.bmm(x, x.mT).double()
+        targets = y.double()
+        params = features.new_zeros(num_layers, n)
+    else:
+        features, targets = x, y
+        params = x.new_zeros(num_layers, d)
+    eye = torch.eye(params.shape[1], dtype=torch.float64, device=x.device)
+    bias = params.new_zeros(num_layers)
+    logits = batched_logits(params, bias, features)
+
+    def objective(logits: Tensor, params: Tensor, bias: Tensor) -> Tensor:
+        loss = bce_with_logits(logits, targets, reduction="none").mean(-1)
+        if dual:
+            return loss + l2_penalty * (params * (logits - bias[:, None])).sum(-1)
+        return loss + l2_penalty * params.square().sum(-1)
+
+    loss = objective(logits, params, bias)
+    iterations = torch.zeros(num_layers, dtype=torch.long, device=x.device)
+    converged = torch.zeros(num_layers, dtype=torch.bool, device=x.device)
+    for _ in range(max_iter):
+        probs = logits.sigmoid()
+        residuals = probs - targets
+        curvature = probs * (1 - probs)
+        grad_bias = residuals.mean(-1).double()
+        curvature_bias = curvature.mean(-1).double()
+        # The gradient of the weights and the Hessian block [[A, c], [c^T, h]] that
+        # couples them with the bias, in terms of the parameters
+        if dual:
+            grad = residuals / n + ridge * params
+            cross = curvature / n
+            hessian = curvature[:, :, None] * features / n + ridge * eye
+            # A^-1 X^T v = X^T (S K / N + ridge * I)^-1 v
+            solved = torch.linalg.solve(hessian, torch.stack([grad, cross], dim=-1))
+            # Inner products of weights X^T a and X^T b are a^T K b
+            mapped = torch.bmm(features, solved)
+        else:
+            grad = torch.bmm(residuals[:, None], x).squeeze(1) / n + ridge * params
+            cross = torch.bmm(curvature[:, None], x).squeeze(1) / n
+            hessian = torch.bmm(x.mT * curvature[:, None], x).double() / n
+            rhs = torch.stack([grad, cross], dim=-1).double()
+            solved = torch.cholesky_solve(rhs, _cholesky(hessian + ridge * eye))
+            mapped = solved
+        grad, cross = grad.double(), cross.double()
+
+        # Newton step of the bias and the parameters
+        schur = curvature_bias - (cross * mapped[..., 1]).sum(-1)
+        step_bias = (grad_bias - (cross * mapped[..., 0]).sum(-1)) / -schur.clamp_min(
+            1e-12
+        )
+        step_params = -solved[..., 0] - solved[..., 1] * step_bias[:, None]
+        mapped_step = -mapped[..., 0] - mapped[..., 1] * step_bias[:, None]
+        decrement = -((grad * mapped_step).sum(-1) + grad_bias * step_bias)
+
+        converged |= decrement / 2 <= eps
+        active = ~converged
+        if not active.any():
+            break
+        step_params = step_params.to(params.dtype) * active[:, None]
+        step_bias = step_bias.to(params.dtype) * active
+        decrement = decrement.to(params.dtype)
+        if dual:
+            step_logits = mapped_step * active[:, None] + step_bias[:, None]
+        else:
+            step_logits = batched_logits(step_params, step_bias, x)
+
+        # Backtrack until the loss of every active problem decreases sufficiently
+        step = torch.ones_like(loss)
+        pending = active.clone()
+        for _ in range(30):
+            new_logits = logits + step[:, None] * step_logits
+            new_params = params + step[:, None] * step_params
+            new_bias = bias + step * step_bias
+            new_loss = objective(new_logits, new_params, new_bias)
+            accept = pending & (new_loss <= loss - 1e-4 * step * decrement)
+            logits = torch.where(accept[:, None], new_logits, logits)
+            params = torch.where(accept[:, None], new_params, params)
+            bias = torch.where(accept, new_bias, bias)
+            loss = torch.where(accept, new_loss, loss)
+            pending &= ~accept
+            if not pending.any():
+                break
+            step = torch.where(pending, step / 2, step)
+        # Problems without any decrease along the Newton step are at their minimum
+        converged |= pending
+        iterations += active & ~pending
+
+    if dual:
+        return (
+            torch.bmm(params[:, None].to(x.dtype), x).squeeze(1),
+            bias.to(x.dtype),
+            iterations,
+            converged,
+        )
+    return params, bias, iterations, converged
+
+
+def _cholesky(matrix: Tensor) -> Tensor:
+    """Cholesky factor of a batch of symmetric matrices, adding increasing multiples
+    of the identity to those that aren't numerically positive definite."""
+    factor, info = torch.linalg.cholesky_ex(matrix)
+    scale = matrix.diagonal(dim1=-2, dim2=-1).abs().mean(-1)
+    jitter = torch.finfo(matrix.dtype).eps * scale
+    eye = torch.eye(matrix.shape[-1], dtype=matrix.dtype, device=matrix.device)
+    while info.any():
+        jitter = torch.where(info > 0, jitter * 10, jitter)
+        failed = info > 0
+        factor[failed], info[failed] = torch.linalg.cholesky_ex(
+            matrix[failed] + jitter[failed, None, None] * eye
+        )
+    return factor
+
+
+class BatchedClassifier(nn.Module):
+    """Independent binary linear classifiers, e.g. one for every layer of a model,
+    trained in a single batched optimization.
+
+    Each classifier minimizes the same objective as `Classifier.fit`, with the same
+    solvers batched over the layers. With L-BFGS they are fit together with
+    `batched_lbfgs`, which evaluates all layers in a few batched matrix products per
+    step and drops layers from the batch as they converge. Its line search
+    backtracks instead of enforcing the strong Wolfe conditions, so it reaches the
+    same optimum as `Classifier.fit` up to the tolerances of the solvers, but along
+    different iterates.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        input_dim: int,
+        device: str | torch.device | None = None,
+        dtype: torch.dtype | None = None,
+    ):
+        super().__init__()
+
+        self.weight = nn.Parameter(
+            torch.zeros(num_layers, input_dim, device=device, dtype=dtype)
+        )
+        self.bias = nn.Parameter(torch.zeros(num_layers, device=device, dtype=dtype))
+
+    def __len__(self) -> int:
+        return len(self.weight)
+
+    def __getitem__(self, layer: int) -> Classifier:
+        """The classifier of a single layer."""
+        classifier = Classifier(
+            self.weight.shape[1], device=self.weight.device, dtype=self.weight.dtype
+        )
+        classifier.linear.weight.data.copy_(self.weight.data[layer])
+        classifier.linear.bias.data.copy_(self.bias.data[layer])
+        return classifier
+
+    def forward(self, x: Tensor) -> Tensor:
+        """Log odds of shape (L, N) of inputs of shape (L, N, D)."""
+        return batched_logits(self.weight, self.bias, x)
+
+    @torch.no_grad()
+    def fit(
+        self,
+        x: Tensor,
+        y: Tensor,
+        *,
+        l2_penalty: float = 0.001,
+        max_iter: int = 10_000,
+        solver: Solver = "lbfgs",
+    ) -> Tensor:
+        """Fits the classifiers to the inputs of every layer with L2 regularization.
+
+        Convergence diagnostics of the fit are saved in `self.diagnostics`.
+
+        Args:
+            x: Input tensor of shape (L, N, D).
+            y: Binary targets of shape (N,), shared by all layers, or (L, N).
+            l2_penalty: L2 regularization strength.
+            max_iter: Maximum number of iterations of the L-BFGS optimizer.
+            solver: Solver of the classifiers, see `Classifier.fit`.
+
+        Returns:
+            Final values of the loss function of every layer, shape (L,).
+        """
+        solver = choose_solver(*x.shape[1:]) if solver == "auto" else solver
+        self.diagnostics = self._fit(x, y, slice(None), l2_penalty, max_iter, solver)
+        return self.diagnostics.loss
+
+    def fit_layers(
+        self,
+        hiddens: Sequence[Tensor],
+        y: Tensor,
+        *,
+        layers_per_batch: int | None = None,
+        l2_penalty: float = 0.001,
+        max_iter: int = 10_000,
+        solver: Solver = "lbfgs",
+    ) -> Tensor:
+        """Fits the classifiers to a sequence of layers, e.g. an `ActivationStore`.
+
+        The layers are moved to the device of the classifiers and fit in batches of
+        `layers_per_batch` layers, `LAYERS_PER_BATCH` by default. Raise it to fit more
+        layers at once when they fit in memory. The hiddens of each example are
+        flattened, so (N, 2, d) contrast pairs are concatenated.
+
+        Returns:
+            Final values of the loss function of every layer, shape (L,).
+        """
+        assert len(hiddens) == len(self), "Mismatched number of layers"
+        layers_per_batch = layers_per_batch or LAYERS_PER_BATCH
+        if solver == "auto":
+            solver = choose_solver(len(y), hiddens[0][0].numel())
+        diagnostics = []
+        for start in range(0, len(self), layers_per_batch):
+            layers = slice(start, min(start + layers_per_batch, len(self)))
+            x = torch.stack(
+                [
+                    hiddens[k].flatten(1).to(self.weight.device, self.weight.dtype)
+                    for k in range(layers.start, layers.stop)
+                ]
+            )
+            diagnostics.append(self._fit(x, y, layers, l2_penalty, max_iter, solver))
+            del x
+
+        self.diagnostics = FitDiagnostics(
+            solver,
+            *(
+                torch.cat([getattr(d, field) for d in diagnostics])
+                for field in ("iterations", "converged", "loss", "grad_norm")
+            ),
+        )
+        return self.diagnostics.loss
+
+    @torch.no_grad()
+    def _fit(
+        self,
+        x: Tensor,
+        y: Tensor,
+        layers: slice,
+        l2_penalty: float,
+        max_iter: int,
+        solver: str,
+    ) -> FitDiagnostics:
+        y = y.to(x.device, x.dtype).expand(x.shape[:2])
+        if solver in ("newton", "dual"):
+            weight, bias, iterations, converged = newton_logistic(
+                x, y, l2_penalty, dual=solver == "dual"
+            )
+        else:
+            assert solver == "lbfgs", f"Unknown solver: {solver}"
+            weight, bias, iterations, converged = self._fit_lbfgs(
+                x, y, layers, l2_penalty, max_iter
+            )
+        self.weight[layers] = weight.to(self.weight.dtype)
+        self.bias[layers] = bias.to(self.bias.dtype)
+
+        loss, grad_norm = logistic_loss_and_grad_norm(x, y, weight, bias, l2_penalty)
+        return FitDiagnostics(solver, iterations, converged, loss, grad_norm)
+
+    def _fit_lbfgs(
+        self, x: Tensor, y: Tensor, layers: slice, l2_penalty: float, max_iter: int
+    ) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+
+        def logits_fn(params: Tensor, x: Tensor) -> Tensor:
+            return batched_logits(params[:, :-1], params[:, -1], x)
+
+        # Inputs of the layers that are still being optimized. Consecutive layers are
+        # views, others are gathered once for every set of layers
+        gathered = (None, x, y)
+
+        def loss_fn(params: Tensor, index: Tensor) -> Tensor:
+            nonlocal gathered
+            start, stop = int(index[0]), int(index[-1]) + 1
+            if stop - start == len(index):
+                active_x, active_y = x[start:stop], y[start:stop]
+            else:
+                if gathered[0] is None or not torch.equal(gathered[0], index):
+                    gathered = (index, x[index], y[index])
+                _, active_x, active_y = gathered
+            logits = logits_fn(params, active_x)
+            loss = bce_with_logits(logits, active_y, reduction="none").mean(-1)
+            return loss + l2_penalty * params[:, :-1].square().sum(-1)
+
+        params = torch.cat([self.weight[layers], self.bias[layers, None]], dim=-1)
+        params, _, iterations, converged = batched_lbfgs(
+            loss_fn, params.to(x.dtype), max_iter=max_iter
+        )
+        return params[:, :-1], params[:, -1], iterations, converged
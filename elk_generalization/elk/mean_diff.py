@@ -2,6 +2,8 @@ import torch
 from torch import Tensor, nn, optim
 from sklearn.metrics import roc_auc_score
 
+from moment_store import ClassMoments
+
 class MeanDiffReporter(nn.Module):
     def __init__(self, in_features: int, device: torch.device, dtype: torch.dtype):
         super().__init__()
@@ -21,6 +23,14 @@ class MeanDiffReporter(nn.Module):
 
         self.linear.weight.data = diff.unsqueeze(0)
 
+    def fit_from_moments(self, moments: ClassMoments):
+        """Fit like `fit` to the samples that binary class `moments` summarize. The
+        sign needs no resolving, since the direction is mu1 - mu0."""
+        diff = moments.means[1] - moments.means[0]
+        diff = diff / diff.norm()
+
+        self.linear.weight.data = diff.unsqueeze(0).to(self.linear.weight.dtype)
+
     @torch.no_grad()
     def resolve_sign(self, labels: Tensor, hiddens: Tensor):
         """Flip the scale term if AUROC < 0.5."""
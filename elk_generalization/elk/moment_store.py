@@ -0,0 +1,276 @@
+"""Mergeable per-class moments of hidden states, for closed-form reporters."""
+
+import os
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from concept_erasure import LeaceEraser, LeaceFitter
+from torch import Tensor
+
+try:
+    from .activation_store import ActivationStore
+except ImportError:  # run as a script from this directory
+    from activation_store import ActivationStore
+
+
+@dataclass
+class ClassMoments:
+    """Count, mean and scatter matrix of the hiddens of each class, in float64.
+
+    These are sufficient statistics for closed-form reporters like mean-diff, LDA
+    and LEACE. Moments of disjoint sets of samples merge exactly with `merge`, so
+    moments computed once per dataset give those of any union of datasets.
+    """
+
+    counts: Tensor
+    """Number of samples of each class, shape (C,)."""
+    means: Tensor
+    """Mean of each class, shape (C, d)."""
+    scatters: Tensor
+    """Sum of the outer products of the centered samples of each class, (C, d, d)."""
+
+    @classmethod
+    def zeros(
+        cls, num_classes: int, dim: int, device: str | torch.device | None = None
+    ) -> "ClassMoments":
+        kwargs = dict(dtype=torch.float64, device=device)
+        return cls(
+            torch.zeros(num_classes, **kwargs),
+            torch.zeros(num_classes, dim, **kwargs),
+            torch.zeros(num_classes, dim, dim, **kwargs),
+        )
+
+    @classmethod
+    def fit(
+        cls,
+        x: Tensor,
+        classes: Tensor,
+        num_classes: int = 2,
+        chunk_size: int = 1024,
+        device: str | torch.device | None = None,
+    ) -> "ClassMoments":
+        """Moments of hiddens of shape (n, d) with integer classes of shape (n,).
+
+        The moments are accumulated on `device`, the device of `x` by default, to
+        which one chunk of `x` at a time is moved, so `x` can be memory-mapped.
+        """
+        moments = cls.zeros(num_classes, x.shape[-1], device or x.device)
+        for start in range(0, len(x), chunk_size):
+            stop = start + chunk_size
+            moments.update(x[start:stop], classes[start:stop])
+        return moments
+
+    @torch.no_grad()
+    def update(self, x: Tensor, classes: Tensor) -> "ClassMoments":
+        """Add a chunk of samples of shape (n, d) with classes of shape (n,)."""
+        x = x.to(self.means.device, torch.float64)
+        classes = classes.to(self.means.device)
+        chunk = ClassMoments.zeros(*self.means.shape, self.means.device)
+        for c in range(len(self.counts)):
+            x_c = x[classes == c]
+            if not len(x_c):
+                continue
+            chunk.counts[c] = len(x_c)
+            chunk.means[c] = x_c.mean(dim=0)
+            centered = x_c - chunk.means[c]
+            chunk.scatters[c] = centered.mT @ centered
+        merged = self.merge(chunk)
+        self.counts, self.means, self.scatters = (
+            merged.counts,
+            merged.means,
+            merged.scatters,
+        )
+        return self
+
+    def merge(self, other: "ClassMoments") -> "ClassMoments":
+        """Moments of the union of the samples of both, e.g. of two datasets."""
+        counts = self.counts + other.counts
+        delta = other.means - self.means
+        # Classes without any samples have zero weight
+        weight = (other.counts / counts.clamp_min(1))[:, None]
+        coupling = (self.counts * other.counts / counts.clamp_min(1))[:, None, None]
+        return ClassMoments(
+            counts,
+            self.means + weight * delta,
+            self.scatters
+            + other.scatters
+            + coupling * delta[:, :, None] * delta[:, None, :],
+        )
+
+    def rescale(self, num_samples: float) -> "ClassMoments":
+        """Moments weighted as if `num_samples` samples were drawn from these ones,
+        with the same class proportions, e.g. to weight datasets of different sizes
+        equally when merging them."""
+        scale = num_samples / self.num_samples
+        return ClassMoments(self.counts * scale, self.means, self.scatters * scale)
+
+    def to(self, device: str | torch.device | None) -> "ClassMoments":
+        return ClassMoments(
+            self.counts.to(device), self.means.to(device), self.scatters.to(device)
+        )
+
+    @property
+    def num_samples(self) -> float:
+        return float(self.counts.sum())
+
+    @property
+    def mean(self) -> Tensor:
+        """Mean of all samples, shape (d,)."""
+        return self.counts @ self.means / self.num_samples
+
+    def within_covariance(self) -> Tensor:
+        """Pooled within-class covariance of shape (d, d), normalized by the number
+        of samples."""
+        return self.scatters.sum(0) / self.num_samples
+
+    def covariance(self) -> Tensor:
+        """Covariance of all samples of shape (d, d), normalized by their number."""
+        between = self.means - self.mean
+        between = (self.counts[:, None] * between).mT @ between
+        return self.within_covariance() + between / self.num_samples
+
+    def leace_eraser(self, dtype: torch.dtype | None = None, **kwargs) -> LeaceEraser:
+        """LEACE eraser of the class from the hiddens, as fit by `LeaceFitter` on the
+        samples with one-hot classes. It is fit in float64 and then cast to `dtype`,
+        if given. Other keyword arguments go to `LeaceFitter`."""
+        num_classes, dim = self.means.shape
+        fitter = LeaceFitter(
+            dim, num_classes, device=self.means.device, dtype=torch.float64, **kwargs
+        )
+        # The unnormalized statistics that `LeaceFitter.update` would accumulate
+        fitter.n = torch.tensor(int(self.num_samples), device=self.means.device)
+        fitter.mean_x = self.mean
+        fitter.mean_z = self.counts / self.num_samples
+        fitter.sigma_xz_ = ((self.means - self.mean) * self.counts[:, None]).mT
+        if fitter.sigma_xx_ is not None:
+            fitter.sigma_xx_ = self.covariance() * self.num_samples
+        eraser = fitter.eraser
+        if dtype is None:
+            return eraser
+        return LeaceEraser(
+            eraser.proj_left.to(dtype),
+            eraser.proj_right.to(dtype),
+            eraser.bias.to(dtype) if eraser.bias is not None else None,
+        )
+
+    def state_dict(self) -> dict:
+        return dict(counts=self.counts, means=self.means, scatters=self.scatters)
+
+
+def merge_moments(moments: Iterable[ClassMoments]) -> ClassMoments:
+    """Moments of the union of the samples of all `moments`, e.g. of several
+    datasets."""
+    moments = iter(moments)
+    merged = next(moments)
+    for other in moments:
+        merged = merged.merge(other)
+    return merged
+
+
+class MomentStore(Sequence):
+    """Per-layer `ClassMoments` of an artifact, computed once and saved next to it.
+
+    The moments of layer `k` of `<root>/<name>` are saved at
+    `<root>/moments/<name>-<classes>/layer_<k>.pt`. They are computed in a single
+    streaming pass over the memory-mapped layer the first time they are accessed, and
+    files are written under a hidden name and renamed once complete.
+
+    Args:
+        root: Directory containing the artifact, e.g. a split of a dataset.
+        name: Name of the artifact, e.g. "hiddens".
+        classes: Name of the labels that define the classes, e.g. "labels" for
+            `<root>/labels.pt`, or "contrast" to use the negative and positive
+            hiddens of contrast pairs of shape (n, 2, d) as the two classes.
+        device: Device on which missing moments are computed and returned.
+        chunk_size: Number of samples per chunk of the streaming pass.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        name: str = "hiddens",
+        classes: str = "labels",
+        device: str | torch.device | None = None,
+        chunk_size: int = 1024,
+    ):
+        self.root = Path(root)
+        self.name = name
+        self.classes = classes
+        self.device = device
+        self.chunk_size = chunk_size
+        self.path = self.root / "moments" / f"{name}-{classes}"
+        self._hiddens = None
+
+    @property
+    def hiddens(self) -> ActivationStore:
+        if self._hiddens is None:
+            self._hiddens = ActivationStore(self.root, self.name)
+        return self._hiddens
+
+    def __len__(self) -> int:
+        return len(self.hiddens)
+
+    def layer_path(self, k: int) -> Path:
+        return self.path / f"layer_{k:03d}.pt"
+
+    def layer(self, k: int) -> ClassMoments:
+        """Moments of layer `k`, computed and saved if they don't exist yet."""
+        k = range(len(self))[k]
+        path = self.layer_path(k)
+        if path.exists():
+            state = torch.load(path, map_location=self.device)
+            return ClassMoments(**state)
+
+        moments = self.compute(k)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Unique per process, since several jobs may compute the same moments at once
+        tmp_path = path.with_name(f".{path.name}.tmp{os.getpid()}")
+        torch.save(moments.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+        return moments
+
+    def compute(self, k: int) -> ClassMoments:
+        """Compute the moments of layer `k` in one pass over its samples."""
+        hiddens = self.hiddens.layer(k)
+        if self.classes == "contrast":
+            n, num_classes, dim = hiddens.shape
+            hiddens = hiddens.reshape(n * num_classes, dim)
+            classes = torch.arange(num_classes).repeat(n)
+        else:
+            classes = torch.load(self.root / f"{self.classes}.pt", map_location="cpu")
+            num_classes = 2
+        return ClassMoments.fit(
+            hiddens, classes, num_classes, self.chunk_size, device=self.device
+        )
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.layer(i) for i in range(len(self))[k]]
+        return self.layer(k)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Compute the per-class moments of every layer of some splits."
+    )
+    parser.add_argument("split_dirs", type=Path, nargs="+")
+    parser.add_argument("--name", type=str, default="hiddens")
+    parser.add_argument(
+        "--classes",
+        type=str,
+        default="labels",
+        help="Labels defining the classes, e.g. 'labels' or 'alice_labels', or "
+        "'contrast' for the two sides of the contrast pairs",
+    )
+    parser.add_argument("--device", type=str)
+    args = parser.parse_args()
+
+    for split_dir in args.split_dirs:
+        store = MomentStore(split_dir, args.name, args.classes, args.device)
+        for k in range(len(store)):
+            store.layer(k)
+        print(f"Saved the moments of {len(store)} layers at {store.path}")
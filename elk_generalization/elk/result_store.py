@@ -0,0 +1,310 @@
+"""Append-only, partitioned Parquet store of the per-layer results of reporters."""
+
+import fcntl
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+import torch
+from torch import Tensor
+
+try:
+    from .catalog import Catalog
+except ImportError:  # run as a script from this directory
+    from catalog import Catalog
+
+SCHEMA = pa.schema(
+    [
+        ("train_desc", pa.string()),
+        ("eval_dataset", pa.string()),
+        ("label_col", pa.string()),
+        ("layer", pa.int32()),
+        # Log odds of every test example, or null for reporters that save metrics
+        ("log_odds", pa.list_(pa.float32())),
+        # JSON-encoded metrics of the layer, e.g. the AUROC of random reporters
+        ("metrics", pa.string()),
+        ("created", pa.float64()),
+    ]
+)
+# Columns given by the directories of the partitions
+PARTITIONS = pa.schema([("model", pa.string()), ("reporter", pa.string())])
+# Columns identifying a result; later rows replace earlier ones with the same key
+KEY = ["model", "reporter", "train_desc", "eval_dataset", "label_col", "layer"]
+
+
+class ResultStore:
+    """Results of reporters, stored as Parquet files partitioned by model and reporter.
+
+    Each flush adds a new uniquely named file to the partition of every model and
+    reporter it has rows for, at `<root>/model=<model>/reporter=<reporter>/part-*.parquet`,
+    so any number of processes can write to the store concurrently without locking.
+    Files are written under a hidden name and renamed once complete, so readers never
+    see partial files. A result that is written again supersedes the earlier rows with
+    the same key (`KEY`). Writers only ever add files; merging the files of each
+    partition into one is a separate offline step, `python result_store.py <data_dir>
+    --compact`, run once the jobs writing to the store have finished.
+
+    Reads only open the partitions of the requested models and reporters and only
+    decode the requested columns.
+
+    Args:
+        root: Directory of the store, e.g. `<data_dir>/results`.
+        flush_rows: Number of buffered rows after which `add_*` flush automatically.
+    """
+
+    def __init__(self, root: Path, flush_rows: int = 100_000):
+        self.root = Path(root)
+        self.flush_rows = flush_rows
+        self._buffer: dict[tuple[str, str], list[dict]] = {}
+        self._num_rows = 0
+
+    def partition(self, model: str, reporter: str) -> Path:
+        # Model names like "EleutherAI/pythia-410M" are URI-encoded, as pyarrow expects
+        return (
+            self.root
+            / f"model={quote(model, safe='')}"
+            / f"reporter={quote(reporter, safe='')}"
+        )
+
+    def _add(self, model: str, reporter: str, rows: list[dict]):
+        self._buffer.setdefault((model, reporter), []).extend(rows)
+        self._num_rows += len(rows)
+        if self._num_rows >= self.flush_rows:
+            self.flush()
+
+    def add_log_odds(
+        self,
+        model: str,
+        reporter: str,
+        train_desc: str,
+        eval_dataset: str,
+        label_col: str,
+        log_odds: Tensor,
+    ):
+        """Buffer the log odds of shape (num_layers, num_examples) of a reporter."""
+        created = time.time()
+        log_odds = log_odds.float().cpu().numpy()
+        self._add(
+            model,
+            reporter,
+            [
+                dict(
+                    train_desc=train_desc,
+                    eval_dataset=eval_dataset,
+                    label_col=label_col,
+                    layer=layer,
+                    log_odds=layer_log_odds,
+                    metrics=None,
+                    created=created,
+                )
+                for layer, layer_log_odds in enumerate(log_odds)
+            ],
+        )
+
+    def add_metrics(
+        self,
+        model: str,
+        reporter: str,
+        train_desc: str,
+        eval_dataset: str,
+        label_col: str,
+        metrics: list[dict],
+    ):
+        """Buffer a JSON-serializable dict of metrics for every layer of a reporter."""
+        created = time.time()
+        self._add(
+            model,
+            reporter,
+            [
+                dict(
+                    train_desc=train_desc,
+                    eval_dataset=eval_dataset,
+                    label_col=label_col,
+                    layer=layer,
+                    log_odds=None,
+                    metrics=json.dumps(layer_metrics),
+                    created=created,
+                )
+                for layer, layer_metrics in enumerate(metrics)
+            ],
+        )
+
+    def flush(self):
+        """Write the buffered rows as one new file per partition."""
+        for (model, reporter), rows in self._buffer.items():
+            table = pa.Table.from_pylist(rows, schema=SCHEMA)
+            self._write(self.partition(model, reporter), table)
+        self._buffer = {}
+        self._num_rows = 0
+
+    def _write(self, directory: Path, table: pa.Table) -> Path:
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        # Hidden files are ignored by readers until they are renamed
+        tmp_path = directory / f".{name}.tmp"
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, directory / name)
+        return directory / name
+
+    def _files(self, model: str | None, reporter: str | None) -> list[Path]:
+        if model is not None and reporter is not None:
+            directories = [self.partition(model, reporter)]
+        elif model is not None:
+            directories = self.partition(model, "").parent.glob("reporter=*")
+        elif reporter is not None:
+            directories = self.root.glob(f"model=*/reporter={quote(reporter, safe='')}")
+        else:
+            directories = self.root.glob("model=*/reporter=*")
+        return sorted(f for d in directories for f in Path(d).glob("part-*.parquet"))
+
+    def read(
+        self,
+        model: str | None = None,
+        reporter: str | None = None,
+        columns: list[str] | None = None,
+        filter: pds.Expression | None = None,
+    ) -> pd.DataFrame:
+        """Latest results of the given model and reporter, or of all of them.
+
+        Args:
+            columns: Columns to read besides the key columns (`KEY`), which are
+                always read. All columns by default.
+            filter: Row filter, e.g. `pds.field("eval_dataset") == "got/cities"`.
+        """
+        columns = list(
+            dict.fromkeys(
+                KEY + ["created"] + (SCHEMA.names if columns is None else columns)
+            )
+        )
+        files = self._files(model, reporter)
+        if not files:
+            return pd.DataFrame(columns=columns).drop(columns="created")
+
+        dataset = pds.dataset(
+            [str(f) for f in files],
+            schema=pa.unify_schemas([SCHEMA, PARTITIONS]),
+            format="parquet",
+            partitioning=pds.partitioning(PARTITIONS, flavor="hive"),
+            partition_base_dir=str(self.root),
+        )
+        df = dataset.to_table(columns=columns, filter=filter).to_pandas()
+        # Later writes of the same result supersede earlier ones
+        df = df.sort_values("created", kind="stable").drop_duplicates(KEY, keep="last")
+        return df.drop(columns="created").sort_values(KEY).reset_index(drop=True)
+
+    def keys(
+        self, model: str, reporter: str, label_col: str | None = None
+    ) -> set[tuple[str, str]]:
+        """(train_desc, eval_dataset) pairs with results, e.g. for skip checks."""
+        filter = pds.field("label_col") == label_col if label_col is not None else None
+        df = self.read(model, reporter, columns=[], filter=filter)
+        return set(zip(df["train_desc"], df["eval_dataset"]))
+
+    def compact(self, model: str | None = None, reporter: str | None = None):
+        """Merge the files of each partition into a single file without superseded rows.
+
+        Meant to be run offline rather than by the jobs writing to the store.
+        Compactions hold an exclusive lock on `<root>/.compact.lock`, so they never
+        merge or delete the same files twice; files added by writers in the meantime
+        are left for the next compaction, and readers drop the rows that briefly
+        appear twice.
+        """
+        self.flush()
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / ".compact.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            by_partition: dict[Path, list[Path]] = {}
+            for file in self._files(model, reporter):
+                by_partition.setdefault(file.parent, []).append(file)
+
+            for directory, files in by_partition.items():
+                if len(files) < 2:
+                    continue
+                table = pa.concat_tables(pq.read_table(f, schema=SCHEMA) for f in files)
+                df = table.to_pandas().sort_values("created", kind="stable")
+                keys = [c for c in KEY if c in SCHEMA.names]
+                df = df.drop_duplicates(keys, keep="last").sort_values(keys)
+                self._write(
+                    directory,
+                    pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False),
+                )
+                for file in files:
+                    file.unlink()
+
+def import_legacy_results(
+    data_dir: Path, store: ResultStore, label_col: str = "labels"
+):
+    """Add the `<reporter>_log_odds.pt` and `random_aucs_against_<label_col>.pt` files
+    saved by earlier versions of transfer_diversify.py to the store.
+
+    They are found at
+    `<data_dir>/<eval_dataset>/<model>/test/<training_identifier>/`, and the model and
+    eval dataset are recovered from the catalog of `data_dir`.
+    """
+    catalog = Catalog(data_dir)
+    count = 0
+    for artifact in catalog.find(split="test"):
+        train_desc, _, name = artifact.name.rpartition("/")
+        if not train_desc.startswith("trained-on"):
+            continue
+        if name.endswith("_log_odds"):
+            store.add_log_odds(
+                artifact.model,
+                name.removesuffix("_log_odds"),
+                train_desc,
+                artifact.dataset,
+                label_col,
+                torch.load(artifact.path, map_location="cpu"),
+            )
+        elif name == f"random_aucs_against_{label_col}":
+            store.add_metrics(
+                artifact.model,
+                "random",
+                train_desc,
+                artifact.dataset,
+                label_col,
+                torch.load(artifact.path, map_location="cpu"),
+            )
+        else:
+            continue
+        count += 1
+    store.flush()
+    return count
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Maintain the result store of a data directory."
+    )
+    parser.add_argument("data_dir", type=Path)
+    parser.add_argument(
+        "--import-legacy",
+        action="store_true",
+        help="Add the *_log_odds.pt results catalogued in data_dir to the store",
+    )
+    parser.add_argument(
+        "--label-col",
+        type=str,
+        default="labels",
+        help="Label the imported results were trained on",
+    )
+    parser.add_argument(
+        "--compact", action="store_true", help="Merge the files of each partition"
+    )
+    args = parser.parse_args()
+
+    store = ResultStore(args.data_dir / "results")
+    if args.import_legacy:
+        count = import_legacy_results(args.data_dir, store, args.label_col)
+        print(f"Imported {count} result files into {store.root}")
+    if args.compact:
+        store.compact()
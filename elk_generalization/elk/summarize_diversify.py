@@ -1,4 +1,5 @@
 import argparse
+import json
 from pathlib import Path
 import os
 import pandas as pd
@@ -7,6 +8,9 @@ from itertools import combinations
 import torch
 import numpy as np
 from sklearn.metrics import accuracy_score, roc_auc_score
+import pyarrow.dataset as pds
+from catalog import Catalog
+from result_store import ResultStore
 from elk_utils import aggregate_segments, DiversifyTrainingConfig
 
 
@@ -28,6 +32,7 @@ if __name__ == "__main__":
     parser.add_argument("--reporters", type=str, nargs="+", default="lr", help="Which reporters to use.")
     parser.add_argument("--metric", type=str, choices=["auroc", "acc"], default="auroc", help="Metric to use.")
     parser.add_argument("--label-col", type=str, choices=["labels", "objective_labels", "quirky_labels"], default="objective_labels", help="Which label to use for the metric.")
+    parser.add_argument("--train-label-col", type=str, default="labels", help="Label the reporters were trained on.")
     parser.add_argument("--save-csv-path", type=Path, help="Path to save the dataframe as csv.")
     parser.add_argument(
         "--training-datasets",
@@ -56,6 +61,7 @@ if __name__ == "__main__":
             reporters = ["ccs", "lr"],
             metric="auroc",
             label_col = "labels",
+            train_label_col = "labels",
             save_csv_path="diversify_debug.csv",
             training_datasets = ["got/cities", "got/larger_than"],
             eval_datasets = ["got/cities", "got/larger_than"],
@@ -69,6 +75,28 @@ if __name__ == "__main__":
     print(args)
 
     data_dir = Path(args.data_dir)
+    # Results are discovered through the catalog of data_dir instead of the filesystem
+    catalog = Catalog(data_dir, readonly=True)
+    store = ResultStore(data_dir / "results")
+    reporter_results = {}
+
+    def load_results(model, reporter):
+        """Per-layer results of a reporter by (train_desc, eval_dataset), read once per model and reporter."""
+        if (model, reporter) not in reporter_results:
+            # Only decode the column the reporter saves
+            column = "metrics" if reporter == "random" else "log_odds"
+            results = store.read(
+                model,
+                reporter,
+                columns=[column],
+                filter=(pds.field("label_col") == args.train_label_col) & pds.field("eval_dataset").isin(args.eval_datasets),
+            )
+            # Rows are sorted by layer within each group
+            reporter_results[model, reporter] = {
+                key: group[column].tolist() for key, group in results.groupby(["train_desc", "eval_dataset"])
+            }
+        return reporter_results[model, reporter]
+
     metric_fn = {
         "auroc": roc_auc_score,
         "acc": lambda gt, logodds: accuracy_score(gt, logodds > 0),
@@ -106,9 +134,9 @@ if __name__ == "__main__":
 
                 # Add lm performance if available
                 # (we don't expect it to be available for non-"choice" datasets)
-                lm_log_odds_path = eval_dir / "lm_log_odds.pt"
-                if lm_log_odds_path.exists():
-                    lm_log_odds = torch.load(lm_log_odds_path, map_location="cpu")
+                lm_log_odds_artifact = catalog.get(eval_dataset, model, "test", "lm_log_odds")
+                if lm_log_odds_artifact is not None:
+                    lm_log_odds = torch.load(lm_log_odds_artifact.path, map_location="cpu")
                     # lm performance is independent of the probe's and their training, but we add it for each training config for convenience
                     rows.append({
                         "model": model,
@@ -123,14 +151,18 @@ if __name__ == "__main__":
 
                 for reporter in args.reporters:
                     aurocs_per_layer = []
+                    results = load_results(model, reporter).get((train_desc, eval_dataset))
+                    if results is None:
+                        print(f"Skipping {reporter} trained on {train_desc} for {eval_dataset} with {model}: no results in the store.")
+                        continue
                     if reporter == "random":
-                        random_aurocs = torch.load(eval_dir / train_desc / f"random_aucs_against_labels.pt", map_location="cpu")
+                        random_aurocs = [json.loads(metrics) for metrics in results]
                         aurocs_per_layer = [auroc["mean"] for auroc in random_aurocs]
                         # Accuracies are currently not available for random reporters
                         accs_per_layer = [np.nan for auroc in random_aurocs]
                     else:
-                        reporter_log_odds = torch.load(eval_dir / train_desc / f"{reporter}_log_odds.pt", map_location="cpu")
-                        aurocs_per_layer = [roc_auc_score(labels, layer_log_odds.float().numpy()) for layer_log_odds in reporter_log_odds]
+                        reporter_log_odds = results
+                        aurocs_per_layer = [roc_auc_score(labels, layer_log_odds) for layer_log_odds in reporter_log_odds]
                         accs_per_layer = [accuracy_score(labels, layer_log_odds > 0) for layer_log_odds in reporter_log_odds]
 
 
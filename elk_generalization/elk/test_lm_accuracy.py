@@ -7,13 +7,23 @@ import sys
 import pandas as pd
 import numpy as np
 import torch
-from datasets import Dataset, load_dataset, load_from_disk
+from datasets import Dataset, concatenate_datasets, load_dataset, load_from_disk
 from tqdm.auto import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from sklearn.metrics import roc_auc_score, accuracy_score
 
 sys.path.append('')
 from elk_generalization.datasets.integer_comparison_dataset import IntComparisonDataset
+from elk_generalization.elk.extraction import (
+    default_batch_size,
+    filter_difficulty,
+    lm_log_odds_batch,
+    load_model,
+    pad_token_id,
+    plan_batches,
+)
+from elk_generalization.elk.tokenization import pretokenize
+
 
 def encode_choice(text, tokenizer):
     c_ids = tokenizer.encode(text, add_special_tokens=False)
@@ -26,6 +36,110 @@ def encode_choice(text, tokenizer):
     return c_ids[0]
 
 
+def filter_dataset(dataset, args):
+    dataset = filter_difficulty(dataset, args.difficulty)
+
+    # Filter along specified columns
+    print(f"Number of rows before filtering along columns: {len(dataset)}")
+    for i, col in enumerate(args.filter_cols):
+        value = bool(strtobool(args.filter_values[i].strip()))
+        dataset = dataset.filter(lambda example: example[col] == value)
+    print(f"Number of rows after filtering along columns: {len(dataset)}")
+    return dataset
+
+
+def template_metrics(dataset, log_odds):
+    """Summarize model behavior with a template"""
+    return {
+        "label_accuracy": accuracy_score(dataset["label"], log_odds > 0),
+        "label_auroc": roc_auc_score(dataset["label"], log_odds),
+        "ol_accuracy": accuracy_score(dataset["objective_label"], log_odds > 0),
+        "ol_auroc": roc_auc_score(dataset["objective_label"], log_odds),
+        "ql_accuracy": accuracy_score(dataset["quirky_label"], log_odds > 0),
+        "ql_auroc": roc_auc_score(dataset["quirky_label"], log_odds),
+        "positive_predictions": (log_odds > 0).float().mean().item(),
+        "log_odds_mean": log_odds.mean().item(),
+        "balance_label": np.mean(dataset["label"]),
+        "balance_ol": np.mean(dataset["objective_label"]),
+        "balance_ql": np.mean(dataset["quirky_label"]),
+    }
+
+
+def sweep(args, templates):
+    """Score all templates on the same integer pairs and tabulate the LM accuracy.
+
+    The statements of all templates that a model has not been scored on yet are
+    tokenized together and run in mixed batches through a single loaded model. Only
+    the LM log odds are computed. Results are appended to one table, keyed by the
+    template text, so that adding templates only scores the new ones.
+    """
+    table_path = args.save_path / "template_sweep.csv"
+    table = pd.read_csv(table_path) if table_path.exists() else pd.DataFrame()
+
+    # The integer pairs are stored the first time, so that templates added later are
+    # scored on exactly the same pairs
+    ds_full = IntComparisonDataset(
+        base_examples=args.max_examples,
+        err_symbols=('<', '>'),
+        working_dir=args.save_path)
+    base_path = args.save_path / "template_sweep_base"
+    if base_path.exists():
+        base_dataset = load_from_disk(str(base_path))
+    else:
+        base_dataset = ds_full.dataset
+        base_dataset.save_to_disk(str(base_path))
+
+    for model_name in args.models:
+        done = set(table.loc[table["model"] == model_name, "template"]) if len(table) else set()
+        pending = [(i, t) for i, t in enumerate(templates) if t not in done]
+        if not pending:
+            print(f"All templates already scored for {model_name}. Skipping.")
+            continue
+
+        # Materialize the pending templates, each on the same filtered integer pairs
+        parts = []
+        for i_template, template in pending:
+            ds_full.fixed_template = template
+            dataset = ds_full._transform_base_dataset(base_dataset, {})
+            dataset = filter_dataset(dataset, args).select(range(args.max_examples))
+            parts.append(dataset.add_column("template_index", [i_template] * len(dataset)))
+        dataset = concatenate_datasets(parts)
+
+        model = load_model(model_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        dataset = pretokenize(dataset, tokenizer, ["statement"], "choices", cache_dir=args.tokenization_cache)
+        batch_size = args.batch_size or (None if args.max_tokens_per_batch else default_batch_size(model))
+
+        # Statements of different templates are mixed in length-bucketed batches
+        prompts = dataset["statement_ids"]
+        choice_toks = dataset["choice_ids"]
+        pad_id = pad_token_id(tokenizer)
+        log_odds = torch.full([len(dataset)], torch.nan, dtype=torch.float32)
+        for batch in tqdm(plan_batches([len(p) for p in prompts], batch_size, args.max_tokens_per_batch)):
+            log_odds[batch] = lm_log_odds_batch(
+                model, [prompts[i] for i in batch], [choice_toks[i] for i in batch], pad_id
+            ).float().cpu()
+        assert log_odds.isfinite().all()
+
+        template_index = np.asarray(dataset["template_index"])
+        rows = []
+        for i_template, template in pending:
+            select = np.flatnonzero(template_index == i_template)
+            rows.append({
+                "model": model_name,
+                "template_index": i_template,
+                "template": template,
+                **template_metrics(dataset.select(select), log_odds[select]),
+            })
+        table = pd.concat([table, pd.DataFrame(rows)], ignore_index=True)
+        print(f"Finished all templates for {model_name}. Results:")
+        print(pd.DataFrame(rows).drop(columns="template"))
+        table.to_csv(table_path, index=False)
+
+        del model
+    print(table.drop(columns="template"))
+
+
 if __name__ == "__main__":
     debug = False
     if debug:
@@ -41,6 +155,10 @@ if __name__ == "__main__":
             label_cols = ["label", "objective_label", "objective_label", "quirky_label"],
             filter_cols = [],
             filter_values = [],
+            sweep = False,
+            batch_size = None,
+            max_tokens_per_batch = None,
+            tokenization_cache = None,
             )
     else:
         parser = ArgumentParser(description="Process and save model hidden states.")
@@ -79,6 +197,29 @@ if __name__ == "__main__":
             help="Values by which we want to filter the columns specified by --filter-cols.",
             default=[],
         )
+        parser.add_argument(
+            "--sweep",
+            action="store_true",
+            help="Only score the LM log odds of all templates in mixed batches and write one accuracy and AUROC "
+            "table, template_sweep.csv. Templates already in the table are not scored again.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="Number of statements per forward pass with --sweep. Defaults to 1 on GPUs "
+            "and to a size that fits the CPU cache on the CPU.",
+        )
+        parser.add_argument(
+            "--max-tokens-per-batch",
+            type=int,
+            help="With --sweep, build batches of statements of similar length with at most this many (padded) "
+            "tokens instead of fixed-size batches. --batch-size then caps the number of statements.",
+        )
+        parser.add_argument(
+            "--tokenization-cache",
+            type=Path,
+            help="Directory in which tokenized datasets are cached. Defaults to a subdirectory of the datasets cache.",
+        )
         args = parser.parse_args()
 
     print(args)
@@ -98,6 +239,9 @@ if __name__ == "__main__":
         "Upon examining two numbers, {name} consistently leans towards the first one being {quirk_text} the second. In {name}'s analysis, the proposition {int1}{task_operator}{int2} is"
     ]
 
+    if args.sweep:
+        sweep(args, templates)
+        sys.exit()
 
     index = pd.MultiIndex(levels=[[], []], codes=[[], []], names=['model', 'template'])
     df = pd.DataFrame(index=index)
@@ -130,23 +274,7 @@ if __name__ == "__main__":
 
             assert isinstance(dataset, Dataset)
 
-            # Filter for difficulty (corresponds to number of digits in the shorter of the two summands)
-            # An easy example is defined as one in which the shorter of the two summands is two digits or shorter. 
-            if args.difficulty == "easy":
-                print(f"Filtering for difficulty {args.difficulty}")
-                dataset = dataset.filter(lambda example: example["difficulty"] <= 2)
-                
-            # Similarly, a hard example has a shorter summand of at least four digits.
-            if args.difficulty == "hard":
-                print(f"Filtering for difficulty {args.difficulty}")
-                dataset = dataset.filter(lambda example: example["difficulty"] > 4)
-
-            # Filter along specified columns
-            print(f"Number of rows before filtering along columns: {len(dataset)}")
-            for i, col in enumerate(args.filter_cols):
-                value = bool(strtobool(args.filter_values[i].strip()))
-                dataset = dataset.filter(lambda example: example[col] == value)
-            print(f"Number of rows after filtering along columns: {len(dataset)}")
+            dataset = filter_dataset(dataset, args)
 
             print(f"Size of dataset before selecting: {len(dataset)}")
             dataset = dataset.select(range(args.max_examples))
@@ -225,17 +353,8 @@ if __name__ == "__main__":
             # Summarize model behavior with the template
             log_odds = log_odds.cpu()
             df.loc[(model_name, i_template), "template"] = template
-            df.loc[(model_name, i_template), "label_accuracy"] = accuracy_score(dataset["label"], log_odds > 0)
-            df.loc[(model_name, i_template), "label_auroc"] = roc_auc_score(dataset["label"], log_odds)
-            df.loc[(model_name, i_template), "ol_accuracy"] = accuracy_score(dataset["objective_label"], log_odds > 0)
-            df.loc[(model_name, i_template), "ol_auroc"] = roc_auc_score(dataset["objective_label"], log_odds)
-            df.loc[(model_name, i_template), "ql_accuracy"] = accuracy_score(dataset["quirky_label"], log_odds > 0)
-            df.loc[(model_name, i_template), "ql_auroc"] = roc_auc_score(dataset["quirky_label"], log_odds)
-            df.loc[(model_name, i_template), "positive_predictions"] = (log_odds > 0).float().mean().item()
-            df.loc[(model_name, i_template), "log_odds_mean"] = log_odds.mean().item()
-            df.loc[(model_name, i_template), "balance_label"] = np.mean(dataset["label"])
-            df.loc[(model_name, i_template), "balance_ol"] = np.mean(dataset["objective_label"])
-            df.loc[(model_name, i_template), "balance_ql"] = np.mean(dataset["quirky_label"])
+            for metric, value in template_metrics(dataset, log_odds).items():
+                df.loc[(model_name, i_template), metric] = value
 
             print(f"Finished run {model_name}, {i_template}. Results:")
             print(df.loc[(model_name, i_template)])
@@ -0,0 +1,164 @@
+"""Batched pre-tokenization of datasets with a persistent on-disk cache."""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+from datasets import Dataset, load_from_disk
+from datasets.config import HF_DATASETS_CACHE
+
+# Bump when the layout of the cached datasets changes
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = Path(HF_DATASETS_CACHE) / "elk_tokenized"
+
+
+def encode_choice(text, tokenizer):
+    c_ids = tokenizer.encode(text, add_special_tokens=False)
+
+    # some tokenizers split off the leading whitespace character
+    if tokenizer.decode(c_ids[0]).strip() == "":
+        c_ids = c_ids[1:]
+        assert c_ids == tokenizer.encode(text.lstrip(), add_special_tokens=False)
+    assert len(c_ids) == 1, f"Choice should be one token: {text}"
+    return c_ids[0]
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything that determines the token ids a tokenizer produces.
+
+    For fast tokenizers this is the serialized tokenizer pipeline (normalizer,
+    pre-tokenizer, vocab and merges, and the post-processor that adds special
+    tokens), so all Pythia sizes share a fingerprint. Slow tokenizers fall back to
+    the vocab and special tokens.
+    """
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = json.dumps(
+            [
+                type(tokenizer).__name__,
+                sorted(tokenizer.get_vocab().items()),
+                tokenizer.special_tokens_map,
+            ],
+            sort_keys=True,
+        )
+    return hashlib.sha256(state.encode()).hexdigest()
+
+
+def _tokenize_batch(
+    batch: dict[str, list],
+    tokenizer,
+    text_columns: list[str],
+    choices_column: str | None,
+    single_token_choices: bool,
+) -> dict[str, list]:
+    out = {}
+    for column in text_columns:
+        texts = batch[column]
+        # Columns like "prompts" hold several texts per example
+        nested = len(texts) > 0 and isinstance(texts[0], list)
+        flat = [text for group in texts for text in group] if nested else texts
+        ids = tokenizer(flat)["input_ids"]
+        if nested:
+            grouped, start = [], 0
+            for group in texts:
+                grouped.append(ids[start : start + len(group)])
+                start += len(group)
+            ids = grouped
+        out[f"{column}_ids"] = ids
+
+    if choices_column is not None:
+        # There are usually only a handful of distinct choices
+        encoded = {}
+        for choices in batch[choices_column]:
+            for choice in choices:
+                if choice not in encoded:
+                    encoded[choice] = (
+                        encode_choice(choice, tokenizer)
+                        if single_token_choices
+                        else tokenizer.encode(choice, add_special_tokens=False)
+                    )
+        out["choice_ids"] = [
+            [encoded[choice] for choice in choices]
+            for choices in batch[choices_column]
+        ]
+    return out
+
+
+def pretokenize(
+    dataset: Dataset,
+    tokenizer,
+    text_columns: list[str],
+    choices_column: str | None = None,
+    single_token_choices: bool = True,
+    cache_dir: Path | None = None,
+    num_proc: int | None = None,
+) -> Dataset:
+    """Tokenize the text columns of a dataset, reusing earlier results from disk.
+
+    Adds a `<column>_ids` column with the token ids (including special tokens, as
+    `tokenizer.encode` would) for each of `text_columns`, and a `choice_ids` column
+    with the ids of each choice in `choices_column`. The tokenizer runs batched over
+    several processes, and the result is saved as an Arrow dataset under a key made of
+    the tokenizer fingerprint and the dataset fingerprint. Later calls, e.g. for every
+    other model with the same tokenizer, memory-map the cached dataset instead.
+
+    Args:
+        dataset: Dataset to tokenize. Tokenize it before shuffling or selecting rows,
+            so that the cache is shared by all seeds and subsets.
+        tokenizer: A (preferably fast) Hugging Face tokenizer.
+        text_columns: Columns containing a text or a list of texts per example.
+        choices_column: Column containing the answer choices of each example.
+        single_token_choices: Encode each choice as a single token id with
+            `encode_choice`. Otherwise, each choice is encoded as the list of ids of
+            its continuation tokens, without special tokens.
+        cache_dir: Directory of the cache. Defaults to a subdirectory of the Hugging
+            Face datasets cache.
+        num_proc: Number of tokenizer processes. Defaults to up to 8 for large
+            datasets.
+    """
+    key = hashlib.sha256(
+        json.dumps(
+            [
+                CACHE_VERSION,
+                tokenizer_fingerprint(tokenizer),
+                dataset._fingerprint,
+                text_columns,
+                choices_column,
+                single_token_choices,
+            ]
+        ).encode()
+    ).hexdigest()[:32]
+    path = Path(cache_dir or DEFAULT_CACHE_DIR) / key
+    if path.exists():
+        return load_from_disk(str(path))
+
+    if num_proc is None and len(dataset) >= 10_000:
+        num_proc = min(8, os.cpu_count() or 1)
+    tokenized = dataset.map(
+        _tokenize_batch,
+        batched=True,
+        num_proc=num_proc,
+        fn_kwargs=dict(
+            tokenizer=tokenizer,
+            text_columns=text_columns,
+            choices_column=choices_column,
+            single_token_choices=single_token_choices,
+        ),
+        # The tokenizer is covered by the key, so there is no need to hash it
+        new_fingerprint=key,
+        desc="Tokenizing",
+    )
+
+    # Save to a temporary directory first, so that concurrent jobs never load a
+    # partially written cache entry
+    tmp_path = path.with_name(f"{key}.tmp{os.getpid()}")
+    tokenized.save_to_disk(str(tmp_path))
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another job saved the same entry in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return load_from_disk(str(path))
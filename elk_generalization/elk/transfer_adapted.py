@@ -4,13 +4,14 @@ from distutils.util import strtobool
 import os
 
 import torch
-from ccs import CcsConfig, CcsReporter
+from ccs import CcsConfig, fit_reporters
 from crc import CrcReporter
 from mean_diff import MeanDiffReporter
-from lda import LdaReporter
-from lr_classifier import Classifier
+from lda import fit_lda_reporters
+from lr_classifier import BatchedClassifier
 from tqdm import tqdm
 from random_baseline import eval_random_baseline
+from activation_store import ActivationStore, LazyLayers
 from elk_utils import SplitConfig, SegmentConfig, aggregate_segments
 
 if __name__ == "__main__":
@@ -26,6 +27,19 @@ if __name__ == "__main__":
     parser.add_argument("--prevent-skip", action="store_true")
     parser.add_argument("--max-train-examples", type=int, default=4096)
     parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument(
+        "--lr-solver",
+        type=str,
+        choices=["auto", "lbfgs", "newton", "dual"],
+        default="auto",
+        help="Solver of the lr probes. 'newton' factorizes the d x d Hessian, 'dual' works with the n x n Gram matrix "
+        "and is fastest when there are fewer training examples than hidden dimensions. 'auto' picks one from n and d.",
+    )
+    parser.add_argument(
+        "--layers-per-batch",
+        type=int,
+        help="Number of layers whose lr probes, ccs or lda reporters are fit at once. By default a few layers are fit at once; raise it to fit more when memory allows.",
+    )
     parser.add_argument(
         "--label-col",
         type=str,
@@ -102,7 +116,8 @@ if __name__ == "__main__":
         )
 
     train_idx = torch.randperm(len(aggs["labels"]))[:args.max_train_examples]
-    train_hiddens = [hidden[train_idx] for hidden in aggs["hiddens"]]
+    # The training rows of a layer are only gathered when that layer is trained
+    train_hiddens = LazyLayers(len(aggs["hiddens"]), lambda k: aggs["hiddens"][k][train_idx])
     train_labels = aggs[args.label_col][train_idx]
     labels = aggs["labels"][train_idx]
     objective_labels = aggs["objective_labels"][train_idx]
@@ -136,78 +151,82 @@ if __name__ == "__main__":
         print(f"Starting training to predict {args.label_col} on {train_hiddens[0].shape[0]} samples from {len(training_segment_dirs)} splits.")
         print(f"Balancing stats: ol={ol_balance}; ql={ql_balance}; l={l_balance}; ol*ql={ol_ql_balance}; ol*l={ol_l_balance}")
 
-    reporters = []  # one for each layer
-    for layer, train_hidden in tqdm(
-        enumerate(train_hiddens), desc=f"Training on {len(training_segment_dirs)} splits"
-    ):
-        train_hidden = train_hidden.to(args.device).to(dtype)
-        hidden_size = train_hidden.shape[-1]
-
-        if args.reporter == "ccs":
-            # we unsqueeze because CcsReporter expects a variants dimension
-            train_hidden = train_hidden.unsqueeze(1)
-
-            reporter = CcsReporter(
-                cfg=CcsConfig(
-                    bias=True,
-                    loss=["ccs"],
-                    norm="leace",
-                    lr=1e-2,
-                    num_epochs=1000,
-                    num_tries=10,
-                    optimizer="lbfgs",
-                    weight_decay=0.01,
-                ),
-                in_features=hidden_size,
-                num_variants=1,
-                device=args.device,
-                dtype=dtype,
-            )
-
-            reporter.fit(train_hidden)
-            reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
-        elif args.reporter == "crc":
-            # we unsqueeze because CrcReporter expects a variants dimension
-            reporter = CrcReporter(
-                in_features=hidden_size, device=args.device, dtype=dtype
-            )
-            reporter.fit(train_hidden)
+    if args.reporter in {"lr", "lr-on-pair"}:
+        # Fit the probes of all layers in one batched optimization; lr-on-pair concatenates
+        # the positive and negative hiddens
+        classifiers = BatchedClassifier(len(train_hiddens), train_hiddens[0][0].numel(), device=args.device)
+        classifiers.fit_layers(
+            train_hiddens, train_labels, layers_per_batch=args.layers_per_batch, solver=args.lr_solver
+        )
+        if not classifiers.diagnostics.converged.all():
+            unconverged = classifiers.diagnostics.converged.logical_not().nonzero().flatten().tolist()
+            print(f"Warning: the {classifiers.diagnostics.solver} solver didn't converge for layers {unconverged}")
+        reporters = [classifiers[layer] for layer in range(len(classifiers))]
+    elif args.reporter == "ccs":
+        # Fit all tries of the reporters of all layers at once; we unsqueeze because
+        # CcsReporter expects a variants dimension
+        ccs_hiddens = LazyLayers(len(train_hiddens), lambda k: train_hiddens[k].to(args.device).to(dtype).unsqueeze(1))
+        reporters = fit_reporters(
+            CcsConfig(
+                bias=True,
+                loss=["ccs"],
+                norm="leace",
+                lr=1e-2,
+                num_epochs=1000,
+                num_tries=10,
+                optimizer="lbfgs",
+                weight_decay=0.01,
+                parallel_tries=True,
+            ),
+            ccs_hiddens,
+            device=args.device,
+            dtype=dtype,
+            layers_per_batch=args.layers_per_batch,
+        )
+        for reporter, train_hidden in zip(reporters, ccs_hiddens):
             reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
-        elif args.reporter == "lr":
-            reporter = Classifier(input_dim=hidden_size, device=args.device)
-            reporter.fit(train_hidden, train_labels)
-        elif args.reporter == "lr-on-pair":
-            # We train a reporter on the difference between the two hiddens
-            # pos, neg = train_hidden.unbind(-2)
-            # hidden = pos - neg
-            train_hidden = train_hidden.view(train_hidden.shape[0], -1)  # cat positive and negative
-            reporter = Classifier(input_dim=2 * hidden_size, device=args.device)
-            reporter.fit(train_hidden, train_labels)
-        elif args.reporter == "mean-diff":
-            reporter = MeanDiffReporter(in_features=hidden_size, device=args.device, dtype=dtype)
-            reporter.fit(train_hidden, train_labels)
-            reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
-        elif args.reporter == "lda":
-            reporter = LdaReporter(in_features=hidden_size, device=args.device, dtype=dtype)
-            reporter.fit(train_hidden, train_labels)
-            reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
-        elif args.reporter == "random":
-            reporter = None
-        else:
-            raise ValueError(f"Unknown reporter type: {args.reporter}")
+    elif args.reporter == "lda":
+        reporters = fit_lda_reporters(
+            train_hiddens, train_labels, device=args.device, dtype=dtype, layers_per_batch=args.layers_per_batch
+        )
+        for reporter, train_hidden in zip(reporters, train_hiddens):
+            reporter.resolve_sign(labels=train_labels, hiddens=train_hidden.to(args.device).to(dtype))
+    else:
+        reporters = []  # one for each layer
+        for layer, train_hidden in tqdm(
+            enumerate(train_hiddens), desc=f"Training on {len(training_segment_dirs)} splits"
+        ):
+            train_hidden = train_hidden.to(args.device).to(dtype)
+            hidden_size = train_hidden.shape[-1]
+
+            if args.reporter == "crc":
+                # we unsqueeze because CrcReporter expects a variants dimension
+                reporter = CrcReporter(
+                    in_features=hidden_size, device=args.device, dtype=dtype
+                )
+                reporter.fit(train_hidden)
+                reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
+            elif args.reporter == "mean-diff":
+                reporter = MeanDiffReporter(in_features=hidden_size, device=args.device, dtype=dtype)
+                reporter.fit(train_hidden, train_labels)
+                reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
+            elif args.reporter == "random":
+                reporter = None
+            else:
+                raise ValueError(f"Unknown reporter type: {args.reporter}")
 
-        reporters.append(reporter)
+            reporters.append(reporter)
 
     with torch.inference_mode():
         # Test on all splits
         for split_dir in split_dirs:
             test_dir = split_dir / "test"
-            hiddens_file = (
-                "ccs_hiddens.pt"
+            hiddens_name = (
+                "ccs_hiddens"
                 if args.reporter in {"ccs", "crc", "lr-on-pair"}
-                else "hiddens.pt"
+                else "hiddens"
             )
-            test_hiddens = torch.load(test_dir / hiddens_file)
+            test_hiddens = ActivationStore(test_dir, hiddens_name)
             test_labels = (
                 torch.load(test_dir / f"{args.label_col}.pt").to(args.device).int()
             )
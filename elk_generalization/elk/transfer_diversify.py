@@ -1,17 +1,26 @@
 import argparse
 from pathlib import Path
 from distutils.util import strtobool
-import os
 from itertools import combinations
 import torch
-from ccs import CcsConfig, CcsReporter
+from ccs import CcsConfig, fit_reporters
 from crc import CrcReporter
 from mean_diff import MeanDiffReporter
-from lda import LdaReporter
-from lr_classifier import Classifier
+from lda import LdaReporter, fit_lda_reporters
+from lr_classifier import BatchedClassifier
 from tqdm import tqdm
 from random_baseline import eval_random_baseline
+from activation_store import ActivationStore, LazyLayers
+from catalog import Catalog
 from elk_utils import aggregate_datasets, DiversifyTrainingConfig
+from result_store import ResultStore
+from moment_store import MomentStore, merge_moments
+
+
+def with_zero_contrast(hiddens):
+    """Stack (n,d) hiddens with the 0-vector as their contrast, giving (n,2,d)."""
+    return torch.stack([hiddens, torch.zeros_like(hiddens)], dim=1)
+
 
 if __name__ == "__main__":    
     debug = False
@@ -29,6 +38,9 @@ if __name__ == "__main__":
             prevent_skip = True,
             train_examples = 10,
             device = "cpu",
+            lr_solver = "auto",
+            layers_per_batch = None,
+            from_moments = False,
             label_col = "labels",
             verbose=True
             )
@@ -75,6 +87,28 @@ if __name__ == "__main__":
         parser.add_argument("--prevent-skip", action="store_true")
         parser.add_argument("--train-examples", type=int, default=4096)
         parser.add_argument("--device", type=str, default="cuda")
+        parser.add_argument(
+            "--lr-solver",
+            type=str,
+            choices=["auto", "lbfgs", "newton", "dual"],
+            default="auto",
+            help="Solver of the lr probes. 'newton' factorizes the d x d Hessian, 'dual' works with the n x n Gram matrix "
+            "and is fastest when there are fewer training examples than hidden dimensions. 'auto' picks one from n and d.",
+        )
+        parser.add_argument(
+            "--layers-per-batch",
+            type=int,
+            help="Number of layers whose lr probes, ccs or lda reporters are fit at once. By default a few layers are fit at once; raise it to fit more when memory allows.",
+        )
+        parser.add_argument(
+            "--from-moments",
+            action="store_true",
+            help="Fit mean-diff and lda reporters by merging per-class moments of each training dataset, which are "
+            "computed once and cached in <dataset>/<model>/train/moments, instead of passing over the sampled hiddens. "
+            "The moments cover every training example of a dataset rather than a random subsample of "
+            "train_examples / (number of training datasets) examples, but each dataset is weighted as if that many "
+            "examples were drawn from it. The reporters therefore differ from those fit without this flag.",
+        )
         parser.add_argument(
             "--label-col",
             type=str,
@@ -89,7 +123,7 @@ if __name__ == "__main__":
 
     data_dir = Path(args.data_dir) 
     # Expected (input) data structure: data_dir/<train_dataset>/<model>/<train|test>/hiddens.pt
-    # Expected (results) data structure: data_dir/<eval_dataset>/<model>/<train|test>/<training_identifier>/<reporter>_log_odds.pt
+    # Expected (results) data structure: data_dir/results/model=<model>/reporter=<reporter>/part-*.parquet (see result_store.py)
 
     if args.verbose:
         print("Training args: ", args)
@@ -103,8 +137,15 @@ if __name__ == "__main__":
     contrast_individual_norm = args.contrast_norm if args.normalize_contrast_individually else None
     contrast_aggr_norm = None if args.normalize_contrast_individually else args.contrast_norm
     
+    # Discovery and skip checks query the catalog of data_dir instead of the filesystem
+    catalog = Catalog(data_dir, readonly=True)
+    # Results of all runs are appended to a single store, partitioned by model and reporter
+    results = ResultStore(data_dir / "results")
+
     for model in args.models:
         print(f"Starting transfer experiments for {model}.")
+        # (training_identifier, eval_dataset) pairs that already have results
+        done = {reporter_name: results.keys(model, reporter_name, args.label_col) for reporter_name in args.reporters}
         # Iterate through all combinations of training datasets of the given length
         training_dataset_combinations = []
         for n in range(1, args.max_n_train_datasets + 1):
@@ -140,13 +181,7 @@ if __name__ == "__main__":
             for reporter_name in args.reporters:
                 # Skip if results already exist
                 if not args.prevent_skip:
-                    if reporter_name == "random":
-                        results_fname = f"{reporter_name}_aucs_against_labels.pt"
-                    else:
-                        results_fname = f"{reporter_name}_log_odds.pt"
-                    # Expected (results) data structure: data_dir/<eval_dataset>/<model>/<train|test>/<training_identifier>/<reporter>_log_odds.pt
-                    result_files = [data_dir / eval_dataset / model / "test" / training_identifier / results_fname for eval_dataset in args.eval_datasets]
-                    if all([result_file.exists() for result_file in result_files]):
+                    if all((training_identifier, eval_dataset) in done[reporter_name] for eval_dataset in args.eval_datasets):
                         print(f"Skipping run for {training_identifier=} and {reporter_name=} as data already exists.")
                         continue
 
@@ -156,67 +191,83 @@ if __name__ == "__main__":
 
                 selected_train_hiddens = aggs["ccs_hiddens"] if reporter_name in ["ccs", "crc", "lr-on-pair"] else aggs["hiddens"]
 
-                reporters = []  # one for each layer
-                for layer, train_hidden in tqdm(
-                    enumerate(selected_train_hiddens), desc=f"Training"
-                ):
-                    train_hidden = train_hidden.to(args.device).to(dtype)
-                    hidden_size = train_hidden.shape[-1]
-
-                    if reporter_name == "ccs":
-                        # we unsqueeze because CcsReporter expects a variants dimension
-                        train_hidden = train_hidden.unsqueeze(1)
-
-                        reporter = CcsReporter(
-                            cfg=CcsConfig(
-                                bias=True,
-                                loss=["ccs"],
-                                norm=contrast_aggr_norm,
-                                lr=1e-2,
-                                num_epochs=1000,
-                                num_tries=10,
-                                optimizer="lbfgs",
-                                weight_decay=0.01,
-                            ),
-                            in_features=hidden_size,
-                            num_variants=1,
-                            device=args.device,
-                            dtype=dtype,
-                        )
-
-                        reporter.fit(train_hidden)
+                if reporter_name in {"lr", "lr-on-pair"}:
+                    # Fit the probes of all layers in one batched optimization; lr-on-pair concatenates
+                    # the positive and negative hiddens
+                    classifiers = BatchedClassifier(len(selected_train_hiddens), selected_train_hiddens[0][0].numel(), device=args.device)
+                    classifiers.fit_layers(
+                        selected_train_hiddens, train_labels, layers_per_batch=args.layers_per_batch, solver=args.lr_solver
+                    )
+                    if not classifiers.diagnostics.converged.all():
+                        unconverged = classifiers.diagnostics.converged.logical_not().nonzero().flatten().tolist()
+                        print(f"Warning: the {classifiers.diagnostics.solver} solver didn't converge for layers {unconverged}")
+                    reporters = [classifiers[layer] for layer in range(len(classifiers))]
+                elif reporter_name == "ccs":
+                    # Fit all tries of the reporters of all layers at once; we unsqueeze because
+                    # CcsReporter expects a variants dimension
+                    ccs_hiddens = LazyLayers(len(selected_train_hiddens), lambda k: selected_train_hiddens[k].to(args.device).to(dtype).unsqueeze(1))
+                    reporters = fit_reporters(
+                        CcsConfig(
+                            bias=True,
+                            loss=["ccs"],
+                            norm=contrast_aggr_norm,
+                            lr=1e-2,
+                            num_epochs=1000,
+                            num_tries=10,
+                            optimizer="lbfgs",
+                            weight_decay=0.01,
+                            parallel_tries=True,
+                        ),
+                        ccs_hiddens,
+                        device=args.device,
+                        dtype=dtype,
+                        layers_per_batch=args.layers_per_batch,
+                    )
+                    for reporter, train_hidden in zip(reporters, ccs_hiddens):
                         reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
-                    elif reporter_name == "crc":
-                        # we unsqueeze because CrcReporter expects a variants dimension
-                        reporter = CrcReporter(
-                            in_features=hidden_size, device=args.device, dtype=dtype
-                        )
-                        reporter.fit(train_hidden)
-                        reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
-                    elif reporter_name == "lr":
-                        reporter = Classifier(input_dim=hidden_size, device=args.device)
-                        reporter.fit(train_hidden, train_labels)
-                    elif reporter_name == "lr-on-pair":
-                        # We train a reporter on the difference between the two hiddens
-                        # pos, neg = train_hidden.unbind(-2)
-                        # hidden = pos - neg
-                        train_hidden = train_hidden.view(train_hidden.shape[0], -1)  # cat positive and negative
-                        reporter = Classifier(input_dim=2 * hidden_size, device=args.device)
-                        reporter.fit(train_hidden, train_labels)
-                    elif reporter_name == "mean-diff":
-                        reporter = MeanDiffReporter(in_features=hidden_size, device=args.device, dtype=dtype)
-                        reporter.fit(train_hidden, train_labels)
-                        reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
-                    elif reporter_name == "lda":
-                        reporter = LdaReporter(in_features=hidden_size, device=args.device, dtype=dtype)
-                        reporter.fit(train_hidden, train_labels)
-                        reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
-                    elif reporter_name == "random":
-                        reporter = None
-                    else:
-                        raise ValueError(f"Unknown reporter type: {reporter_name}")
+                elif args.from_moments and reporter_name in {"mean-diff", "lda"}:
+                    # Merging the moments of the datasets costs O(d^2) per layer, plus one solve for lda.
+                    # The moments cover all rows of each dataset, rescaled to the size of its subsample
+                    moment_stores = [MomentStore(path, "hiddens", args.label_col, device=args.device) for path in training_paths]
+                    samples_per_dataset = int(args.train_examples / len(training_datasets))
+                    reporter_cls = LdaReporter if reporter_name == "lda" else MeanDiffReporter
+                    reporters = []
+                    for layer in range(len(moment_stores[0])):
+                        moments = merge_moments(store[layer].rescale(samples_per_dataset) for store in moment_stores)
+                        reporter = reporter_cls(in_features=moments.means.shape[-1], device=args.device, dtype=dtype)
+                        reporter.fit_from_moments(moments)
+                        reporters.append(reporter)
+                elif reporter_name == "lda":
+                    reporters = fit_lda_reporters(
+                        selected_train_hiddens, train_labels, device=args.device, dtype=dtype, layers_per_batch=args.layers_per_batch
+                    )
+                    for reporter, train_hidden in zip(reporters, selected_train_hiddens):
+                        reporter.resolve_sign(labels=train_labels, hiddens=train_hidden.to(args.device).to(dtype))
+                else:
+                    reporters = []  # one for each layer
+                    for layer, train_hidden in tqdm(
+                        enumerate(selected_train_hiddens), desc=f"Training"
+                    ):
+                        train_hidden = train_hidden.to(args.device).to(dtype)
+                        hidden_size = train_hidden.shape[-1]
 
-                    reporters.append(reporter)
+                        if reporter_name == "crc":
+                            # we unsqueeze because CrcReporter expects a variants dimension
+                            reporter = CrcReporter(
+                                in_features=hidden_size, device=args.device, dtype=dtype
+                            )
+                            reporter.fit(train_hidden)
+                            reporter.platt_scale(labels=train_labels, hiddens=train_hidden)
+                        elif reporter_name == "mean-diff":
+                            reporter = MeanDiffReporter(in_features=hidden_size, device=args.device, dtype=dtype)
+                            reporter.fit(train_hidden, train_labels)
+                            reporter.resolve_sign(labels=train_labels, hiddens=train_hidden)
+                        elif reporter_name == "random":
+                            reporter = None
+                        else:
+                            raise ValueError(f"Unknown reporter type: {reporter_name}")
+
+                        reporters.append(reporter)
                     
                 # Test
                 if args.verbose: 
@@ -226,29 +277,26 @@ if __name__ == "__main__":
                     for eval_dataset in args.eval_datasets:
                         # Expected (input) data structure: data_dir/<train_dataset>/<model>/<train|test>/hiddens.pt
                         eval_path = data_dir / eval_dataset / model / "test"
-                        # Expected (results) data structure: data_dir/<eval_dataset>/<model>/<train|test>/<training_identifier>/<reporter>_log_odds.pt
-                        results_path = data_dir / eval_dataset / model / "test" / training_identifier
+                        # Memory-mapped on the CPU; each layer is moved to the device when it is used
                         if reporter_name in {"ccs", "crc", "lr-on-pair"}:
-                            hiddens_file = "ccs_hiddens.pt"
-                            if (eval_path / hiddens_file).exists():
+                            if catalog.exists(eval_dataset, model, "test", "ccs_hiddens"):
                                 ccs_hiddens_exist = True
-                                test_hiddens = torch.load(eval_path / hiddens_file, map_location=torch.device(args.device))
+                                test_hiddens = ActivationStore(eval_path, "ccs_hiddens", args.device)
                             else:
                                 ccs_hiddens_exist = False
                                 # To evaluate an unsupervised probe on a dataset that does not have tuples, we use the 0-vector instead of the negated statement
-                                test_hiddens = torch.load(eval_path / "hiddens.pt", map_location=torch.device(args.device)) # list of (n,d) tensors
+                                single_hiddens = ActivationStore(eval_path, "hiddens", args.device) # (n,d) layers
                                 print("Stacking test_hiddens")
-                                test_hiddens = [torch.stack([h, torch.zeros_like(h)], dim=1) for h in test_hiddens] # list of (n,2,d) tensors
+                                test_hiddens = LazyLayers(len(single_hiddens), lambda k: with_zero_contrast(single_hiddens[k])) # (n,2,d) layers
                         else:
-                            hiddens_file = "hiddens.pt"
-                            test_hiddens = torch.load(eval_path / hiddens_file, map_location=torch.device(args.device))
+                            test_hiddens = ActivationStore(eval_path, "hiddens", args.device)
 
                         test_labels = (
                             torch.load(eval_path / f"{args.label_col}.pt", map_location=torch.device(args.device)).int()
                         )
 
                         # lm_log_odds are only available if the samples in the dataset end on choices like e.g. " true" or " false"
-                        lm_log_odds_available = (eval_path / "lm_log_odds.pt").exists()
+                        lm_log_odds_available = catalog.exists(eval_dataset, model, "test", "lm_log_odds")
                         if lm_log_odds_available:
                             lm_log_odds = (
                                 torch.load(eval_path / "lm_log_odds.pt", map_location=torch.device(args.device)).to(dtype)
@@ -286,8 +334,6 @@ if __name__ == "__main__":
                                 log_odds[layer] = reporter(test_hidden).squeeze(-1)
 
 
-                        os.makedirs(results_path, exist_ok = True) 
-
                         if reporter_name == "random":
                             try:
                                 aucs = []
@@ -302,18 +348,12 @@ if __name__ == "__main__":
                                     if args.verbose:
                                         print(f"Layer {layer} random AUC: {auc['mean']}")
                                     aucs.append(auc)
-                                torch.save(
-                                    aucs,
-                                    results_path / f"random_aucs_against_{args.label_col}.pt",
-                                )
+                                results.add_metrics(model, reporter_name, training_identifier, eval_dataset, args.label_col, aucs)
                             except ValueError as e:
                                 print(f"Succesfully finished training but failed computing AUCs with error: {e}")
                         else:
-                            # save the log odds to disk
-                            torch.save(
-                                log_odds,
-                                results_path / f"{reporter_name}_log_odds.pt",
-                            )
+                            # save the log odds to the result store
+                            results.add_log_odds(model, reporter_name, training_identifier, eval_dataset, args.label_col, log_odds)
 
                             try:
                                 if args.verbose:
@@ -341,4 +381,6 @@ if __name__ == "__main__":
                                     else:
                                         print("No LM metrics available as no lm_log_odds were provided.")
                             except ValueError as e:
-                                print(f"Succesfully finished training but failed computing AUCs with error: {e}")
\ No newline at end of file
+                                print(f"Succesfully finished training but failed computing AUCs with error: {e}")
+            # Write the results of this combination, so an interrupted run keeps them
+            results.flush()
@@ -77,6 +77,19 @@ class MMProbe(t.nn.Module):
 
         return probe    
 
+    def from_moments(moments, atol=1e-3, device='cpu'):
+        """Same as from_data, but from the binary class moments of the acts (see
+        elk/moment_store.py), e.g. merged over several datasets. The moments have to be
+        those of the acts from_data would get: shifting all acts by the same vector
+        changes neither the direction nor the covariance, but centering each dataset
+        separately does, so merge moments of the centered acts in that case."""
+        direction = (moments.means[1] - moments.means[0]).float()
+        covariance = moments.within_covariance().float()
+
+        probe = MMProbe(direction, covariance=covariance, atol=atol).to(device)
+
+        return probe
+
 import torch
 from torch import Tensor, nn, optim
 from sklearn.metrics import roc_auc_score
@@ -3,6 +3,8 @@ import pandas as pd
 import os
 from glob import glob
 import random
+from elk_generalization.elk.activation_store import ActivationStore
+from elk_generalization.elk.catalog import Catalog
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 ACTS_BATCH_SIZE = 25
@@ -48,7 +50,11 @@ def collect_acts(hiddens_path, layer, center=True, scale=False, device='cpu'):
     """
     Collects activations from a dataset of statements, returns as a tensor of shape [n_activations, activation_dimension].
     """
-    acts = t.load(hiddens_path / "hiddens.pt")[layer].float().to(device)
+    # Extraction with --layers only saves the requested layers, listed in layers.pt
+    if (hiddens_path / "layers.pt").exists():
+        layer = t.load(hiddens_path / "layers.pt").index(layer)
+    # Only reads this layer from disk, for hiddens saved in either layout
+    acts = ActivationStore(hiddens_path, "hiddens").layer(layer).float().to(device)
     if center:
         acts = acts - t.mean(acts, dim=0)
     if scale:
@@ -94,6 +100,7 @@ class DataManager:
             'val' : {}
         } # dictionary of datasets
         self.root = root
+        self.catalog = Catalog(root, readonly=True) # catalog of the extracted hiddens under root
         self.proj = None # projection matrix for dimensionality reduction
     
     def add_dataset(self, dataset_name, model_name, layer, n_training_samples=None, label='label', split=None, seed=None, center=True, scale=False, device='cpu'):
@@ -104,7 +111,11 @@ class DataManager:
         limit_n is the number of samples. If limit_n is None, then all samples are used
         """
         assert split is None or n_training_samples is None, "Training samples should not be limited by split and limit at once"
-        dataset_path = self.root / dataset_name / model_name / "full"
+        hiddens = self.catalog.get(dataset_name, model_name, "full", "hiddens")
+        assert hiddens is not None, (
+            f"No hiddens of {model_name} on {dataset_name} in the catalog of {self.root}"
+        )
+        dataset_path = hiddens.path.parent
         acts = collect_acts(dataset_path, layer=layer, center=center, scale=scale, device=device)
         labels = t.load(dataset_path / "labels.pt").to(device).float()
 
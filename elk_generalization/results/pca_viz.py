@@ -10,13 +10,18 @@ import plotly.express as px
 import plotly.graph_objects as go
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
+from elk_generalization.elk.activation_store import ActivationStore
 
 
 def collect_acts(hiddens_path, layer, center=True, scale=False, device='cpu'):
     """
     Collects activations from a dataset of statements, returns as a tensor of shape [n_activations, activation_dimension].
     """
-    acts = torch.load(hiddens_path / "hiddens.pt")[layer].float().to(device)
+    # Extraction with --layers only saves the requested layers, listed in layers.pt
+    if (hiddens_path / "layers.pt").exists():
+        layer = torch.load(hiddens_path / "layers.pt").index(layer)
+    # Only reads this layer from disk, for hiddens saved in either layout
+    acts = ActivationStore(hiddens_path, "hiddens").layer(layer).float().to(device)
     if center:
         acts = acts - torch.mean(acts, dim=0)
     if scale:
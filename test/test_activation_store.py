@@ -0,0 +1,157 @@
+import pytest
+import torch
+
+from elk_generalization.elk.activation_store import (
+    ActivationStore,
+    HiddenStateWriter,
+    LazyLayers,
+    QuantizedActivations,
+    convert_to_layer_major,
+    dequantize_layer,
+    load_activations,
+    quantize_layer,
+    save_activations,
+    save_layer_major,
+)
+
+
+def activations(num_layers: int = 3) -> list[torch.Tensor]:
+    """Activations with an outlier channel, like a transformer residual stream."""
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(num_layers):
+        layer = torch.randn(50, 2, 16)
+        layer[..., 3] *= 100
+        layers.append(layer)
+    return layers
+
+
+def test_hidden_state_writer_round_trip(tmp_path):
+    torch.manual_seed(0)
+    layers = torch.randn(3, 10, 2, 4)
+    writer = HiddenStateWriter(tmp_path, "ccs_hiddens", 3, (10, 2, 4), torch.float32)
+    # Batches may arrive in any order, and by index tensor or by slice
+    writer.write(slice(6, 10), layers[:, 6:])
+    writer.write(torch.tensor([0, 2, 4]), layers[:, [0, 2, 4]])
+    writer.write(torch.tensor([1, 3, 5]), layers[:, [1, 3, 5]])
+
+    loaded = writer.load()
+    assert len(loaded) == 3
+    for k in range(3):
+        torch.testing.assert_close(loaded[k], layers[k], atol=0, rtol=0)
+
+    writer.save()
+    assert (tmp_path / "ccs_hiddens.pt").exists()
+    assert not writer.layer_dir.exists()
+
+
+def test_hidden_state_writer_rejects_non_finite(tmp_path):
+    writer = HiddenStateWriter(tmp_path, "hiddens", 1, (2, 3), torch.float32)
+    writer.write(slice(0, 2), torch.full((1, 2, 3), float("inf")))
+
+    with pytest.raises(AssertionError, match="Non-finite"):
+        writer.close()
+
+
+def test_hidden_state_writer_rejects_missing_rows(tmp_path):
+    writer = HiddenStateWriter(tmp_path, "hiddens", 2, (4, 3), torch.bfloat16)
+    writer.write(slice(0, 3), torch.randn(2, 3, 3))
+
+    with pytest.raises(AssertionError, match="never written"):
+        writer.load()
+
+
+def test_int8_error_is_within_half_a_step_per_channel():
+    for layer in activations():
+        quantized = quantize_layer(layer, "int8")
+        error = (dequantize_layer(quantized) - layer).abs()
+
+        # Each channel has its own step size, so the outlier channel does not
+        # coarsen the others
+        step = quantized["scale"]
+        assert (error <= step / 2 + 1e-5 * step.max()).all()
+        assert step[3] > 50 * step[torch.arange(16) != 3].max()
+        assert quantized["error"]["max_abs"] == pytest.approx(error.max().item())
+
+
+def test_float_storage_error_is_within_rounding():
+    layer = activations(1)[0]
+    for storage, eps in (("float16", 2**-11), ("bfloat16", 2**-8)):
+        quantized = quantize_layer(layer, storage)
+        assert quantized["data"].dtype == getattr(torch, storage)
+        error = (dequantize_layer(quantized) - layer).abs()
+        assert (error <= eps * layer.abs()).all()
+
+
+def test_saved_activations_round_trip(tmp_path):
+    layers = activations()
+    for storage in ("native", "float16", "bfloat16", "int8"):
+        path = tmp_path / f"{storage}.pt"
+        save_activations(layers, path, storage)
+        loaded = load_activations(path)
+
+        assert len(loaded) == len(layers)
+        if storage == "native":
+            assert isinstance(loaded, list)
+        else:
+            assert isinstance(loaded, QuantizedActivations)
+            assert len(loaded.errors()) == len(layers)
+        for k, layer in enumerate(layers):
+            if storage != "native":
+                layer = dequantize_layer(quantize_layer(layer, storage))
+            torch.testing.assert_close(loaded[k], layer, atol=0, rtol=0)
+
+
+def test_activation_store_round_trip(tmp_path):
+    layers = activations()
+    for storage in ("native", "float16", "bfloat16", "int8"):
+        for layout in ("file", "layers"):
+            root = tmp_path / f"{storage}_{layout}"
+            root.mkdir()
+            if layout == "file":
+                save_activations(layers, root / "hiddens.pt", storage)
+            else:
+                save_layer_major(layers, root / "hiddens", storage)
+            store = ActivationStore(root, "hiddens")
+
+            assert len(store) == len(layers)
+            assert len(store.errors()) == (0 if storage == "native" else len(layers))
+            for k in reversed(range(len(layers))):
+                expected = layers[k]
+                if storage != "native":
+                    expected = dequantize_layer(quantize_layer(expected, storage))
+                torch.testing.assert_close(store.layer(k), expected, atol=0, rtol=0)
+
+            # Writes to a layer and assigned layers never reach the saved files
+            store.layer(0).zero_()
+            store[1] = torch.zeros(1)
+            reopened = ActivationStore(root, "hiddens")
+            assert reopened.layer(0).abs().sum() > 0
+            assert reopened.layer(1).shape == layers[1].shape
+
+
+def test_convert_to_layer_major(tmp_path):
+    layers = [layer.bfloat16() for layer in activations()]
+    save_activations(layers, tmp_path / "hiddens.pt")
+
+    convert_to_layer_major(tmp_path / "hiddens.pt", remove_original=True)
+
+    assert not (tmp_path / "hiddens.pt").exists()
+    store = ActivationStore(tmp_path, "hiddens")
+    for k, layer in enumerate(layers):
+        torch.testing.assert_close(store[k], layer, atol=0, rtol=0)
+
+
+def test_lazy_layers_load_each_accessed_layer_once():
+    loads = []
+
+    def load(k):
+        loads.append(k)
+        return torch.full((2,), float(k))
+
+    layers = LazyLayers(4, load)
+    assert len(layers) == 4 and loads == []
+    for _ in range(3):
+        assert layers[2].tolist() == [2.0, 2.0]
+    assert [layer[0].item() for layer in layers[-2:]] == [2.0, 3.0]
+    assert loads == [2, 3]
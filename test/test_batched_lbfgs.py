@@ -0,0 +1,47 @@
+import torch
+
+from elk_generalization.elk.batched_lbfgs import batched_lbfgs
+
+
+def quadratics(b: int = 4, p: int = 5):
+    """Losses of B positive definite quadratics, and their minima."""
+    torch.manual_seed(0)
+    a = torch.randn(b, p, p, dtype=torch.float64)
+    a = a @ a.mT + torch.eye(p, dtype=torch.float64)
+    v = torch.randn(b, p, dtype=torch.float64)
+
+    def fn(x, index):
+        quadratic = torch.einsum("bi,bij,bj->b", x, a[index], x)
+        return quadratic / 2 - (v[index] * x).sum(-1)
+
+    return fn, torch.linalg.solve(a, v)
+
+
+def test_rows_converge_to_their_minima():
+    fn, minima = quadratics()
+
+    x, loss, iterations, converged = batched_lbfgs(fn, torch.zeros_like(minima))
+
+    assert converged.all()
+    # Rows stop once their loss changes by less than the default tolerance of 1e-9
+    torch.testing.assert_close(x, minima, atol=1e-4, rtol=0)
+    torch.testing.assert_close(loss, fn(minima, torch.arange(4)), atol=1e-9, rtol=0)
+    # The rows are independent, so each takes as many iterations as on its own
+    for row in range(4):
+        _, _, alone, _ = batched_lbfgs(
+            lambda x, index: fn(x, index + row), torch.zeros_like(minima[row : row + 1])
+        )
+        assert alone.item() == iterations[row].item()
+
+
+def test_iterations_of_rows_that_converge_in_the_last_iteration():
+    fn, minima = quadratics()
+    x0 = torch.zeros_like(minima)
+    _, _, iterations, _ = batched_lbfgs(fn, x0)
+    assert len(iterations.unique()) > 1
+
+    for max_iter in iterations.unique().tolist():
+        _, _, capped, converged = batched_lbfgs(fn, x0, max_iter=max_iter)
+        # Rows converging in the last allowed iteration took all of them
+        assert converged.tolist() == (iterations <= max_iter).tolist()
+        assert capped.tolist() == iterations.clamp(max=max_iter).tolist()
@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+import torch
+
+from elk_generalization.elk.activation_store import save_layer_major
+from elk_generalization.elk.catalog import CATALOG_FILE, Catalog, find_data_root
+
+
+def save_split(split_dir, n: int = 6, d: int = 4):
+    """A split with layer-major hiddens, .pt contrast hiddens, labels and log odds."""
+    split_dir.mkdir(parents=True)
+    save_layer_major([torch.randn(n, d) for _ in range(2)], split_dir / "hiddens")
+    torch.save([torch.randn(n, 2, d) for _ in range(2)], split_dir / "ccs_hiddens.pt")
+    torch.save(torch.ones(n, dtype=torch.int32), split_dir / "labels.pt")
+    (split_dir / "run").mkdir()
+    torch.save(torch.zeros(2, n), split_dir / "run" / "lr_log_odds.pt")
+
+
+def test_record_split_and_query(tmp_path):
+    split_dir = tmp_path / "got/cities" / "meta-llama/Llama-2-7b-hf" / "train"
+    save_split(split_dir)
+    catalog = Catalog(tmp_path)
+
+    keys = catalog.split_keys(split_dir, "meta-llama/Llama-2-7b-hf")
+    assert keys == ("got/cities", "meta-llama/Llama-2-7b-hf", "train")
+    recorded = catalog.record_split(*keys, split_dir)
+
+    names = ["ccs_hiddens", "hiddens", "labels", "run/lr_log_odds"]
+    assert [artifact.name for artifact in recorded] == names
+    hiddens = catalog.get(*keys, "hiddens")
+    assert hiddens.layout == "layers" and hiddens.storage == "native"
+    assert (hiddens.num_layers, hiddens.num_examples, hiddens.hidden_size) == (2, 6, 4)
+    assert hiddens.path == split_dir / "hiddens"
+    ccs_hiddens = catalog.get(*keys, "ccs_hiddens")
+    assert ccs_hiddens.layout == "file" and ccs_hiddens.shape == (6, 2, 4)
+    assert catalog.get(*keys, "labels").dtype == "int32"
+    assert catalog.exists(*keys) and not catalog.exists(*keys, "neg_hiddens")
+    assert len(catalog.find(model="meta-llama/Llama-2-7b-hf")) == 4
+    assert find_data_root(split_dir) == tmp_path
+
+    # A changed artifact fails verification and can be forgotten
+    assert all(artifact.verify() for artifact in recorded)
+    torch.save(torch.ones(7, dtype=torch.int32), split_dir / "labels.pt")
+    assert not catalog.get(*keys, "labels").verify()
+    catalog.remove(*keys, "labels")
+    assert not catalog.exists(*keys, "labels")
+
+
+def test_readonly_catalog(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No catalog"):
+        Catalog(tmp_path / "data", readonly=True)
+    assert not (tmp_path / "data").exists()
+
+    split_dir = tmp_path / "data" / "a" / "m" / "test"
+    save_split(split_dir)
+    Catalog(tmp_path / "data").record_split("a", "m", "test")
+
+    reader = Catalog(tmp_path / "data", readonly=True)
+    assert reader.exists("a", "m", "test", "ccs_hiddens")
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        reader.record("a", "m", "test", "labels")
+
+
+def test_index_backfills_new_artifacts_of_finished_splits(tmp_path):
+    for split in ("train", "test"):
+        save_split(tmp_path / "a" / "m" / split)
+    # An extraction of the test split is still running
+    (tmp_path / "a" / "m" / "test" / "progress.json").write_text("{}")
+    catalog = Catalog(tmp_path)
+
+    assert catalog.index(["a", "b"], ["m"], ["train", "test"]) == 4
+    assert {a.split for a in catalog.find()} == {"train"}
+    assert all(artifact.checksum is None for artifact in catalog.find())
+    # Catalogued artifacts are skipped, new ones are added
+    assert catalog.index(["a"], ["m"], ["train"]) == 0
+    torch.save(torch.zeros(6), tmp_path / "a" / "m" / "train" / "lm_log_odds.pt")
+    assert catalog.index(["a"], ["m"], ["train"]) == 1
+    assert (tmp_path / CATALOG_FILE).exists()
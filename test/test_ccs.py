@@ -0,0 +1,67 @@
+import torch
+
+from elk_generalization.elk.ccs import (
+    CcsConfig,
+    CcsReporter,
+    fit_reporters,
+    fit_tries,
+)
+
+
+def contrast_pairs(n: int = 64, d: int = 8) -> torch.Tensor:
+    """Contrast pairs of shape (n, 1, 2, d) that differ along a random direction."""
+    truth = torch.randint(0, 2, (n,)) * 2 - 1.0
+    direction = torch.randn(d)
+    z = torch.randn(n, d)
+    x_neg = z - truth[:, None] * direction
+    x_pos = z + truth[:, None] * direction
+    return torch.stack([x_neg, x_pos], dim=1)[:, None].double()
+
+
+def test_fit_tries_matches_fit():
+    torch.manual_seed(0)
+    hiddens = contrast_pairs()
+    # A few Adam steps from the PCA initialization stay close to it
+    settings = [("lbfgs", "default", 200), ("adam", "default", 200), ("adam", "pca", 3)]
+    for optimizer, init, num_epochs in settings:
+        cfg = CcsConfig(
+            num_tries=3, num_epochs=num_epochs, optimizer=optimizer, init=init
+        )
+
+        # Both draw the initializations of the tries in the same order
+        torch.manual_seed(1)
+        sequential = CcsReporter(cfg, hiddens.shape[-1], dtype=torch.float64)
+        loss = sequential.fit(hiddens)
+
+        torch.manual_seed(1)
+        parallel = CcsReporter(cfg, hiddens.shape[-1], dtype=torch.float64)
+        x_neg, x_pos = parallel.fit_norm(hiddens)
+        (parallel_loss,) = fit_tries([parallel], x_neg[None], x_pos[None]).tolist()
+
+        assert abs(parallel_loss - loss) < 1e-6
+        torch.testing.assert_close(
+            parallel.probe.weight, sequential.probe.weight, atol=1e-6, rtol=0
+        )
+        torch.testing.assert_close(
+            parallel.probe.bias, sequential.probe.bias, atol=1e-6, rtol=0
+        )
+
+
+def test_fit_reporters_in_batches_matches_single_batch():
+    torch.manual_seed(0)
+    hiddens = [contrast_pairs(n=32, d=4) for _ in range(5)]
+    cfg = CcsConfig(num_tries=2, num_epochs=100)
+
+    torch.manual_seed(1)
+    reference = fit_reporters(cfg, hiddens, dtype=torch.float64, layers_per_batch=5)
+    # The default batch size, and one that doesn't divide the layers
+    for layers_per_batch in (None, 2):
+        torch.manual_seed(1)
+        reporters = fit_reporters(
+            cfg, hiddens, dtype=torch.float64, layers_per_batch=layers_per_batch
+        )
+        assert len(reporters) == len(hiddens)
+        for reporter, expected in zip(reporters, reference):
+            torch.testing.assert_close(
+                reporter.probe.weight, expected.probe.weight, atol=1e-6, rtol=0
+            )
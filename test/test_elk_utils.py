@@ -0,0 +1,88 @@
+import torch
+
+from elk_generalization.elk.activation_store import save_layer_major
+from elk_generalization.elk.elk_utils import (
+    aggregate_datasets,
+    aggregate_segments,
+    normalize_ccs_hiddens,
+)
+
+
+def make_split(path, n: int, num_layers: int = 3, d: int = 8, layer_major=False):
+    """A split with random hiddens, contrast hiddens and labels."""
+    path.mkdir(parents=True)
+    hiddens = [torch.randn(n, d) for _ in range(num_layers)]
+    ccs_hiddens = [torch.randn(n, 2, d) for _ in range(num_layers)]
+    if layer_major:
+        save_layer_major(hiddens, path / "hiddens")
+        save_layer_major(ccs_hiddens, path / "ccs_hiddens")
+    else:
+        torch.save(hiddens, path / "hiddens.pt")
+        torch.save(ccs_hiddens, path / "ccs_hiddens.pt")
+    torch.save(torch.randint(0, 2, (n,)), path / "labels.pt")
+    return hiddens, ccs_hiddens
+
+
+def eager_aggregate(splits, indices, contrast_norm=None):
+    """Loads and concatenates all layers up front, as aggregate_datasets used to."""
+    hiddens, ccs_hiddens = [], []
+    for (split_hiddens, split_ccs_hiddens), rows in zip(splits, indices):
+        if contrast_norm:
+            split_ccs_hiddens = [
+                normalize_ccs_hiddens(h.unsqueeze(1), norm=contrast_norm)[0].squeeze(1)
+                for h in split_ccs_hiddens
+            ]
+        hiddens.append([h[rows] for h in split_hiddens])
+        ccs_hiddens.append([h[rows] for h in split_ccs_hiddens])
+    return (
+        [torch.cat(layers) for layers in zip(*hiddens)],
+        [torch.cat(layers) for layers in zip(*ccs_hiddens)],
+    )
+
+
+def test_lazy_aggregate_matches_eager_aggregate(tmp_path):
+    torch.manual_seed(0)
+    paths = [tmp_path / "a", tmp_path / "b"]
+    splits = [make_split(paths[0], 20), make_split(paths[1], 30, layer_major=True)]
+
+    # The LEACE eraser of each dataset is fit to its moments in float64 rather than
+    # to its hiddens in float32
+    for contrast_norm, atol in ((None, 0), ("burns", 0), ("leace", 1e-5)):
+        torch.manual_seed(1)
+        out = aggregate_datasets(
+            paths,
+            ["labels"],
+            "cpu",
+            samples_per_dataset=10,
+            contrast_norm=contrast_norm,
+        )
+        # The rows are drawn in the same order as aggregate_datasets draws them
+        torch.manual_seed(1)
+        indices = [torch.randperm(20)[:10], torch.randperm(30)[:10]]
+        hiddens, ccs_hiddens = eager_aggregate(splits, indices, contrast_norm)
+
+        assert len(out["hiddens"]) == len(out["ccs_hiddens"]) == 3
+        # Layers are accessed out of order, and repeatedly
+        for k in (2, 0, 0, 1):
+            torch.testing.assert_close(out["hiddens"][k], hiddens[k])
+            torch.testing.assert_close(
+                out["ccs_hiddens"][k], ccs_hiddens[k], atol=atol, rtol=atol
+            )
+        labels = [torch.load(p / "labels.pt")[rows] for p, rows in zip(paths, indices)]
+        assert out["labels"].tolist() == torch.cat(labels).tolist()
+
+
+def test_lazy_segments_match_eager_concatenation(tmp_path):
+    torch.manual_seed(0)
+    paths = [tmp_path / "a", tmp_path / "b"]
+    splits = [
+        make_split(paths[0] / "test", 5),
+        make_split(paths[1] / "test", 7, layer_major=True),
+    ]
+
+    out = aggregate_segments(paths, ["labels"], "ccs", "cpu", "test")
+
+    assert len(out["hiddens"]) == 3
+    for k in range(3):
+        expected = torch.cat([ccs_hiddens[k] for _, ccs_hiddens in splits])
+        torch.testing.assert_close(out["hiddens"][k], expected)
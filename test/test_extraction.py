@@ -0,0 +1,192 @@
+import random
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from elk_generalization.elk.activation_store import HiddenStateWriter
+from elk_generalization.elk.extraction import (
+    ExtractionProgress,
+    SharedPrefix,
+    forward_batch,
+    forward_pair_batch,
+    lm_log_odds_batch,
+    plan_batches,
+)
+
+
+def tiny_llama() -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def random_prompts(rng: random.Random, n: int, min_len: int, max_len: int):
+    """Prompts of different lengths, so that a batch of them is padded."""
+    return [
+        [rng.randrange(1, 64) for _ in range(rng.randrange(min_len, max_len))]
+        for _ in range(n)
+    ]
+
+
+@torch.inference_mode()
+def last_token_hiddens(model, prompt: list[int]) -> torch.Tensor:
+    """Hidden states of the last token of an unpadded prompt, of shape (L, d)."""
+    outputs = model(torch.as_tensor([prompt]), output_hidden_states=True)
+    return torch.stack([state[0, -1] for state in outputs.hidden_states[1:]])
+
+
+def test_plan_batches_respects_token_budget():
+    rng = random.Random(0)
+    lengths = [rng.randrange(1, 40) for _ in range(100)] + [80]
+
+    batches = plan_batches(lengths, batch_size=8, max_tokens=64)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= 8
+        padded = len(batch) * max(lengths[i] for i in batch)
+        # Only an example longer than the budget may exceed it, alone
+        assert padded <= 64 or len(batch) == 1
+    assert batches[0] == [100]
+    # Without a budget, consecutive examples are batched
+    unbucketed = plan_batches(lengths[:10], batch_size=4)
+    assert unbucketed == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_forward_batch_matches_unpadded_forward():
+    model = tiny_llama()
+    rng = random.Random(0)
+    prompts = random_prompts(rng, 5, 1, 9)
+    choices = [[rng.randrange(1, 64), rng.randrange(1, 64)] for _ in prompts]
+
+    out = forward_batch(model, prompts, choices, pad_id=0, ccs_hiddens=False)
+
+    for i, (prompt, (c0, c1)) in enumerate(zip(prompts, choices)):
+        expected = last_token_hiddens(model, prompt)
+        torch.testing.assert_close(out["hiddens"][:, i], expected, atol=1e-5, rtol=1e-5)
+        with torch.inference_mode():
+            logits = model(torch.as_tensor([prompt])).logits[0, -1]
+        torch.testing.assert_close(
+            out["log_odds"][i], logits[c1] - logits[c0], atol=1e-5, rtol=1e-5
+        )
+
+
+def test_lm_log_odds_batch_matches_forward_batch():
+    model = tiny_llama()
+    rng = random.Random(3)
+    prompts = random_prompts(rng, 6, 1, 9)
+    choices = [[rng.randrange(1, 64), rng.randrange(1, 64)] for _ in prompts]
+
+    log_odds = lm_log_odds_batch(model, prompts, choices, pad_id=0)
+
+    out = forward_batch(model, prompts, choices, pad_id=0, ccs_hiddens=False)
+    torch.testing.assert_close(log_odds, out["log_odds"], atol=1e-5, rtol=1e-5)
+
+
+def test_contrast_hiddens_match_prompt_plus_choice():
+    model = tiny_llama()
+    rng = random.Random(0)
+    prompts = random_prompts(rng, 5, 1, 9)
+    choices = [[rng.randrange(1, 64), rng.randrange(1, 64)] for _ in prompts]
+
+    out = forward_batch(model, prompts, choices, pad_id=0)
+
+    # Both choices are scored on one expanded copy of the padded prompt cache
+    for i, prompt in enumerate(prompts):
+        for k, choice in enumerate(choices[i]):
+            expected = last_token_hiddens(model, prompt + [choice])
+            torch.testing.assert_close(
+                out["ccs_hiddens"][:, i, k], expected, atol=1e-5, rtol=1e-5
+            )
+
+
+def test_forward_batch_selected_layers():
+    model = tiny_llama()
+    prompts = random_prompts(random.Random(1), 4, 2, 7)
+    expected = torch.stack([last_token_hiddens(model, p) for p in prompts], dim=1)
+
+    # The hooks capture the top layer after the final norm, and the forward pass
+    # stops after the highest requested layer
+    for layers in ([2, 0], [1]):
+        out = forward_batch(model, prompts, None, pad_id=0, layers=layers)
+        assert out.keys() == {"hiddens"}
+        torch.testing.assert_close(
+            out["hiddens"], expected[sorted(layers)], atol=1e-5, rtol=1e-5
+        )
+
+
+def test_shared_prefix_matches_full_forward():
+    model = tiny_llama()
+    rng = random.Random(0)
+    prefix = [rng.randrange(1, 64) for _ in range(7)]
+    suffixes = random_prompts(rng, 5, 1, 6)
+    choices = [[rng.randrange(1, 64), rng.randrange(1, 64)] for _ in suffixes]
+
+    full = forward_batch(model, [prefix + s for s in suffixes], choices, pad_id=0)
+    shared = forward_batch(
+        model, suffixes, choices, pad_id=0, prefix=SharedPrefix(model, prefix)
+    )
+
+    assert full.keys() == shared.keys() == {"hiddens", "ccs_hiddens", "log_odds"}
+    for key in full:
+        torch.testing.assert_close(shared[key], full[key], atol=1e-5, rtol=1e-5)
+
+
+def test_forward_pair_batch_matches_unpadded_forward():
+    model = tiny_llama()
+    rng = random.Random(2)
+    # Pairs of statements that differ after a shared prefix of varying length
+    prefixes = random_prompts(rng, 4, 1, 8)
+    prompts = [p + s for p, s in zip(prefixes, random_prompts(rng, 4, 1, 4))]
+    pair_prompts = [p + s for p, s in zip(prefixes, random_prompts(rng, 4, 1, 4))]
+    # Pairs that share no token fall back to two separate batches
+    unshared = [[1, 2, 3], [4, 5]], [[6, 7], [8, 9, 10]]
+
+    for firsts, seconds in (prompts, pair_prompts), unshared:
+        hiddens, pair_hiddens = forward_pair_batch(model, firsts, seconds, pad_id=0)
+        for i, (first, second) in enumerate(zip(firsts, seconds)):
+            torch.testing.assert_close(
+                hiddens[:, i], last_token_hiddens(model, first), atol=1e-5, rtol=1e-5
+            )
+            torch.testing.assert_close(
+                pair_hiddens[:, i],
+                last_token_hiddens(model, second),
+                atol=1e-5,
+                rtol=1e-5,
+            )
+
+
+def test_extraction_resumes_at_the_first_unfinished_shard(tmp_path):
+    hiddens = torch.randn(2, 10, 4)
+    progress = ExtractionProgress(tmp_path, shard_size=4)
+    seed = progress.seed()
+    progress.start(10)
+    writer = HiddenStateWriter(tmp_path, "hiddens", 2, (10, 4), torch.float32)
+    first = progress.pending_shards()[0]
+    rows = slice(first.start, first.stop)
+    writer.write(rows, hiddens[:, rows])
+    progress.mark_done(first, [writer])
+    # The job is interrupted here, with a half-written second shard
+    writer.write(slice(4, 6), hiddens[:, 4:6])
+
+    progress = ExtractionProgress(tmp_path, shard_size=4)
+    assert progress.resumed and progress.seed(seed + 1) == seed
+    progress.start(10)
+    writer = HiddenStateWriter(
+        tmp_path, "hiddens", 2, (10, 4), torch.float32, resume=True
+    )
+    pending = progress.pending_shards()
+    assert pending == [range(4, 8), range(8, 10)]
+    for shard in pending:
+        rows = slice(shard.start, shard.stop)
+        writer.write(rows, hiddens[:, rows])
+        progress.mark_done(shard, [writer])
+
+    torch.testing.assert_close(torch.stack(writer.load()), hiddens, atol=0, rtol=0)
@@ -0,0 +1,67 @@
+import torch
+from concept_erasure.shrinkage import optimal_linear_shrinkage
+
+from elk_generalization.elk.lda import (
+    _shrinkage,
+    fit_lda_reporters,
+    shrunk_lda_weights,
+)
+
+
+def labelled_hiddens(num_layers: int, n: int, d: int):
+    torch.manual_seed(0)
+    y = torch.arange(n) % 2
+    # Anisotropic hiddens whose class means differ
+    x = torch.randn(num_layers, n, d, dtype=torch.float64) * torch.linspace(0.5, 2, d)
+    return x + y[:, None].double(), y
+
+
+def reference_weights(x, y):
+    """S^-1 (mu1 - mu0) with the shrunk covariance of `optimal_linear_shrinkage`."""
+    y = y.bool()
+    mu0, mu1 = x[:, ~y].mean(1), x[:, y].mean(1)
+    centered = x - torch.where(y[None, :, None], mu1[:, None], mu0[:, None])
+    cov = centered.mT @ centered / x.shape[1]
+    shrunk = optimal_linear_shrinkage(cov, x.shape[1])
+    return torch.linalg.solve(shrunk, mu1 - mu0)
+
+
+def test_shrinkage_matches_optimal_linear_shrinkage():
+    for n, d in ((50, 10), (10, 50)):
+        x, _ = labelled_hiddens(3, n, d)
+        centered = x - x.mean(1, keepdim=True)
+        cov = centered.mT @ centered / n
+
+        alpha, ridge = _shrinkage(cov, n, d)
+
+        shrunk = alpha[:, None, None] * cov + ridge[:, None, None] * torch.eye(d)
+        torch.testing.assert_close(shrunk, optimal_linear_shrinkage(cov, n))
+        assert ((alpha > 0) & (alpha < 1)).all()
+        # The coefficients only depend on the trace and Frobenius norm, which the
+        # Gram matrix shares with the covariance
+        gram = centered @ centered.mT / n
+        for gram_coef, cov_coef in zip(_shrinkage(gram, n, d), (alpha, ridge)):
+            torch.testing.assert_close(gram_coef, cov_coef)
+
+
+def test_woodbury_and_cholesky_weights_match_explicit_solve():
+    # Fewer samples than dimensions use the Woodbury identity, more use Cholesky
+    for n, d in ((16, 40), (40, 16)):
+        x, y = labelled_hiddens(3, n, d)
+
+        w = shrunk_lda_weights(x, y)
+
+        torch.testing.assert_close(w, reference_weights(x, y))
+
+
+def test_fit_lda_reporters_in_batches():
+    x, y = labelled_hiddens(11, 30, 6)
+    expected = shrunk_lda_weights(x, y)
+
+    # The default batch size, and one that doesn't divide the layers
+    for layers_per_batch in (None, 4):
+        reporters = fit_lda_reporters(
+            list(x), y, dtype=torch.float64, layers_per_batch=layers_per_batch
+        )
+        weights = torch.cat([reporter.linear.weight.data for reporter in reporters])
+        torch.testing.assert_close(weights, expected)
@@ -0,0 +1,80 @@
+import torch
+
+from elk_generalization.elk.lr_classifier import (
+    BatchedClassifier,
+    Classifier,
+    logistic_loss_and_grad_norm,
+    newton_logistic,
+)
+
+
+def objective(x, y, weight, bias, l2_penalty):
+    """The regularized loss minimized by all solvers, shape (L,)."""
+    loss, _ = logistic_loss_and_grad_norm(x, y, weight, bias, l2_penalty)
+    return loss + l2_penalty * weight.square().sum(-1)
+
+
+def binary_problems(num_layers: int, n: int, d: int):
+    torch.manual_seed(0)
+    x = torch.randn(num_layers, n, d, dtype=torch.float64)
+    noise = 0.5 * torch.randn(num_layers, n, dtype=torch.float64)
+    return x, (x[..., 0] + noise > 0).double()
+
+
+def test_batched_solvers_match_lbfgs_classifier():
+    num_layers, d = 3, 10
+    x, y = binary_problems(num_layers, 40, d)
+
+    weights, biases = [], []
+    for k in range(num_layers):
+        classifier = Classifier(d, dtype=torch.float64)
+        classifier.fit(x[k], y[k], l2_penalty=0.01)
+        assert classifier.diagnostics.solver == "lbfgs"
+        weights.append(classifier.linear.weight.data[0])
+        biases.append(classifier.linear.bias.data[0])
+    weight, bias = torch.stack(weights), torch.stack(biases)
+    reference = objective(x, y, weight, bias, 0.01)
+
+    for solver in ("lbfgs", "newton", "dual"):
+        batched = BatchedClassifier(num_layers, d, dtype=torch.float64)
+        batched.fit(x, y, l2_penalty=0.01, solver=solver)
+        assert batched.diagnostics.converged.all()
+        # The tolerances of `torch.optim.LBFGS` limit the precision of the reference
+        torch.testing.assert_close(batched.weight.data, weight, atol=1e-3, rtol=0)
+        torch.testing.assert_close(batched.bias.data, bias, atol=1e-3, rtol=0)
+        torch.testing.assert_close(
+            objective(x, y, batched.weight.data, batched.bias.data, 0.01),
+            reference,
+            atol=1e-7,
+            rtol=0,
+        )
+
+    # Both Newton solvers converge to the same optimum
+    primal_weight, primal_bias, _, _ = newton_logistic(x, y, 0.01)
+    dual_weight, dual_bias, _, _ = newton_logistic(x, y, 0.01, dual=True)
+    torch.testing.assert_close(dual_weight, primal_weight, atol=1e-10, rtol=0)
+    torch.testing.assert_close(dual_bias, primal_bias, atol=1e-10, rtol=0)
+
+
+def test_fit_layers_in_batches_matches_fit():
+    num_layers, d = 11, 6
+    x, y = binary_problems(num_layers, 30, d)
+    # Labels shared by all layers, as for the hiddens of one dataset
+    y = y[0]
+
+    reference = BatchedClassifier(num_layers, d, dtype=torch.float64)
+    reference.fit(x, y, l2_penalty=0.01, solver="lbfgs")
+
+    # In batches of the default size, and of a size that doesn't divide the layers
+    for layers_per_batch in (None, 4):
+        batched = BatchedClassifier(num_layers, d, dtype=torch.float64)
+        loss = batched.fit_layers(
+            list(x),
+            y,
+            l2_penalty=0.01,
+            solver="lbfgs",
+            layers_per_batch=layers_per_batch,
+        )
+        assert loss.shape == batched.diagnostics.converged.shape == (num_layers,)
+        torch.testing.assert_close(batched.weight.data, reference.weight.data)
+        torch.testing.assert_close(batched.bias.data, reference.bias.data)
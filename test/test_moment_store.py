@@ -0,0 +1,58 @@
+import torch
+
+from elk_generalization.elk.activation_store import save_layer_major
+from elk_generalization.elk.moment_store import ClassMoments, MomentStore, merge_moments
+from elk_generalization.got_code.probes import MMProbe
+
+
+def test_merge_matches_fit_on_concatenated_data():
+    torch.manual_seed(0)
+    x = torch.randn(100, 6, dtype=torch.float64) + 3
+    classes = torch.randint(0, 2, (100,))
+    # The last part has samples of a single class
+    classes[90:] = 1
+    parts = [slice(0, 7), slice(7, 90), slice(90, 100)]
+
+    merged = merge_moments(ClassMoments.fit(x[part], classes[part]) for part in parts)
+    full = ClassMoments.fit(x, classes, chunk_size=16)
+
+    torch.testing.assert_close(merged.counts, full.counts)
+    torch.testing.assert_close(merged.means, full.means)
+    torch.testing.assert_close(merged.scatters, full.scatters)
+    torch.testing.assert_close(merged.covariance(), x.T.cov(correction=0))
+
+
+def test_moment_store_computes_each_layer_once(tmp_path):
+    torch.manual_seed(0)
+    layers = [torch.randn(50, 4) for _ in range(3)]
+    save_layer_major(layers, tmp_path / "hiddens")
+    labels = torch.randint(0, 2, (50,))
+    torch.save(labels, tmp_path / "labels.pt")
+    store = MomentStore(tmp_path, chunk_size=8)
+
+    moments = store[1]
+
+    expected = ClassMoments.fit(layers[1], labels)
+    torch.testing.assert_close(moments.means, expected.means)
+    torch.testing.assert_close(moments.scatters, expected.scatters)
+    assert [p.name for p in store.path.iterdir()] == ["layer_001.pt"]
+    # Later accesses load the saved moments
+    torch.save(torch.zeros(50, dtype=torch.long), tmp_path / "labels.pt")
+    torch.testing.assert_close(store[1].means, expected.means)
+
+
+def test_mm_probe_from_moments_matches_from_data():
+    torch.manual_seed(0)
+    acts = torch.randn(80, 5) + torch.arange(5.0)
+    labels = torch.randint(0, 2, (80,))
+    acts[labels == 1] += 1
+
+    moments = merge_moments(
+        ClassMoments.fit(acts[part], labels[part])
+        for part in (slice(0, 30), slice(30, None))
+    )
+    probe = MMProbe.from_moments(moments)
+    reference = MMProbe.from_data(acts, labels)
+
+    torch.testing.assert_close(probe.direction, reference.direction)
+    torch.testing.assert_close(probe.inv, reference.inv, atol=1e-4, rtol=1e-4)
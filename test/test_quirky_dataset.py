@@ -0,0 +1,68 @@
+import random
+from types import SimpleNamespace
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from elk_generalization.datasets.quirky_dataset import QuirkyDataset
+from elk_generalization.elk.extraction import estimate_model_bytes
+
+
+@torch.inference_mode()
+def reference_log_odds(model, prompt: list[int], choices: list[list[int]]):
+    """Log odds of the second choice from unpadded forwards of prompt + choice."""
+    scores = []
+    for choice in choices:
+        logits = model(torch.as_tensor([prompt + choice])).logits[0]
+        logprobs = logits[len(prompt) - 1 : -1].float().log_softmax(-1)
+        scores.append(logprobs.gather(1, torch.as_tensor(choice)[:, None]).sum())
+    return scores[1] - scores[0]
+
+
+def test_get_log_odds_matches_single_prompt_reference():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    model = LlamaForCausalLM(config).eval()
+    tokenizer = SimpleNamespace(pad_token_id=0, eos_token_id=None)
+
+    rng = random.Random(0)
+    prompts = [
+        [rng.randrange(1, 64) for _ in range(rng.randrange(1, 8))] for _ in range(5)
+    ]
+    # Single- and multi-token choices of different lengths in the same batch
+    choice_toks = [
+        [[rng.randrange(1, 64) for _ in range(rng.randrange(1, 4))] for _ in range(2)]
+        for _ in prompts
+    ]
+
+    log_odds = QuirkyDataset._get_log_odds(model, tokenizer, prompts, choice_toks)
+
+    expected = torch.stack(
+        [reference_log_odds(model, p, c) for p, c in zip(prompts, choice_toks)]
+    )
+    torch.testing.assert_close(log_odds, expected, atol=1e-5, rtol=1e-5)
+
+
+def test_plan_concurrent_groups_fits_budget(tmp_path):
+    names, sizes = [], []
+    for i, layers in enumerate([2, 2, 8, 2]):
+        config = LlamaConfig(
+            vocab_size=64, hidden_size=32, num_hidden_layers=layers, dtype="float32"
+        )
+        config.save_pretrained(tmp_path / f"model_{i}")
+        names.append(str(tmp_path / f"model_{i}"))
+        sizes.append(estimate_model_bytes(config))
+
+    # Consecutive models are grouped while their weights fit the budget together
+    budget = sizes[0] + sizes[1]
+    groups = QuirkyDataset._plan_concurrent_groups(names, budget)
+    assert groups == [names[:2], [names[2]], [names[3]]]
+    # Without a budget, every model runs on its own
+    assert QuirkyDataset._plan_concurrent_groups(names, 0) == [[n] for n in names]
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+import pyarrow.dataset as pds
+import torch
+
+from elk_generalization.elk.result_store import ResultStore
+
+
+def test_add_read_and_keys(tmp_path):
+    store = ResultStore(tmp_path / "results")
+    model = "EleutherAI/pythia-410M"
+    log_odds = torch.randn(3, 5)
+    store.add_log_odds(model, "lr", "trained-on-a", "got/cities", "labels", log_odds)
+    store.add_log_odds(
+        model, "lr", "trained-on-a", "got/cities", "quirky_labels", log_odds
+    )
+    store.add_metrics(
+        model, "random", "trained-on-a", "got/cities", "labels", [{"auroc": 0.5}] * 3
+    )
+    # Nothing is visible before the rows are flushed
+    assert store.read(model, "lr").empty
+    store.flush()
+
+    df = store.read(model, "lr", filter=pds.field("label_col") == "labels")
+    assert df["layer"].tolist() == [0, 1, 2]
+    assert (df["model"] == model).all() and (df["eval_dataset"] == "got/cities").all()
+    torch.testing.assert_close(torch.from_numpy(np.stack(df["log_odds"])), log_odds)
+    metrics = store.read(model, "random")["metrics"]
+    assert [json.loads(m) for m in metrics] == [{"auroc": 0.5}] * 3
+    assert store.keys(model, "lr", "labels") == {("trained-on-a", "got/cities")}
+    assert store.keys(model, "lr", "objective_labels") == set()
+    assert len(store.read()) == 9
+
+
+def test_rewritten_results_supersede_earlier_rows_and_compact(tmp_path):
+    store = ResultStore(tmp_path / "results")
+    first, second = torch.zeros(2, 4), torch.ones(2, 4)
+    store.add_log_odds("m", "lr", "trained-on-a", "a", "labels", first)
+    store.flush()
+    store.add_log_odds("m", "lr", "trained-on-b", "a", "labels", first)
+    store.flush()
+    # A second job writes the same result again, flushing as soon as it adds rows
+    other = ResultStore(tmp_path / "results", flush_rows=1)
+    other.add_log_odds("m", "lr", "trained-on-a", "a", "labels", second)
+
+    def read():
+        df = store.read("m", "lr")
+        return {
+            (desc, layer): lo
+            for desc, layer, lo in zip(df["train_desc"], df["layer"], df["log_odds"])
+        }
+
+    before = read()
+    assert len(before) == 4
+    assert all(v.tolist() == [1.0] * 4 for k, v in before.items() if k[0].endswith("a"))
+    partition = store.partition("m", "lr")
+    assert len(list(partition.glob("part-*.parquet"))) == 3
+
+    store.compact()
+
+    assert len(list(partition.glob("part-*.parquet"))) == 1
+    after = read()
+    assert before.keys() == after.keys()
+    assert all(after[k].tolist() == before[k].tolist() for k in before)
+    # Compacting a single file is a no-op
+    store.compact("m", "lr")
+    assert len(list(partition.glob("part-*.parquet"))) == 1
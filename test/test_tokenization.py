@@ -0,0 +1,48 @@
+from datasets import Dataset
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from elk_generalization.elk.tokenization import pretokenize
+
+
+def word_tokenizer(words: list[str]) -> PreTrainedTokenizerFast:
+    vocab = {word: i for i, word in enumerate(["[UNK]", *words])}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="[UNK]")
+
+
+def test_pretokenize_matches_encode_and_is_cached(tmp_path):
+    dataset = Dataset.from_dict(
+        {
+            "statement": ["one is less than two", "three is more than two"],
+            "choices": [["false", "true"], ["false", "true"]],
+        }
+    )
+    words = "one two three is less more than false true".split()
+    tokenizer = word_tokenizer(words)
+
+    tokenized = pretokenize(
+        dataset, tokenizer, ["statement"], "choices", cache_dir=tmp_path
+    )
+
+    assert tokenized["statement_ids"] == [
+        tokenizer.encode(text) for text in dataset["statement"]
+    ]
+    assert tokenized["choice_ids"] == [[8, 9], [8, 9]]
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # The same dataset and tokenizer hit the cache, another tokenizer does not
+    cached = pretokenize(
+        dataset, tokenizer, ["statement"], "choices", cache_dir=tmp_path
+    )
+    assert cached["statement_ids"] == tokenized["statement_ids"]
+    assert len(list(tmp_path.iterdir())) == 1
+    pretokenize(
+        dataset,
+        word_tokenizer(words[::-1]),
+        ["statement"],
+        "choices",
+        cache_dir=tmp_path,
+    )
+    assert len(list(tmp_path.iterdir())) == 2